@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf8:et:sta:ai:sw=4:ts=4:sts=4
+'''
+Measure single-stream throughput of a chunked publish between two hubs
+
+Streams 1GB over a loopback connection as one chunked publish, in 4KB and
+then 64KB chunks, and reports the rate at which the receiving handler got
+through it. Each backend named on the command line (default: all those that
+import) runs in its own process, so they don't share any state.
+'''
+
+import os
+import subprocess
+import sys
+import time
+
+import junction
+from junction.core import backend
+
+
+TOTAL = 1 << 30
+CHUNK_SIZES = (4096, 65536)
+PORT = 9870
+
+
+def stream(size):
+    chunk = 'x' * size
+    for i in xrange(TOTAL // size):
+        yield chunk
+
+
+def measure(size):
+    done = backend.Event()
+    received = [0]
+
+    def sink(chunks):
+        for chunk in chunks:
+            received[0] += len(chunk)
+        done.set()
+
+    receiver = junction.Hub(("127.0.0.1", PORT), [])
+    receiver.accept_publish('bench', 0, 0, 'sink', sink)
+    receiver.start()
+
+    sender = junction.Hub(("127.0.0.1", PORT + 1), [receiver.addr])
+    sender.start()
+    sender.wait_connected()
+    backend.pause_for(0.1)
+
+    start = time.time()
+    sender.publish('bench', 0, 'sink', (stream(size),))
+    done.wait()
+    elapsed = time.time() - start
+
+    sender.shutdown()
+    receiver.shutdown()
+    backend.pause_for(0.1)
+
+    assert received[0] == TOTAL
+    return elapsed
+
+
+def run(name):
+    getattr(junction, "activate_" + name)()
+    for size in CHUNK_SIZES:
+        elapsed = measure(size)
+        print "%10s %10s %10.2f %12.1f" % (name, "%dKB" % (size // 1024),
+                elapsed, TOTAL / elapsed / (1 << 20))
+        sys.stdout.flush()
+
+
+def available(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "--run":
+        run(sys.argv[2])
+        return
+
+    names = sys.argv[1:] or [name for name in backend._supported
+            if available(name)]
+    print "%10s %10s %10s %12s" % ("backend", "chunks", "seconds", "MB/s")
+    for name in names:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+            "--run", name])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf8:et:sta:ai:sw=4:ts=4:sts=4
+'''
+Measure the cost of matching an incoming message against local subscriptions
+
+Each run registers N shard subscriptions (one mask, N distinct values) plus a
+catch-all subscription under a second mask, then times
+Dispatcher.find_local_handler and Dispatcher.locally_handles for random
+routing ids. With the compiled routing index the per-lookup cost should stay
+flat as N grows from 10 to 10,000, and with overlap checks going through
+trie.MaskTrie the setup time should grow linearly rather than quadratically.
+'''
+
+import random
+import time
+
+from junction.core import const, dispatch
+
+
+SERVICE = "service"
+LOOKUPS = 100000
+SIZES = (10, 100, 1000, 10000)
+
+
+def handler(*args, **kwargs):
+    pass
+
+
+def build(count):
+    disp = dispatch.Dispatcher(None, None)
+    bits = max(1, (count - 1).bit_length())
+    mask = (1 << bits) - 1
+
+    for value in xrange(count):
+        disp.add_local_subscription(const.MSG_TYPE_RPC_REQUEST, SERVICE,
+                mask, value, "shard", handler, True)
+    disp.add_local_subscription(const.MSG_TYPE_RPC_REQUEST, SERVICE,
+            0, 0, "any", handler, True)
+
+    return disp, mask
+
+
+def measure(func, ids):
+    start = time.time()
+    for routing_id in ids:
+        func(routing_id)
+    return (time.time() - start) / len(ids)
+
+
+def main():
+    print "%8s %12s %12s %12s" % (
+            "subs", "setup (s)", "find (us)", "handles (us)")
+
+    for count in SIZES:
+        start = time.time()
+        disp, mask = build(count)
+        setup = time.time() - start
+
+        ids = [random.randrange(count) for i in xrange(LOOKUPS)]
+
+        # the first lookup compiles the index, leave it out of the timing
+        disp.find_local_handler(const.MSG_TYPE_RPC_REQUEST, SERVICE, 0, "shard")
+
+        find = measure(lambda rid: disp.find_local_handler(
+                const.MSG_TYPE_RPC_REQUEST, SERVICE, rid, "shard"), ids)
+        handles = measure(lambda rid: disp.locally_handles(
+                const.MSG_TYPE_RPC_REQUEST, SERVICE, rid), ids)
+
+        print "%8d %12.3f %12.3f %12.3f" % (
+                count, setup, find * 1e6, handles * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf8:et:sta:ai:sw=4:ts=4:sts=4
+'''
+Measure how many incoming messages per second the dispatcher can handle
+
+Feeds publishes and RPC requests for an immediate (unscheduled) no-op handler
+straight into Dispatcher.incoming, with a stand-in peer that drops the
+responses, so the numbers are the dispatcher's own per-message overhead.
+Logging is left at its default WARNING level, so any time spent formatting
+debug messages shows up directly in the rates. The last column repeats the
+publish run with junction.core.trace enabled.
+'''
+
+import time
+
+from junction.core import connection, const, dispatch, trace
+
+
+SERVICE = "service"
+MESSAGES = 200000
+
+
+class Peer(object):
+    ident = ("127.0.0.1", 9000)
+    up = True
+
+    def push(self, msg):
+        pass
+
+    def push_string(self, msg):
+        pass
+
+    def dump(self, msg):
+        return connection.dump(msg)
+
+
+def handler(*args, **kwargs):
+    pass
+
+
+def rate(disp, msg):
+    peer = Peer()
+    start = time.time()
+    for i in xrange(MESSAGES):
+        disp.incoming(peer, msg)
+    return MESSAGES / (time.time() - start)
+
+
+def main():
+    disp = dispatch.Dispatcher(None, None)
+    disp.add_local_subscription(const.MSG_TYPE_PUBLISH, SERVICE,
+            0, 0, "method", handler, False)
+    disp.add_local_subscription(const.MSG_TYPE_RPC_REQUEST, SERVICE,
+            0, 0, "method", handler, False)
+
+    publish = (const.MSG_TYPE_PUBLISH,
+            (SERVICE, 0, "method", (1, 2), {'a': 3}))
+    request = (const.MSG_TYPE_RPC_REQUEST,
+            (1, SERVICE, 0, "method", (1, 2), {'a': 3}))
+
+    pubs = rate(disp, publish)
+    rpcs = rate(disp, request)
+
+    trace.enable()
+    traced = rate(disp, publish)
+    trace.disable()
+
+    print "%14s %14s %14s" % ("publish/s", "rpc/s", "traced pub/s")
+    print "%14d %14d %14d" % (pubs, rpcs, traced)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,10 +13,29 @@ log = logging.getLogger("junction.client")
 
 class Client(object):
     "A junction client without the server"
-    def __init__(self, addrs):
-        self._rpc_client = rpc.ProxiedClient(self)
-        self._dispatcher = dispatch.Dispatcher(self._rpc_client, None)
+    def __init__(self, addrs, send_batch_size=connection.SEND_BATCH_SIZE,
+            send_linger=0, rpc_max_age=None, max_inflight=None,
+            max_queued_bytes=None, on_queue_full=const.QUEUE_BLOCK,
+            chunk_batch_size=1, chunk_batch_bytes=dispatch.CHUNK_BATCH_BYTES,
+            chunk_linger=dispatch.CHUNK_LINGER, fragment_size=None):
+        if on_queue_full not in const.QUEUE_POLICIES:
+            raise ValueError("unknown send queue policy %r" % (on_queue_full,))
+        self._rpc_client = rpc.ProxiedClient(self, rpc_max_age, max_inflight)
+        self._chunk_options = {
+            'chunk_batch_size': chunk_batch_size,
+            'chunk_batch_bytes': chunk_batch_bytes,
+            'chunk_linger': chunk_linger,
+        }
+        self._dispatcher = dispatch.Dispatcher(
+                self._rpc_client, None, **self._chunk_options)
         self._peer = None
+        self._peer_options = {
+            'send_batch_size': send_batch_size,
+            'send_linger': send_linger,
+            'max_queued_bytes': max_queued_bytes,
+            'on_queue_full': on_queue_full,
+            'fragment_size': fragment_size,
+        }
 
         # allow just a single (host, port) pair
         if (isinstance(addrs, tuple) and
@@ -34,7 +53,7 @@ class Client(object):
         # down we are going to cycle to the next potential peer from the Client
         self._peer = connection.Peer(
                 None, self._dispatcher, self._addrs.popleft(),
-                backend.Socket(), reconnect=False)
+                backend.Socket(), reconnect=False, **self._peer_options)
         self._peer.start()
 
     def wait_connected(self, timeout=None):
@@ -51,7 +70,7 @@ class Client(object):
         result = self._peer.wait_connected(timeout)
         if not result:
             if timeout is not None:
-                log.warn("connect wait timed out after %.2f seconds" % timeout)
+                log.warn("connect wait timed out after %.2f seconds", timeout)
         return result
 
     def reset(self):
@@ -59,11 +78,31 @@ class Client(object):
         log.info("resetting client")
         rpc_client = self._rpc_client
         self._addrs.append(self._peer.addr)
-        self.__init__(self._addrs)
+        self.__init__(self._addrs, **dict(
+            self._peer_options, **self._chunk_options))
         self._rpc_client = rpc_client
         self._dispatcher.rpc_client = rpc_client
         rpc_client._client = weakref.ref(self)
 
+    def stats(self):
+        '''Collect counters describing the client's internal state
+
+        :returns:
+            a dict with the key ``connection``, mapping to a dict of the hub
+            connection's ``queued_frames``, ``queued_bytes``,
+            ``dropped_frames``, ``frames_sent``, ``sends`` (socket writes)
+            and ``frames_per_send``, or ``None`` if there is no connection,
+            and the keys ``bookkeeping`` and ``overload`` with the same
+            counts as in :meth:`Hub.stats <junction.hub.Hub.stats>`, where
+            ``max_inflight`` applies to the ``inflight`` RPCs in
+            ``bookkeeping``.
+        '''
+        return {
+            'connection': self._peer.stats() if self._peer else None,
+            'bookkeeping': self._dispatcher.bookkeeping_stats(),
+            'overload': self._rpc_client.overload_stats(),
+        }
+
     def shutdown(self):
         'Close the hub connection'
         log.info("shutting down")
@@ -131,7 +170,8 @@ class Client(object):
                         timeout)[0]
 
     def send_rpc(self, service, routing_id, method, args=None, kwargs=None,
-            broadcast=False):
+            broadcast=False, hedge=None, deadline=None,
+            on_overload=const.OVERLOAD_BLOCK):
         '''Send out an RPC request
 
         :param service: the service name (the routing top level)
@@ -149,23 +189,58 @@ class Client(object):
         :param broadcast:
             if ``True``, send to all peers with matching subscriptions
         :type broadcast: bool
+        :param hedge:
+            for singular RPCs, send a second copy of the request to another
+            eligible peer if no response has arrived after this many seconds.
+            with ``True`` the delay is derived from the latency seen so far
+            from the first peer. the first response to arrive is the one
+            used. ignored for broadcast and chunked RPCs.
+        :type hedge: float, bool or None
+        :param deadline:
+            seconds from now after which the request's handlers should be
+            skipped rather than run, as the response will no longer be
+            wanted. they then fail with :class:`DeadlineExceeded
+            <junction.errors.DeadlineExceeded>`. peers that don't support
+            deadlines run the handlers regardless. ignored for chunked RPCs.
+            a request blocked waiting on ``max_inflight`` gives up with
+            :class:`WaitTimeout <junction.errors.WaitTimeout>` once it passes.
+        :type deadline: float or None
+        :param on_overload:
+            what to do when ``max_inflight`` is set and the client already
+            has that many RPCs outstanding: ``"block"`` (the default) waits
+            for a response to free up a slot, and ``"fail"`` raises
+            :class:`Overloaded <junction.errors.Overloaded>` at once. the
+            hub never blocks on behalf of a client, so requests it relays
+            to peers at their own limit fail with :class:`Overloaded
+            <junction.errors.Overloaded>` either way.
+        :type on_overload: str
 
         :returns:
             a :class:`RPC <junction.futures.RPC>` object representing the
             RPC and its future response.
 
         :raises:
-            :class:`Unroutable <junction.errors.Unroutable>` if the client
-            doesn't have a connection to a hub
+            - :class:`Unroutable <junction.errors.Unroutable>` if the client
+              doesn't have a connection to a hub
+            - :class:`Overloaded <junction.errors.Overloaded>` if the
+              targets are at ``max_inflight`` and ``on_overload`` is
+              ``"fail"``
+            - ``ValueError`` if ``on_overload`` isn't ``"block"`` or
+              ``"fail"``
         '''
+        if on_overload not in const.OVERLOAD_POLICIES:
+            raise ValueError("unknown overload policy %r" % (on_overload,))
+
         if not self._peer.up:
             raise errors.Unroutable()
 
         return self._dispatcher.send_proxied_rpc(service, routing_id, method,
-                args or (), kwargs or {}, not broadcast)
+                args or (), kwargs or {}, not broadcast, hedge, deadline,
+                on_overload)
 
     def rpc(self, service, routing_id, method, args=None, kwargs=None,
-            timeout=None, broadcast=False):
+            timeout=None, broadcast=False, hedge=None,
+            on_overload=const.OVERLOAD_BLOCK):
         '''Send an RPC request and return the corresponding response
 
         This will block waiting until the response has been received.
@@ -184,11 +259,22 @@ class Client(object):
         :type kwargs: dict
         :param timeout:
             maximum time to wait for a response in seconds. with None, there is
-            no timeout.
+            no timeout. it is also sent along as the request's ``deadline``
+            (see :meth:`send_rpc`).
         :type timeout: float or None
         :param broadcast:
             if ``True``, send to all peers with matching subscriptions
         :type broadcast: bool
+        :param hedge:
+            for singular RPCs, send a second copy of the request to another
+            eligible peer if no response has arrived after this many seconds.
+            with ``True`` the delay is derived from the latency seen so far
+            from the first peer. the first response to arrive is the one
+            used. ignored for broadcast and chunked RPCs.
+        :type hedge: float, bool or None
+        :param on_overload:
+            ``"block"`` or ``"fail"``, see :meth:`send_rpc`
+        :type on_overload: str
 
         :returns:
             a list of the objects returned by the RPC's targets. these could be
@@ -198,11 +284,20 @@ class Client(object):
             - :class:`Unroutable <junction.errors.Unroutable>` if no peers are
               registered to receive the message
             - :class:`WaitTimeout <junction.errors.WaitTimeout>` if a timeout
-              was provided and it expires
+              was provided and it expires, in which case the RPC is also
+              :meth:`cancelled <junction.futures.RPC.cancel>`
+            - :class:`Overloaded <junction.errors.Overloaded>` if the
+              client is at ``max_inflight`` and ``on_overload`` is ``"fail"``
         '''
         rpc = self.send_rpc(service, routing_id, method,
-                args or (), kwargs or {}, broadcast=broadcast)
-        return rpc.get(timeout)
+                args or (), kwargs or {}, broadcast=broadcast, hedge=hedge,
+                deadline=timeout, on_overload=on_overload)
+        try:
+            return rpc.get(timeout)
+        except errors.WaitTimeout:
+            # nobody is waiting for the responses any more
+            rpc.cancel()
+            raise
 
     def rpc_receiver_count(self, service, routing_id, method, timeout=None):
         '''Get the number of peers that would handle a particular RPC
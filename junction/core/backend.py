@@ -30,6 +30,16 @@ __all__ = ["active", "Socket", "Queue", "Event", "schedule", "schedule_in",
 _supported = ["greenhouse", "gevent", "eventlet"]
 active = None
 
+# counts activations, so state built on an earlier one (like the timer
+# wheel's driver coroutine) can tell it has to start over
+activations = 0
+
+
+def _activated(name):
+    global active, activations
+    active = name
+    activations += 1
+
 
 def activate_greenhouse():
     globals()['Socket'] = greenhouse.Socket
@@ -44,7 +54,7 @@ def activate_greenhouse():
     globals()['pause'] = greenhouse.pause
     globals()['pause_for'] = greenhouse.pause_for
     globals()['getcurrent'] = greenhouse.getcurrent
-    globals()['active'] = "greenhouse"
+    _activated("greenhouse")
 
 
 def gevent_schedule(target=None, args=(), kwargs=None):
@@ -99,7 +109,7 @@ def activate_gevent():
     globals()['pause'] = gevent.sleep
     globals()['pause_for'] = gevent.sleep
     globals()['getcurrent'] = gevent.getcurrent
-    globals()['active'] = "gevent"
+    _activated("gevent")
 
 
 def eventlet_schedule(target=None, args=(), kwargs=None):
@@ -193,7 +203,7 @@ def activate_eventlet():
     globals()['pause'] = eventlet.sleep
     globals()['pause_for'] = eventlet.sleep
     globals()['getcurrent'] = eventlet.getcurrent
-    globals()['active'] = "eventlet"
+    _activated("eventlet")
 
 
 def activate():
@@ -0,0 +1,102 @@
+'''Packing consecutive chunks of a stream into shared frames
+
+With coalescing turned on, the sender of a chunked stream serializes each
+item it pulls from the generator on its own, and gathers them up until it
+has ``size`` of them or ``nbytes`` serialized bytes, or ``linger`` seconds
+have passed since the first. They then go out together as one chunk frame
+with the rc ``const.CHUNK_BATCH``, which costs a single frame header, a
+single send and a single credit. On the receiving end a :class:`Batch` is
+unpacked again by the generator handed to the handler, so it still sees
+one item per iteration.
+'''
+from __future__ import absolute_import
+
+import sys
+import time
+
+import mummy
+
+from . import const
+
+
+__all__ = ["Batch", "frames", "valid"]
+
+
+class Batch(object):
+    'A received frame of serialized chunks, decoded as it is iterated over'
+    __slots__ = ["items"]
+
+    def __init__(self, items):
+        self.items = items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        for item in self.items:
+            yield mummy.loads(item)
+
+
+def valid(data):
+    'Whether the data of a CHUNK_BATCH frame is a list of serialized chunks'
+    return isinstance(data, (list, tuple)) and all(
+            isinstance(item, str) for item in data)
+
+
+def frames(chunks, size, nbytes, linger=None):
+    '''Pull chunks from an iterable, packing consecutive ones together
+
+    Yields ``(rc, data)`` pairs, where rc is 0 and data a chunk on its own,
+    or rc is ``const.CHUNK_BATCH`` and data a list of serialized chunks. The
+    ``linger`` time bound is checked as each chunk is produced, so a
+    generator that blocks holds back the chunks already packed.
+
+    An exception from the iterable is raised again once the chunks before
+    it have gone out, and a chunk that can't be serialized is yielded on
+    its own, so the sender reports both as it would without coalescing.
+    '''
+    chunks = iter(chunks)
+    while 1:
+        batch, first, total, started = [], None, 0, None
+        exc_info = unserializable = None
+        try:
+            while len(batch) < size and total < nbytes:
+                chunk = chunks.next()
+                try:
+                    item = mummy.dumps(chunk)
+                except TypeError:
+                    unserializable = (chunk,)
+                    break
+
+                if not batch:
+                    first = chunk
+                batch.append(item)
+                total += len(item)
+
+                if linger is not None:
+                    if started is None:
+                        started = time.time()
+                    elif time.time() - started >= linger:
+                        break
+        except StopIteration:
+            if batch:
+                yield _packed(batch, first)
+            return
+        except Exception:
+            if not batch:
+                raise
+            exc_info = sys.exc_info()
+
+        if batch:
+            yield _packed(batch, first)
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if unserializable is not None:
+            yield 0, unserializable[0]
+
+
+def _packed(batch, first):
+    # a lone chunk goes out as it would without coalescing
+    if len(batch) == 1:
+        return 0, first
+    return const.CHUNK_BATCH, batch
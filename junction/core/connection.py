@@ -7,19 +7,41 @@ import struct
 
 import mummy
 
-from . import backend, const
+from . import backend, const, sendqueue, timers, trace
 from .. import errors
 
 
 RECONNECT_JITTER = 0.25
 
+# reconnect pauses are timed on the timer wheel, but a wait gives up on it
+# this many seconds past the pause, so a lost timer only delays the attempt
+RECONNECT_BACKSTOP = 1.0
+
+# the sender writes queued frames in batches of up to this many bytes
+SEND_BATCH_SIZE = 65536
+
+# starting size of each connection's receive buffer. it grows to fit larger
+# frames, and goes back to this size once they have been read
+RECV_BUFFER_SIZE = 65536
+
+# the top bit of a frame's length prefix marks it as a RawFrame
+RAW_FRAME = 0x80000000
+
+# strs can go out as the payload of a RawFrame. below this size, copying
+# them through the serializer costs less than the extra socket write. other
+# buffer types could be changed while queued, and mummy can't serialize them
+# for peers without raw frames, so they aren't taken
+RAW_FRAME_MIN = 4096
+
 log = logging.getLogger("junction.connection")
 
 
 class Peer(object):
 
     def __init__(self, local_addr, dispatcher, addr, sock, initiator=True,
-            reconnect=True):
+            reconnect=True, send_batch_size=SEND_BATCH_SIZE, send_linger=0,
+            max_queued_bytes=None, on_queue_full=const.QUEUE_BLOCK,
+            fragment_size=None):
         self.local_addr = local_addr
         self.dispatcher = dispatcher
         self.addr = addr
@@ -29,7 +51,22 @@ class Peer(object):
         self._closing = False
 
         self.attempt_reconnects = reconnect
-        self.send_queue = backend.Queue()
+        self.send_queue = sendqueue.SendQueue(max_queued_bytes,
+                on_queue_full, self.queue_high, self.queue_low,
+                self.queue_overflow)
+        self.send_batch_size = send_batch_size
+        self.send_linger = send_linger
+        self.fragment_size = fragment_size
+        self.frames_sent = 0
+        self.sends = 0
+        self._recv_buf = bytearray(RECV_BUFFER_SIZE)
+        self._recv_start = self._recv_end = 0
+
+        # counter for the frames split up into fragments on the way out, and
+        # the pieces received so far of those coming in, by that counter
+        self._fragmented = 0
+        self._fragments = {}
+
         self.established = backend.Event()
         self.reconnect_waiter = backend.Event()
 
@@ -39,6 +76,9 @@ class Peer(object):
         # we'll get this from the peer on handshake
         self.ident = ()
 
+        # and these from the MSG_TYPE_FEATURES message right after it
+        self.features = frozenset()
+
     ##
     ## Public API
     ##
@@ -54,9 +94,10 @@ class Peer(object):
 
         if not reconnect:
             self._closing = True
+            self.send_queue.close()
             self.reconnect_waiter.set()
             self.reconnect_waiter.clear()
-            backend.schedule_in(1.0, self.sock.close)
+            timers.add(1.0, self.sock.close)
         elif self.initiator and self.attempt_reconnects:
             self.schedule_restarter()
 
@@ -68,10 +109,45 @@ class Peer(object):
         return self.up
 
     def push(self, msg):
-        self.send_queue.put(self.dump(msg))
-
-    def push_string(self, msg):
-        self.send_queue.put(msg)
+        if trace.events is not None:
+            trace.record("send", msg[0], msg[1], self.ident)
+        self.push_string(self.dump(msg), msg[0], exchange_of(msg))
+
+    def push_string(self, msg, msg_type=None, exchange=None):
+        # exchange is the RPC or stream the frame belongs to (see exchange()),
+        # to keep it behind that exchange's frames already in the queue
+        lane = const.LANES.get(msg_type, const.LANE_RPC)
+        if (self.fragment_size is not None and
+                len(msg) > self.fragment_size and
+                const.FEATURE_FRAGMENTS in self.features):
+            self.push_fragments(msg, lane, exchange)
+        else:
+            self.send_queue.put(msg, msg_type in const.DROPPABLE, lane,
+                    exchange)
+
+    def push_fragments(self, frame, lane, exchange=None):
+        # the pieces go out in order in the frame's lane, but other lanes
+        # get their turns in between. they are never dropped to make room,
+        # as losing one would waste the rest
+        self._fragmented += 1
+        pieces = _split(frame, self.fragment_size)
+        for i, piece in enumerate(pieces):
+            more = i < len(pieces) - 1
+            fragment = RawFrame((const.MSG_TYPE_FRAGMENT,
+                (self._fragmented, more, piece)), (2,))
+            if not self.send_queue.put(fragment, False, lane, exchange):
+                # overflowed with the "disconnect" policy
+                return
+
+    def stats(self):
+        return {
+            'queued_frames': self.send_queue.qsize(),
+            'queued_bytes': self.send_queue.bytes,
+            'dropped_frames': self.send_queue.dropped,
+            'frames_sent': self.frames_sent,
+            'sends': self.sends,
+            'frames_per_send': self.frames_sent / float(self.sends or 1),
+        }
 
     ##
     ## Coroutines
@@ -98,16 +174,59 @@ class Peer(object):
             self.schedule_io_coros()
 
     def sender_coro(self):
+        queue = self.send_queue
         try:
             while 1:
-                self.sock.sendall(self.send_queue.get())
+                frames = [queue.get()]
+                size = len(frames[0])
+
+                # optionally give producers a moment to queue up more
+                if self.send_linger and queue.empty() and \
+                        size < self.send_batch_size:
+                    backend.pause_for(self.send_linger)
+
+                # coalesce everything else already waiting (up to the batch
+                # size) so it goes out with a single sendall
+                while size < self.send_batch_size and not queue.empty():
+                    frames.append(queue.get())
+                    size += len(frames[-1])
+
+                self.write(frames)
+                self.frames_sent += len(frames)
         except socket.error:
             self.connection_failure()
 
+    def write(self, frames):
+        # the payloads of raw frames are written as they are, rather than
+        # copied into one string with everything around them
+        pending = []
+        for frame in frames:
+            if isinstance(frame, RawFrame):
+                pending.append(frame.header)
+                self.sock.sendall(''.join(pending))
+                self.sock.sendall(frame.payload)
+                self.sends += 2
+                pending = []
+            else:
+                pending.append(frame)
+
+        if len(pending) == 1:
+            self.sock.sendall(pending[0])
+            self.sends += 1
+        elif pending:
+            self.sock.sendall(''.join(pending))
+            self.sends += 1
+
     def receiver_coro(self):
         try:
             while 1:
-                self.dispatcher.incoming(self, self.recv_one())
+                msg = self.recv_one()
+                if (isinstance(msg, tuple) and msg and
+                        msg[0] == const.MSG_TYPE_FRAGMENT):
+                    msg = self.reassemble(msg)
+                    if msg is None:
+                        continue
+                self.dispatcher.incoming(self, msg)
         except (socket.error, errors.MessageCutOff):
             self.connection_failure()
 
@@ -119,14 +238,37 @@ class Peer(object):
     def target(self):
         return self.ident or self.addr
 
+    def queue_high(self, queued):
+        self.dispatcher.send_queue_high(self, queued)
+
+    def queue_low(self, queued):
+        self.dispatcher.send_queue_low(self, queued)
+
+    def queue_overflow(self, queued):
+        # with the "disconnect" policy. whatever is queued goes too, it was
+        # meant for the connection that is being given up on
+        if not self.up:
+            return
+        log.warn("send queue to %r overflowed at %d bytes, disconnecting",
+                self.target, queued)
+        self.up = False
+        self.send_queue.clear()
+        backend.schedule(self.go_down, kwargs={'reconnect': True})
+
     def connection_failure(self):
         if self.ident is None:
             log.warn("client connection went down")
         else:
-            log.warn("connection to %r went down" % (self.ident,))
+            log.warn("connection to %r went down", self.ident)
         self.go_down(reconnect=True, expected=False)
 
     def init_sock(self):
+        # anything left in the receive buffer (or in pieces) was from an old
+        # socket, and the features will be announced again on the new one
+        self._recv_start = self._recv_end = 0
+        self._fragments = {}
+        self.features = frozenset()
+
         # disable Nagle algorithm with the NODELAY option
         self.sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
 
@@ -157,7 +299,7 @@ class Peer(object):
         backend.schedule(self.restarter_coro)
 
     def attempt_connect(self):
-        log.info("attempting to connect to %r" % (self.target,))
+        log.info("attempting to connect to %r", self.target)
         try:
             self.sock.connect(self.target)
         except socket.error:
@@ -167,13 +309,16 @@ class Peer(object):
 
     def attempt_handshake(self):
         peername = self.sock.getpeername()
-        log.info("sending a handshake to %r" % (peername,))
+        log.info("sending a handshake to %r", peername)
 
-        # send a handshake message
+        # send a handshake message, followed by our supported features. that
+        # goes in a message of its own so the handshake stays in the format
+        # older peers validate against
         try:
             self.sock.sendall(self.dump((const.MSG_TYPE_HANDSHAKE, (
                 self.local_addr,
-                list(self.dispatcher.local_subscriptions())))))
+                list(self.dispatcher.local_subscriptions())))) +
+                self.dump((const.MSG_TYPE_FEATURES, sorted(const.FEATURES))))
         except socket.error:
             return False
 
@@ -181,7 +326,7 @@ class Peer(object):
         try:
             received = self.recv_one()
         except (socket.error, errors.MessageCutOff):
-            log.warn("receiving handshake from %r failed" % (peername,))
+            log.warn("receiving handshake from %r failed", peername)
             return False
 
         # validate the peer's handshake message format
@@ -193,12 +338,13 @@ class Peer(object):
                 or len(received[1]) != 2
                 or not isinstance(received[1][0], (tuple, type(None)))
                 or not isinstance(received[1][1], list)):
-            log.warn("invalid handshake from %r" % (peername,))
+            log.warn("invalid handshake from %r", peername)
             return False
 
-        log.info("received handshake from %r" % (peername,))
+        log.info("received handshake from %r", peername)
 
         self.ident, subs = received[1]
+        self.recv_features()
         self.up = True
         self.established.set()
 
@@ -235,7 +381,12 @@ class Peer(object):
 
             self.dispatcher.add_reconnecting(self.addr, self)
 
-            if not self.reconnect_waiter.wait(timeout=pause) or self._closing:
+            # the waiter is set by the timer, or by go_down() on a close
+            self.reconnect_waiter.clear()
+            timer = timers.add(pause, self.reconnect_waiter.set)
+            self.reconnect_waiter.wait(timeout=pause + RECONNECT_BACKSTOP)
+            timer.cancel()
+            if self._closing:
                 return False
 
             if self.attempt_connect():
@@ -246,19 +397,194 @@ class Peer(object):
     def dump(self, msg):
         return dump(msg)
 
-    def read_bytes(self, count):
-        data = [self.sock.recv(count)]
-        count -= len(data[0])
-        while count:
-            data.append(self.sock.recv(count))
-            if not data[-1]:
-                raise errors.MessageCutOff(sum(map(len, data)))
-            count -= len(data[-1])
-        return ''.join(data)
+    def fill_recv_buffer(self, count):
+        # read until at least `count` unparsed bytes are buffered. each read
+        # takes as much as the socket has ready, so one recv_into can pull in
+        # any number of frames for recv_one to parse without further reads
+        while self._recv_end - self._recv_start < count:
+            buf = self._recv_buf
+            if len(buf) - self._recv_start < count:
+                # not enough room after the unparsed bytes, so move them to
+                # the front (of a bigger buffer if that is still too small)
+                pending = self._recv_end - self._recv_start
+                if len(buf) < count:
+                    self._recv_buf = bytearray(max(count, len(buf) * 2))
+                self._recv_buf[:pending] = buf[self._recv_start:self._recv_end]
+                self._recv_start, self._recv_end = 0, pending
+                buf = self._recv_buf
+
+            received = self.sock.recv_into(memoryview(buf)[self._recv_end:])
+            if not received:
+                raise errors.MessageCutOff(self._recv_end - self._recv_start)
+            self._recv_end += received
+
+    def recv_features(self):
+        # the features are sent right behind the handshake, so they usually
+        # arrive in the same read. taking them now means they are known before
+        # anything gets sent to the peer. but never wait for them, as peers
+        # that predate them won't send any
+        pending = self._recv_end - self._recv_start
+        if pending < 4:
+            return
+        size = struct.unpack_from("!I", self._recv_buf, self._recv_start)[0]
+        if pending < 4 + size:
+            return
+
+        msg = _loads_from(self._recv_buf, self._recv_start + 4, size)
+        if isinstance(msg, tuple) and msg and \
+                msg[0] == const.MSG_TYPE_FEATURES:
+            self.recv_one()
+            self.dispatcher.incoming(self, msg)
 
     def recv_one(self):
-        size = struct.unpack("!I", self.read_bytes(4))[0]
-        return mummy.loads(self.read_bytes(size))
+        self.fill_recv_buffer(4)
+        size = struct.unpack_from("!I", self._recv_buf, self._recv_start)[0]
+        raw = size & RAW_FRAME
+        size ^= raw
+        self.fill_recv_buffer(4 + size)
+
+        start = self._recv_start + 4
+        if raw:
+            msg = _load_raw(self._recv_buf, start, size)
+        else:
+            msg = _loads_from(self._recv_buf, start, size)
+        self._recv_start = start + size
+
+        if self._recv_start == self._recv_end:
+            # nothing left unparsed, start back at the front
+            self._recv_start = self._recv_end = 0
+            if len(self._recv_buf) > RECV_BUFFER_SIZE:
+                self._recv_buf = bytearray(RECV_BUFFER_SIZE)
+
+        return msg
+
+    def reassemble(self, msg):
+        # collect the pieces of a fragmented frame, and decode it once the
+        # last one is in. returns None until then
+        if not isinstance(msg[1], tuple) or len(msg[1]) != 3:
+            log.warn("received malformed fragment from %r", self.target)
+            return None
+
+        counter, more, piece = msg[1]
+        self._fragments.setdefault(counter, []).append(piece)
+        if more:
+            return None
+
+        frame = ''.join(self._fragments.pop(counter))
+        msg = load_frame(frame)
+        if msg is None:
+            log.warn("received malformed fragmented frame from %r",
+                    self.target)
+        return msg
+
+
+class RawFrame(object):
+    '''A frame carrying a byte string outside of its serialized message
+
+    The message is serialized with None in place of the payload, along with
+    ``path``, the indexes to follow into the message body to find its spot.
+    On the wire that header is followed by the payload, which is written out
+    untouched.
+    '''
+    __slots__ = ["header", "payload", "size"]
+
+    def __init__(self, msg, path):
+        msgtype, body = msg
+        self.payload = payload = _at(body, path)
+        self.size = len(payload)
+        header = mummy.dumps((msgtype, _place(body, path, None), path))
+        size = 4 + len(header) + self.size
+        self.header = struct.pack(
+                "!II", RAW_FRAME | size, len(header)) + header
+
+    def __len__(self):
+        return len(self.header) + self.size
+
+
+def load_frame(frame):
+    'Decode a whole frame from a string, length prefix and all'
+    try:
+        size = struct.unpack_from("!I", frame)[0]
+        raw = size & RAW_FRAME
+        size ^= raw
+        if size != len(frame) - 4:
+            return None
+        if raw:
+            return _load_raw(frame, 4, size)
+        return _loads_from(frame, 4, size)
+    except (struct.error, ValueError, TypeError):
+        return None
+
+
+def _load_raw(buf, start, size):
+    # put a raw frame's message back together. the payload is copied out of
+    # the buffer, but never goes through the decoder
+    header_size = struct.unpack_from("!I", buf, start)[0]
+    payload = memoryview(buf)[start + 4 + header_size:start + size]
+    try:
+        msgtype, body, path = _loads_from(buf, start + 4, header_size)
+        return msgtype, _place(body, path, payload.tobytes())
+    except (ValueError, TypeError, IndexError):
+        # the dispatcher drops it as malformed
+        return None
+
+
+def _split(frame, size):
+    # the bytes of a frame in pieces of the given size. they are views onto
+    # the frame where possible, copies only where one spans its segments
+    if isinstance(frame, RawFrame):
+        segments = [frame.header, frame.payload]
+    else:
+        segments = [frame]
+
+    pieces, carry = [], ''
+    for segment in segments:
+        if getattr(segment, 'itemsize', 1) != 1:
+            segment = segment.tobytes()
+        view = memoryview(segment)
+        if carry:
+            needed = size - len(carry)
+            carry += view[:needed].tobytes()
+            view = view[needed:]
+            if len(carry) < size:
+                continue
+            pieces.append(carry)
+        while len(view) >= size:
+            pieces.append(view[:size])
+            view = view[size:]
+        carry = view.tobytes()
+
+    if carry:
+        pieces.append(carry)
+    return pieces
+
+
+def raw_payload(msg, path):
+    '''The byte string at ``path`` in a message body, if it is worth sending
+    in a :class:`RawFrame`, otherwise None'''
+    try:
+        payload = _at(msg[1], path)
+    except (IndexError, TypeError):
+        return None
+    if not isinstance(payload, str):
+        return None
+    if not RAW_FRAME_MIN <= len(payload) < RAW_FRAME - RAW_FRAME_MIN:
+        return None
+    return payload
+
+
+def _at(body, path):
+    for index in path:
+        body = body[index]
+    return body
+
+
+def _place(body, path, item):
+    # a copy of the nested tuple body, with item at path
+    index = path[0]
+    if len(path) > 1:
+        item = _place(body[index], path[1:], item)
+    return body[:index] + (item,) + body[index + 1:]
 
 
 def compare(peerA, peerB):
@@ -272,6 +598,80 @@ def compare(peerA, peerB):
     return peerB, peerA
 
 
+def fan_out(targets, msg, serialized=None):
+    '''Push a message to many targets, encoding it at most once
+
+    Every remote Peer gets the same serialized frame (``serialized`` if it was
+    already dumped), while other targets (the dispatcher's local handlers) get
+    the message object itself.
+    '''
+    for target in targets:
+        if isinstance(target, Peer):
+            if trace.events is not None:
+                trace.record("send", msg[0], msg[1], target.ident)
+            if serialized is None:
+                serialized = dump(msg)
+            target.push_string(serialized, msg[0], exchange_of(msg))
+        else:
+            target.push(msg)
+
+
+def counter_of(msg):
+    'The counter of the RPC or chunked stream a message belongs to, or None'
+    index = const.COUNTER_INDEX.get(msg[0])
+    if index is None:
+        return None
+    body = msg[1]
+    if isinstance(body, tuple):
+        if len(body) <= index:
+            return None
+        body = body[index]
+    if isinstance(body, (int, long)):
+        return body
+    return None
+
+
+def exchange(msg_type, counter):
+    '''Name the RPC or chunked stream that a message belongs to
+
+    Each end of a connection numbers the exchanges it starts with its own
+    counters, so the same counter going out can belong to two of them: one
+    started here, and one the peer started that this message answers.
+    '''
+    return msg_type in const.RESPONSE_TYPES, counter
+
+
+def exchange_of(msg):
+    'The :func:`exchange` a message belongs to, or None'
+    msg_type = msg[0]
+    if msg_type == const.MSG_TYPE_FRAGMENT:
+        # fragments are numbered apart from the exchanges they carry
+        return None
+    counter = counter_of(msg)
+    if counter is None:
+        return None
+    if msg_type == const.MSG_TYPE_CREDIT:
+        # a credit goes the opposite way to the stream it is for
+        answers, counter = exchange(msg[1][0], counter)
+        return not answers, counter
+    return exchange(msg_type, counter)
+
+
 def dump(msg):
     msg = mummy.dumps(msg)
     return struct.pack("!I", len(msg)) + msg
+
+
+def _pick_loads_from():
+    # decode frames straight out of the receive buffer if this mummy accepts
+    # a buffer object over a bytearray, otherwise copy each frame out first
+    sample = mummy.dumps((1, "sample"))
+    try:
+        if mummy.loads(buffer(bytearray(sample))) == (1, "sample"):
+            return lambda buf, start, size: mummy.loads(
+                    buffer(buf, start, size))
+    except Exception:
+        pass
+    return lambda buf, start, size: mummy.loads(str(buf[start:start + size]))
+
+_loads_from = _pick_loads_from()
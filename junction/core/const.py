@@ -35,6 +35,25 @@ MSG_TYPE_PROXY_PUBLISH_END_CHUNKS = 27
 MSG_TYPE_PROXY_REQUEST_END_CHUNKS = 28
 MSG_TYPE_PROXY_RESPONSE_END_CHUNKS = 29
 
+# batched forms of ANNOUNCE and UNSUBSCRIBE, carrying a list of
+# (msg_type, service, mask, value) subscriptions in one frame
+MSG_TYPE_ANNOUNCE_MANY = 30
+MSG_TYPE_UNSUBSCRIBE_MANY = 31
+
+# sent right after the handshake, carrying a list of the protocol features
+# (below) the sender understands. peers that predate it just drop it
+MSG_TYPE_FEATURES = 32
+
+# tells a peer to stop work on the RPC with the counter it carries
+MSG_TYPE_CANCEL = 33
+
+# hands credits for more chunks back to the sender of a chunked stream
+MSG_TYPE_CREDIT = 34
+
+# a piece of a frame too large to hold up the rest of a connection's
+# traffic, sent in its place to peers with the "fragments" feature
+MSG_TYPE_FRAGMENT = 35
+
 # error codes
 RPC_ERR_MALFORMED = 1
 RPC_ERR_NOHANDLER = 2
@@ -44,6 +63,134 @@ RPC_ERR_UNKNOWN = 5
 RPC_ERR_LOST_CONN = 6
 RPC_ERR_UNSER_RESP = 7
 RPC_ERR_BADARGS = 8
+RPC_ERR_DEADLINE = 9
+RPC_ERR_OVERLOADED = 10
+
+# the rc of a chunk frame packing several consecutive chunks of a stream, as
+# a list of separately serialized items, for peers with the "chunk_batch"
+# feature. unlike the error codes it doesn't end the stream
+CHUNK_BATCH = -1
+
+# optional protocol features. one is only used with peers that listed it in
+# their MSG_TYPE_FEATURES message
+#  - subscribe_many: MSG_TYPE_ANNOUNCE_MANY and MSG_TYPE_UNSUBSCRIBE_MANY are
+#    understood
+#  - request_options: RPC_REQUEST and PROXY_REQUEST messages may carry a dict
+#    of options as an extra last element
+#  - cancel: MSG_TYPE_CANCEL is understood
+#  - credit: chunked streams are flow controlled with MSG_TYPE_CREDIT
+#  - chunk_batch: chunk frames may carry the rc CHUNK_BATCH
+#  - raw_frames: large byte strings may be sent outside of the serializer,
+#    in frames flagged with connection.RAW_FRAME
+#  - fragments: frames may be split up into MSG_TYPE_FRAGMENTs, which are
+#    always sent as raw frames
+FEATURE_SUBSCRIBE_MANY = "subscribe_many"
+FEATURE_REQUEST_OPTIONS = "request_options"
+FEATURE_CANCEL = "cancel"
+FEATURE_CREDIT = "credit"
+FEATURE_CHUNK_BATCH = "chunk_batch"
+FEATURE_RAW_FRAMES = "raw_frames"
+FEATURE_FRAGMENTS = "fragments"
+
+FEATURES = frozenset([
+    FEATURE_SUBSCRIBE_MANY,
+    FEATURE_REQUEST_OPTIONS,
+    FEATURE_CANCEL,
+    FEATURE_CREDIT,
+    FEATURE_CHUNK_BATCH,
+    FEATURE_RAW_FRAMES,
+    FEATURE_FRAGMENTS,
+])
+
+# the number of chunks of a stream that may be sent ahead of the receiver
+# using them up, for peers on both ends with the "credit" feature
+CHUNK_WINDOW = 64
+
+# what send_rpc does when a target already has max_inflight RPCs outstanding
+OVERLOAD_BLOCK = "block"
+OVERLOAD_FAIL = "fail"
+
+OVERLOAD_POLICIES = frozenset([OVERLOAD_BLOCK, OVERLOAD_FAIL])
+
+# what a peer's send queue does when a frame would take it past its bound
+QUEUE_BLOCK = "block"
+QUEUE_DROP = "drop"
+QUEUE_DISCONNECT = "disconnect"
+
+QUEUE_POLICIES = frozenset([QUEUE_BLOCK, QUEUE_DROP, QUEUE_DISCONNECT])
+
+# frames that a "drop" send queue may throw away to make room
+DROPPABLE = frozenset([MSG_TYPE_PUBLISH, MSG_TYPE_PROXY_PUBLISH])
+
+# where to find the counter in each type of message that carries one: the
+# index into the payload tuple, where 0 also covers a bare counter payload.
+# the counter of a MSG_TYPE_FRAGMENT numbers the frames split up on its
+# connection. every message type is listed, with None for those that carry
+# no counter at all
+COUNTER_INDEX = dict.fromkeys([
+    MSG_TYPE_HANDSHAKE,
+    MSG_TYPE_ANNOUNCE,
+    MSG_TYPE_UNSUBSCRIBE,
+    MSG_TYPE_PUBLISH,
+    MSG_TYPE_PROXY_PUBLISH,
+    MSG_TYPE_ANNOUNCE_MANY,
+    MSG_TYPE_UNSUBSCRIBE_MANY,
+    MSG_TYPE_FEATURES,
+])
+COUNTER_INDEX.update(dict.fromkeys([
+    MSG_TYPE_RPC_REQUEST,
+    MSG_TYPE_RPC_RESPONSE,
+    MSG_TYPE_PROXY_REQUEST,
+    MSG_TYPE_PROXY_RESPONSE,
+    MSG_TYPE_PROXY_RESPONSE_COUNT,
+    MSG_TYPE_PROXY_QUERY_COUNT,
+    MSG_TYPE_RESPONSE_IS_CHUNKED,
+    MSG_TYPE_PROXY_RESPONSE_IS_CHUNKED,
+    MSG_TYPE_CANCEL,
+    MSG_TYPE_FRAGMENT,
+] + range(MSG_TYPE_PUBLISH_CHUNK, MSG_TYPE_PROXY_RESPONSE_END_CHUNKS + 1), 0))
+COUNTER_INDEX.update({
+    MSG_TYPE_PUBLISH_IS_CHUNKED: 3,
+    MSG_TYPE_REQUEST_IS_CHUNKED: 3,
+    MSG_TYPE_PROXY_PUBLISH_IS_CHUNKED: 3,
+    MSG_TYPE_PROXY_REQUEST_IS_CHUNKED: 4,
+    # proxied response chunks lead with the ident of the peer they came from
+    MSG_TYPE_PROXY_RESPONSE_CHUNK: 1,
+    # credits name the stream they are for by its (msg_type, counter)
+    MSG_TYPE_CREDIT: 1,
+})
+
+# the message types that answer an exchange started by the other end of the
+# connection, so carry its counter. the others with a counter carry their
+# sender's own, and a credit is numbered like the stream it is for
+RESPONSE_TYPES = frozenset([
+    MSG_TYPE_RPC_RESPONSE,
+    MSG_TYPE_PROXY_RESPONSE,
+    MSG_TYPE_PROXY_RESPONSE_COUNT,
+    MSG_TYPE_RESPONSE_IS_CHUNKED,
+    MSG_TYPE_RESPONSE_CHUNK,
+    MSG_TYPE_RESPONSE_END_CHUNKS,
+    MSG_TYPE_PROXY_RESPONSE_IS_CHUNKED,
+    MSG_TYPE_PROXY_RESPONSE_CHUNK,
+    MSG_TYPE_PROXY_RESPONSE_END_CHUNKS,
+])
+
+# the lanes of a peer's send queue. each keeps its frames in order, but they
+# are interleaved with the other lanes' on the way out. this only sets the
+# lane an exchange starts out in: the later frames of an RPC or chunked
+# stream follow its earlier ones wherever they are still queued (see
+# sendqueue), so a CANCEL, CREDIT or chunk can't overtake what it refers to.
+# anything not listed goes in the RPC lane
+LANE_CONTROL = 0
+LANE_RPC = 1
+LANE_BULK = 2
+
+LANES = dict((msg_type, LANE_CONTROL) for msg_type in (
+        MSG_TYPE_HANDSHAKE, MSG_TYPE_ANNOUNCE, MSG_TYPE_UNSUBSCRIBE,
+        MSG_TYPE_ANNOUNCE_MANY, MSG_TYPE_UNSUBSCRIBE_MANY, MSG_TYPE_FEATURES,
+        MSG_TYPE_CANCEL, MSG_TYPE_CREDIT))
+LANES.update((msg_type, LANE_BULK) for msg_type in xrange(
+        MSG_TYPE_PUBLISH_IS_CHUNKED, MSG_TYPE_PROXY_RESPONSE_END_CHUNKS + 1))
 
 REVERSE = dict((val, key)
         for (key, val) in globals().items()
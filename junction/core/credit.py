@@ -0,0 +1,129 @@
+'''Credit-based flow control for chunked streams
+
+The sender of a chunked publish, request or response starts out with
+``const.CHUNK_WINDOW`` credits for each receiver that announced the
+"credit" feature, spends one per chunk, and blocks when it runs out with
+any of them. Receivers hand credits back in batches of ``BATCH`` as the
+generator of received chunks is consumed, so no more than a window's worth
+of chunks is ever buffered for a stream on the receiving end.
+
+Proxy hubs don't block, they keep a :class:`Relay` for each stream they
+forward. It follows the credits of the receivers downstream and passes
+them on to the original sender as they come back, so the window holds end
+to end.
+'''
+from __future__ import absolute_import
+
+import weakref
+
+from . import backend, const
+
+
+__all__ = ["Window", "Relay", "Grants"]
+
+
+# receivers hand back credits once they have used up this many
+BATCH = const.CHUNK_WINDOW // 2
+
+
+class Window(object):
+    'The credits a stream\'s sender has left with each of its receivers'
+    def __init__(self):
+        self.credits = {}
+        self._granted = backend.Event()
+
+    def add(self, key):
+        self.credits[key] = const.CHUNK_WINDOW
+
+    def discard(self, key):
+        # the receiver is gone, it no longer holds the stream back
+        if self.credits.pop(key, None) is not None:
+            self._wake()
+
+    def available(self):
+        'The fewest credits left with any receiver, or None if none count'
+        if not self.credits:
+            return None
+        return min(self.credits.itervalues())
+
+    def grant(self, key, count):
+        if key in self.credits:
+            self.credits[key] += count
+            self._wake()
+
+    def spend(self):
+        for key in self.credits:
+            self.credits[key] -= 1
+
+    def wait(self):
+        'Block until every receiver has a credit to spare'
+        while self.credits and self.available() <= 0:
+            self._granted.wait()
+
+    def _wake(self):
+        self._granted.set()
+        self._granted.clear()
+
+
+class Relay(Window):
+    '''A proxy hub's view of a forwarded stream's credits
+
+    ``forward`` is called with a count of credits to hand back to the
+    original sender, or is None if the sender doesn't take credits.
+    '''
+    def __init__(self, forward):
+        super(Relay, self).__init__()
+        self.forward = forward
+
+        # the credits the original sender believes it has left
+        self.upstream = const.CHUNK_WINDOW
+
+    def discard(self, key):
+        super(Relay, self).discard(key)
+        self.relay()
+
+    def grant(self, key, count):
+        super(Relay, self).grant(key, count)
+        self.relay()
+
+    def spend(self):
+        super(Relay, self).spend()
+        self.upstream -= 1
+        self.relay()
+
+    def relay(self):
+        # keep the sender no further ahead than the slowest receiver, but
+        # only bother it with more once it is down to its last batch
+        if self.forward is None:
+            return
+        available = self.available()
+        if available is None:
+            available = const.CHUNK_WINDOW
+        owed = available - self.upstream
+        if owed > 0 and self.upstream < BATCH:
+            self.upstream = available
+            self.forward(owed)
+
+
+class Grants(object):
+    '''A receiver's side of a stream, handing credits back as chunks go
+
+    ``send`` is called with the count of credits to return to the sender.
+    '''
+    def __init__(self, send):
+        self.send = send
+        self.owed = 0
+        self.abandoned = False
+        self._ref = None
+
+    def consumed(self, count=1):
+        self.owed += count
+        if self.owed >= BATCH:
+            count, self.owed = self.owed, 0
+            self.send(count)
+
+    def watch(self, generator, on_abandon):
+        # the generator handed to application code. if it is dropped before
+        # reaching the end of the stream, on_abandon is called so the rest
+        # can be thrown away without holding up the sender
+        self._ref = weakref.ref(generator, lambda ref: on_abandon())
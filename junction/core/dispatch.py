@@ -2,14 +2,17 @@ from __future__ import absolute_import
 
 import collections
 import inspect
+import itertools
 import logging
 import socket
 import sys
+import time
 import traceback
 
 import mummy
 
-from . import backend, connection, const
+from . import (backend, coalesce, connection, const, credit, timers, trace,
+        trie)
 from .. import errors, hooks
 
 
@@ -17,130 +20,251 @@ log = logging.getLogger("junction.dispatch")
 
 STOP = object()
 
+# number of (msg_type, service, routing_id, method) resolutions to keep in
+# the route cache. 0 disables it.
+ROUTE_CACHE_SIZE = 4096
+
+# how long an RPC sent with hedge=True waits before hedging when there is no
+# latency on record yet for the peer it went to
+HEDGE_DELAY = 0.1
+
+# with latency on record, hedge=True waits for the average latency plus this
+# many times its average deviation, which approximates a high percentile
+HEDGE_DEVIATIONS = 4
+
+# with chunk coalescing turned on (chunk_batch_size > 1), the most serialized
+# bytes to pack into one chunk frame, and how long the first chunk packed
+# may wait for more to join it
+CHUNK_BATCH_BYTES = 65536
+CHUNK_LINGER = 0.01
+
+# chunk senders give other greenlets a turn once they have run for this many
+# seconds, or whenever a target's send queue has this many bytes waiting
+CHUNK_TIME_SLICE = 0.002
+CHUNK_QUEUE_DEPTH = connection.SEND_BATCH_SIZE * 4
+
 
 class Dispatcher(object):
-    def __init__(self, rpc_client, hub, hooks=None):
+    def __init__(self, rpc_client, hub, hooks=None,
+            route_cache_size=ROUTE_CACHE_SIZE, chunk_batch_size=1,
+            chunk_batch_bytes=CHUNK_BATCH_BYTES, chunk_linger=CHUNK_LINGER):
         self.rpc_client = rpc_client
         self.hub = hub
         self.hooks = hooks
         self.peer_subs = {}
+        self.subs_by_peer = {}
         self.local_subs = {}
+        self.local_index = {}
+        self.local_tries = {}
+        self.route_cache = collections.OrderedDict()
+        self.route_cache_size = route_cache_size
+        self.route_generation = 0
+        self.route_cache_hits = 0
+        self.route_cache_misses = 0
+        self.default_selection = None
+        self.selection_by_service = {}
         self.clients = {}
         self.peers = {}
         self.reconnecting = {}
         self.inflight_proxies = {}
+        self.proxied_requests = {}
         self.proxying_channels = {}
         self.received_channels = {}
         self.outgoing_channels = {}
+        self.send_windows = {}
+        self.chunk_batch_size = chunk_batch_size
+        self.chunk_batch_bytes = chunk_batch_bytes
+        self.chunk_linger = chunk_linger
         self.udp_sender = backend.Socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     def add_local_subscription(self, msg_type, service, mask, value, method,
             handler, schedule):
+        if self._add_local_subscription(msg_type, service, mask, value,
+                method, handler, schedule):
+            self.send_subscription_changes(const.MSG_TYPE_ANNOUNCE,
+                    const.MSG_TYPE_ANNOUNCE_MANY,
+                    [(msg_type, service, mask, value)])
+
+    def add_local_subscriptions(self, subscriptions):
+        # subscriptions is an iterable of 7-tuples of
+        # (msg_type, service, mask, value, method, handler, schedule).
+        # if one of them fails, the ones before it stay in place
+        added = []
+        try:
+            for sub in subscriptions:
+                if self._add_local_subscription(*sub):
+                    added.append(sub[:4])
+        finally:
+            self.send_subscription_changes(const.MSG_TYPE_ANNOUNCE,
+                    const.MSG_TYPE_ANNOUNCE_MANY, added)
+
+    def _add_local_subscription(self, msg_type, service, mask, value, method,
+            handler, schedule):
+        # returns whether the (mask, value) is new and needs announcing
+        #
         # storage in local_subs is shaped like so:
-        # {(msg_type, service): [
-        #     (mask, value, {method: (handler, schedule), ...}), ...], ...}
+        # {(msg_type, service): {
+        #     (mask, value): {method: (handler, schedule), ...}, ...}, ...}
+        # and local_tries holds each method's (mask, value) pairs in a
+        # trie.MaskTrie so overlaps are found without comparing to every one:
+        # {(msg_type, service): {method: MaskTrie, ...}, ...}
 
         # sanity check that no 1 bits in the value would be masked out.
         # in that case, there is no routing id that could possibly match
         if value & ~mask:
             raise errors.ImpossibleSubscription(msg_type, service, mask, value)
 
-        existing = self.local_subs.setdefault((msg_type, service), [])
-        for pmask, pvalue, phandlers in existing:
-            if pmask & value == mask & pvalue:
-                if method in phandlers:
-                    # (mask, value) overlaps with a previous
-                    # subscription with the same method
-                    raise errors.OverlappingSubscription(
-                            (msg_type, service, mask, value, method),
-                            (msg_type, service, pmask, pvalue, method))
-                elif mask == pmask and value == pvalue:
-                    # same (mask, value) as a previous subscription but for a
-                    # different method, so piggy-back on that data structure
-                    phandlers[method] = (handler, schedule)
-
-                    # also bail out. we can skip the MSG_TYPE_ANNOUNCE
-                    # below b/c peers don't route with their peers' methods
-                    return
-
-        existing.append((mask, value, {method: (handler, schedule)}))
+        tries = self.local_tries.setdefault((msg_type, service), {})
+        method_trie = tries.get(method)
+        if method_trie is None:
+            method_trie = tries[method] = trie.MaskTrie()
+
+        overlap = method_trie.find_overlap(mask, value)
+        if overlap is not None:
+            # (mask, value) overlaps with a previous
+            # subscription with the same method
+            raise errors.OverlappingSubscription(
+                    (msg_type, service, mask, value, method),
+                    (msg_type, service) + overlap + (method,))
+
+        method_trie.add(mask, value)
+        self.route_generation += 1
+
+        existing = self.local_subs.setdefault((msg_type, service), {})
+        if (mask, value) in existing:
+            # same (mask, value) as a previous subscription but for a
+            # different method, so piggy-back on that data structure
+            existing[(mask, value)][method] = (handler, schedule)
+
+            # also bail out. we can skip the MSG_TYPE_ANNOUNCE
+            # b/c peers don't route with their peers' methods
+            return False
 
-        # let peers know about the new subscription
-        for peer in self.peers.itervalues():
-            if not peer.up:
-                continue
-            peer.push((const.MSG_TYPE_ANNOUNCE,
-                    (msg_type, service, mask, value)))
+        existing[(mask, value)] = {method: (handler, schedule)}
+        self.local_index.pop((msg_type, service), None)
+        return True
 
     def remove_local_subscription(self, msg_type, service, mask, value):
-        group = self.local_subs.get((msg_type, service), 0)
-        if not group:
+        if not self._remove_local_subscription(msg_type, service, mask, value):
             return False
-        for i, (pmask, pvalue, phandlers) in enumerate(group):
-            if (mask, value) == (pmask, pvalue):
-                del group[i]
-                if not group:
-                    del self.local_subs[(msg_type, service)]
-                for peer in self.peers.itervalues():
-                    if not peer.up:
-                        continue
-                    peer.push((const.MSG_TYPE_UNSUBSCRIBE,
-                        (msg_type, service, mask, value)))
-                return True
-        return False
+        self.send_subscription_changes(const.MSG_TYPE_UNSUBSCRIBE,
+                const.MSG_TYPE_UNSUBSCRIBE_MANY,
+                [(msg_type, service, mask, value)])
+        return True
+
+    def remove_local_subscriptions(self, subscriptions):
+        # subscriptions is an iterable of (msg_type, service, mask, value)
+        removed = [sub for sub in subscriptions
+                if self._remove_local_subscription(*sub)]
+        self.send_subscription_changes(const.MSG_TYPE_UNSUBSCRIBE,
+                const.MSG_TYPE_UNSUBSCRIBE_MANY, removed)
+        return removed
+
+    def _remove_local_subscription(self, msg_type, service, mask, value):
+        existing = self.local_subs.get((msg_type, service), {})
+        handlers = existing.pop((mask, value), None)
+        if handlers is None:
+            return False
+        if not existing:
+            del self.local_subs[(msg_type, service)]
+
+        tries = self.local_tries[(msg_type, service)]
+        for method in handlers:
+            tries[method].remove(mask, value)
+            if not tries[method]:
+                del tries[method]
+        if not tries:
+            del self.local_tries[(msg_type, service)]
+
+        self.local_index.pop((msg_type, service), None)
+        self.route_generation += 1
+        return True
+
+    def send_subscription_changes(self, single_type, batch_type, subs):
+        # let peers know about new or removed subscriptions, with a single
+        # frame to each peer however many subscriptions there are. peers
+        # without the "subscribe_many" feature would drop the batched frame,
+        # so they get one frame per subscription instead
+        if not subs:
+            return
+        if len(subs) == 1:
+            self.multipush(self.peers.itervalues(), (single_type, subs[0]))
+            return
+
+        batched, single = [], []
+        for peer in self.peers.itervalues():
+            if const.FEATURE_SUBSCRIBE_MANY in peer.features:
+                batched.append(peer)
+            else:
+                single.append(peer)
+
+        if batched:
+            self.multipush(batched, (batch_type, list(subs)))
+        if single:
+            for sub in subs:
+                self.multipush(single, (single_type, sub))
 
     def incoming_unsubscribe(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 4:
             # badly formatted message
-            log.warn("received malformed unsubscribe from %r" % (peer.ident,))
+            log.warn("received malformed unsubscribe from %r", peer.ident)
             return
 
-        log.debug("received unsubscribe %r from %r" % (msg, peer.ident))
+        log.debug("received unsubscribe %r from %r", msg, peer.ident)
 
         msg_type, service, mask, value = msg
 
-        groups = self.peer_subs.get((msg_type, service), 0)
-        if not groups:
+        if (msg_type, service) not in self.peer_subs:
             log.warn(("unsubscribe from %r described an unrecognized" +
-                    " subscription (msg_type, service)") % (peer.ident,))
-            return
-        for i, group in enumerate(groups):
-            if (mask, value, peer) == group:
-                del groups[i]
-                if not groups:
-                    del self.peer_subs[(msg_type, service)]
-                break
-        else:
+                    " subscription (msg_type, service)"), peer.ident)
+        elif not self.remove_peer_subscription(
+                peer, msg_type, service, mask, value):
             log.warn(("unsubscribe from %r described an " +
-                    "unrecognized subscription %r") % (peer.ident, msg))
+                    "unrecognized subscription %r"), peer.ident, msg)
+
+    def compiled_local_subs(self, msg_type, service):
+        # the compiled form of local_subs groups subscriptions by mask:
+        # {(msg_type, service): [
+        #     (mask, {value: {method: (handler, schedule), ...}}), ...], ...}
+        # so matching a routing id takes one hash lookup per distinct mask.
+        # it is dropped whenever add/remove_local_subscription change the
+        # group, and rebuilt here on the next lookup. the handler dicts are
+        # shared with local_subs, so adding a method to an existing
+        # (mask, value) doesn't need a rebuild.
+        compiled = self.local_index.get((msg_type, service))
+        if compiled is not None:
+            return compiled
+
+        existing = self.local_subs.get((msg_type, service))
+        if not existing:
+            return ()
+
+        compiled = []
+        by_mask = {}
+        for (mask, value), handlers in existing.iteritems():
+            if mask not in by_mask:
+                by_mask[mask] = {}
+                compiled.append((mask, by_mask[mask]))
+            by_mask[mask][value] = handlers
+
+        self.local_index[(msg_type, service)] = compiled
+        return compiled
 
     def find_local_handler(self, msg_type, service, routing_id, method):
-        group = self.local_subs.get((msg_type, service), 0)
-        if not group:
-            return None, False
-        for mask, value, handlers in group:
-            if routing_id & mask == value and method in handlers:
+        for mask, by_value in self.compiled_local_subs(msg_type, service):
+            handlers = by_value.get(routing_id & mask)
+            if handlers is not None and method in handlers:
                 return handlers[method]
         return None, False
 
     def locally_handles(self, msg_type, service, routing_id):
-        group = self.local_subs.get((msg_type, service), [])
-        if not group:
-            return False
-        for mask, value, handlers in group:
-            if routing_id & mask == value:
+        for mask, by_value in self.compiled_local_subs(msg_type, service):
+            if routing_id & mask in by_value:
                 return True
         return False
 
-    def multipush(self, targets, msg):
-        for target in targets:
-            if target.up:
-                target.push(msg)
-
-    def multipush_str(self, targets, msg):
-        for target in targets:
-            if target.up:
-                target.push_string(msg)
+    def multipush(self, targets, msg, serialized=None):
+        connection.fan_out((t for t in targets if t.up), msg, serialized)
 
     def multipush_udp(self, targets, msg):
         msgstr = mummy.dumps(msg)
@@ -151,9 +275,8 @@ class Dispatcher(object):
                 self.udp_sender.sendto(msgstr, target.ident)
 
     def local_subscriptions(self):
-        for key, value in self.local_subs.iteritems():
-            msg_type, service = key
-            for mask, value, handlers in value:
+        for (msg_type, service), existing in self.local_subs.iteritems():
+            for mask, value in existing:
                 yield (msg_type, service, mask, value)
 
     def add_reconnecting(self, addr, peer):
@@ -184,12 +307,17 @@ class Dispatcher(object):
 
     def connection_received(self, peer, subs):
         if not peer.initiator and peer.ident not in self.hub._started_peers:
-            backend.schedule(hooks._get(self.hooks, "connection_received"),
+            backend.schedule(self.connection_received_hook,
                     (peer.ident, subs))
 
     def connection_lost(self, peer, subs):
-        backend.schedule(hooks._get(self.hooks, "connection_lost"),
-                (peer.ident, subs))
+        backend.schedule(self.connection_lost_hook, (peer.ident, subs))
+
+    def send_queue_high(self, peer, queued):
+        backend.schedule(self.send_queue_high_hook, (peer.ident, queued))
+
+    def send_queue_low(self, peer, queued):
+        backend.schedule(self.send_queue_low_hook, (peer.ident, queued))
 
     def drop_peer(self, peer):
         self.peers.pop(peer.ident, None)
@@ -197,9 +325,19 @@ class Dispatcher(object):
 
         channels = self.proxying_channels.pop(peer.ident, {})
         for source_counter, entry in channels.iteritems():
+            self.untrack_credits(entry['window'], entry['targets'],
+                    entry['type'], entry['dest_counter'])
             self.multipush(entry['targets'],
                 (entry['type'] + 3, const.RPC_ERR_LOST_CONN, None))
 
+        # chunked responses being forwarded to the peer from elsewhere
+        # mustn't wait on credits from it any more
+        for channels in self.proxying_channels.itervalues():
+            for entry in channels.itervalues():
+                if (entry['type'] == const.MSG_TYPE_RESPONSE_IS_CHUNKED and
+                        entry['targets'][0] is peer):
+                    entry['window'].discard(peer)
+
         # reply to all in-flight proxied RPCs to the dropped peer
         # with the "lost connection" error
         for counter in self.rpc_client.by_peer.get(id(peer), []):
@@ -208,21 +346,70 @@ class Dispatcher(object):
 
         peer_ident = peer.ident or id(peer)
 
-        # stop sender greenlets for any outgoing chunked messages to this peer
+        # and neither should streams sent or forwarded to it by this hub
+        for window in self.send_windows.pop(peer_ident, {}).itervalues():
+            window.discard(peer)
+
+        # stop sender greenlets for any outgoing chunked messages to this peer.
+        # scheduled RPC handlers are there too, but they run to completion
+        # since stopping one partway could leave a mess behind
         channels = self.outgoing_channels.pop(peer_ident, {})
         for msgtype, counter in channels.keys():
-            backend.end(channels.pop((msgtype, counter)))
+            glet = channels.pop((msgtype, counter))
+            if msgtype != const.MSG_TYPE_RPC_REQUEST:
+                backend.end(glet)
 
         # give a LostConnection error to any in-progress
         # chunked messages and cork them with a STOP
         channels = self.received_channels.get(peer_ident, {})
-        for (msgtype, counter), (ev, deq) in channels.items():
+        for msgtype, counter in channels.keys():
             self.handle_chunk_arrival(peer_ident or id(peer), msgtype, counter,
                     1, errors.LostConnection(peer.ident))
 
         self.rpc_client.connection_down(peer)
         return subs
 
+    def track_credits(self, window, targets, msgtype, counter):
+        # set up the window to follow the credits of each target that can
+        # grant them. remote ones send a MSG_TYPE_CREDIT, found again here
+        # under (msgtype, counter), and local ones grant to it directly
+        for target in targets:
+            if isinstance(target, LocalTarget):
+                # only ever on the receiving end of publishes and requests
+                if msgtype != const.MSG_TYPE_RESPONSE_IS_CHUNKED:
+                    target.window = window
+                    window.add(target)
+            elif const.FEATURE_CREDIT in target.features:
+                window.add(target)
+                bypeer = self.send_windows.setdefault(
+                        target.ident or id(target), {})
+                bypeer[(msgtype, counter)] = window
+        return window
+
+    def untrack_credits(self, window, targets, msgtype, counter):
+        for target in targets:
+            if isinstance(target, LocalTarget):
+                continue
+            peer_addr = target.ident or id(target)
+            bypeer = self.send_windows.get(peer_addr, {})
+            if bypeer.get((msgtype, counter)) is window:
+                del bypeer[(msgtype, counter)]
+                if not bypeer:
+                    del self.send_windows[peer_addr]
+
+    def credit_sender(self, peer, msgtype, counter, source=None):
+        # the function that hands credits for a stream back to its sender,
+        # or None if the sender doesn't take them
+        if const.FEATURE_CREDIT not in peer.features:
+            return None
+        msg = (msgtype, counter)
+        extra = () if source is None else (source,)
+
+        def grant(count):
+            if peer.up:
+                peer.push((const.MSG_TYPE_CREDIT, msg + (count,) + extra))
+        return grant
+
     def register_outgoing_channel(self, peers, msgtype, counter, glet):
         for peer in peers:
             if isinstance(peer, LocalTarget):
@@ -236,54 +423,182 @@ class Dispatcher(object):
             if isinstance(peer, LocalTarget):
                 continue
             peer_addr = peer.ident or id(peer)
-            bypeer = self.outgoing_channels.setdefault(peer_addr, {})
+            bypeer = self.outgoing_channels.get(peer_addr, {})
             if bypeer.pop((msgtype, counter), None) and not bypeer:
                 del self.outgoing_channels[peer_addr]
 
     def incoming_announce(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 4:
             # drop malformed messages
-            log.warn("received malformed announce from %r" % (peer.ident,))
+            log.warn("received malformed announce from %r", peer.ident)
             return
 
-        log.debug("received announce %r from %r" % (msg, peer.ident))
+        log.debug("received announce %r from %r", msg, peer.ident)
 
         self.add_peer_subscriptions(peer, [msg])
 
+    def incoming_announce_many(self, peer, msg):
+        if not _is_subscription_list(msg):
+            # drop malformed messages
+            log.warn("received malformed announce_many from %r",
+                    peer.ident)
+            return
+
+        log.debug("received %d announces from %r", len(msg), peer.ident)
+
+        self.add_peer_subscriptions(peer, msg)
+
+    def incoming_unsubscribe_many(self, peer, msg):
+        if not _is_subscription_list(msg):
+            # badly formatted message
+            log.warn("received malformed unsubscribe_many from %r",
+                    peer.ident)
+            return
+
+        log.debug("received %d unsubscribes from %r", len(msg), peer.ident)
+
+        unrecognized = [sub for sub in msg
+                if not self.remove_peer_subscription(peer, *sub)]
+        if unrecognized:
+            log.warn(("unsubscribe_many from %r described %d " +
+                    "unrecognized subscriptions"),
+                    peer.ident, len(unrecognized))
+
     def add_peer_subscriptions(self, peer, subscriptions):
         # format for peer_subs:
-        # {(msg_type, service): [(mask, value, connection)]}
+        # {(msg_type, service): {mask: {value: set([connection, ...])}}}
+        # and the reverse index subs_by_peer, so dropping a peer only has to
+        # touch its own entries:
+        # {connection: set([(msg_type, service, mask, value), ...])}
+        by_peer = self.subs_by_peer.setdefault(peer, set())
         for msg_type, service, mask, value in subscriptions:
-            self.peer_subs.setdefault((msg_type, service), []).append(
-                    (mask, value, peer))
+            self.peer_subs.setdefault((msg_type, service), {}).setdefault(
+                    mask, {}).setdefault(value, set()).add(peer)
+            by_peer.add((msg_type, service, mask, value))
+        if not by_peer:
+            del self.subs_by_peer[peer]
+        self.route_generation += 1
+
+    def remove_peer_subscription(self, peer, msg_type, service, mask, value):
+        sub = (msg_type, service, mask, value)
+        by_peer = self.subs_by_peer.get(peer, ())
+        if sub not in by_peer:
+            return False
+
+        by_peer.remove(sub)
+        if not by_peer:
+            del self.subs_by_peer[peer]
+        self._unindex_peer_subscription(peer, *sub)
+        self.route_generation += 1
+        return True
 
     def drop_peer_subscriptions(self, peer):
-        removed = []
-        for (msg_type, service), subs in self.peer_subs.items():
-            for (mask, value, conn) in subs:
-                if conn is peer:
-                    removed.append((msg_type, service, mask, value))
-                    subs.remove((mask, value, conn))
-            if not subs:
-                del self.peer_subs[(msg_type, service)]
+        removed = list(self.subs_by_peer.pop(peer, ()))
+        for sub in removed:
+            self._unindex_peer_subscription(peer, *sub)
+        self.route_generation += 1
         return removed
 
+    def _unindex_peer_subscription(self, peer, msg_type, service, mask, value):
+        by_mask = self.peer_subs[(msg_type, service)]
+        by_value = by_mask[mask]
+        peers = by_value[value]
+
+        peers.remove(peer)
+        if not peers:
+            del by_value[value]
+            if not by_value:
+                del by_mask[mask]
+                if not by_mask:
+                    del self.peer_subs[(msg_type, service)]
+
     def find_peer_routes(self, msg_type, service, routing_id):
-        for mask, value, peer in self.peer_subs.get((msg_type, service), []):
-            if peer.up and routing_id & mask == value:
-                yield peer
+        # peers are taken out of peer_subs by drop_peer as they go down, so
+        # everything in the index is a live route and needs no 'up' check
+        by_mask = self.peer_subs.get((msg_type, service))
+        if not by_mask:
+            return []
+
+        if len(by_mask) == 1:
+            mask, by_value = by_mask.items()[0]
+            return list(by_value.get(routing_id & mask, ()))
+
+        # a peer with overlapping subscriptions under different
+        # masks should still only show up once
+        found = set()
+        for mask, by_value in by_mask.iteritems():
+            peers = by_value.get(routing_id & mask)
+            if peers:
+                found.update(peers)
+        return list(found)
+
+    def find_routes(self, msg_type, service, routing_id, method):
+        # resolves to (peers, local_handler, schedule), going through an LRU
+        # cache. entries are stamped with route_generation, which every
+        # change to local_subs or peer_subs bumps, so a stale entry is just
+        # a miss and invalidation never has to walk the cache.
+        key = (msg_type, service, routing_id, method)
+        entry = self.route_cache.pop(key, None)
+        if entry is not None and entry[0] == self.route_generation:
+            self.route_cache_hits += 1
+            self.route_cache[key] = entry
+            return entry[1]
+        self.route_cache_misses += 1
+
+        handler, schedule = self.find_local_handler(
+                msg_type, service, routing_id, method)
+        routes = (tuple(self.find_peer_routes(msg_type, service, routing_id)),
+                handler, schedule)
+
+        if self.route_cache_size:
+            self.route_cache[key] = (self.route_generation, routes)
+            if len(self.route_cache) > self.route_cache_size:
+                self.route_cache.popitem(last=False)
+
+        return routes
+
+    def bookkeeping_stats(self):
+        rpc_client = self.rpc_client
+        return {
+            'inflight': len(rpc_client.inflight),
+            'by_peer': sum(map(len, rpc_client.by_peer.itervalues())),
+            'deadlines': len(rpc_client.deadlines),
+            'abandoned': len(rpc_client.abandoned),
+            'inflight_proxies': len(self.inflight_proxies),
+            'received_channels': sum(
+                map(len, self.received_channels.itervalues())),
+            'proxying_channels': sum(
+                map(len, self.proxying_channels.itervalues())),
+            'send_windows': sum(map(len, self.send_windows.itervalues())),
+        }
+
+    def reclaim(self):
+        # drop the bookkeeping of abandoned and expired RPCs, along with any
+        # proxy_requests that were waiting on the expired ones
+        for counter in self.rpc_client.reclaim():
+            entry = self.inflight_proxies.pop(counter, None)
+            if entry is not None:
+                peer = entry['peer']
+                self.proxied_requests.pop(
+                        (peer.ident or id(peer), entry['client_counter']),
+                        None)
+
+    def route_cache_stats(self):
+        return {
+            'hits': self.route_cache_hits,
+            'misses': self.route_cache_misses,
+            'size': len(self.route_cache),
+            'capacity': self.route_cache_size,
+        }
 
     def send_publish(self, client, service, routing_id, method, args, kwargs,
             forwarded=False, singular=False):
-        # get the peers registered for this publish
-        peers = list(self.find_peer_routes(
-                const.MSG_TYPE_PUBLISH, service, routing_id))
-
-        # handle locally if we have a hander for it
-        handler, schedule = self.find_local_handler(
+        # get the peers registered for this publish, and
+        # handle locally if we have a handler for it
+        peers, handler, schedule = self.find_routes(
                 const.MSG_TYPE_PUBLISH, service, routing_id, method)
 
-        targets = peers[:]
+        targets = list(peers)
         if handler:
             targets.append(LocalTarget(self, handler, schedule, client))
 
@@ -311,28 +626,24 @@ class Dispatcher(object):
                 (service, routing_id, method, args, kwargs))
 
         if handler is not None:
-            log.debug("locally handling publish %r %s" %
-                    (msg[1][:3], "scheduled" if schedule else "immediately"))
+            log.debug("locally handling publish %r %s",
+                    msg[1][:3], "scheduled" if schedule else "immediately")
 
         if peers and not (singular and handler):
-            log.debug("sending publish %r to %d peers" % (
-                msg[1][:3], len(peers)))
+            log.debug("sending publish %r to %d peers", msg[1][:3], len(peers))
 
-        self.multipush(targets, msg)
+        self.multipush(targets, msg, self.raw_frame(targets, msg, (3, 0)))
 
         return bool(handler or peers)
 
     def send_publish_udp(self, client, service, routing_id, method, args,
             kwargs, singular=False):
-        # get the peers registered for this publish
-        peers = list(self.find_peer_routes(
-            const.MSG_TYPE_PUBLISH, service, routing_id))
-
+        # get the peers registered for this publish, and
         # handle locally if we have a handler for it
-        handler, schedule = self.find_local_handler(
+        peers, handler, schedule = self.find_routes(
                 const.MSG_TYPE_PUBLISH, service, routing_id, method)
 
-        targets = peers[:]
+        targets = list(peers)
         if handler:
             targets.append(LocalTarget(self, handler, schedule, client))
 
@@ -350,12 +661,12 @@ class Dispatcher(object):
                 (service, routing_id, method, args, kwargs))
 
         if handler is not None:
-            log.debug("locally handling UDP publish %r %s" %
-                    (msg[1][:3], "scheduled" if schedule else "immediately"))
+            log.debug("locally handling UDP publish %r %s",
+                    msg[1][:3], "scheduled" if schedule else "immediately")
 
         if peers and not (singular and handler):
-            log.debug("sending UDP publish %r to %d peers" % (
-                msg[1][:3], len(peers)))
+            log.debug("sending UDP publish %r to %d peers",
+                    msg[1][:3], len(peers))
 
         self.multipush_udp(targets, msg)
 
@@ -368,66 +679,143 @@ class Dispatcher(object):
         if proxied:
             msgtype += 9
 
-        log.debug("sending publish_is_chunked %r" %
-                ((service, routing_id, method, counter),))
+        window = self.track_credits(credit.Window(), targets,
+                const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter)
+
+        log.debug("sending publish_is_chunked %r",
+                (service, routing_id, method, counter))
         self.multipush(targets, (msgtype,
                 (service, routing_id, method, counter, args, kwargs)))
 
-        chunks = iter(chunks)
+        frames = self.chunk_frames(chunks, targets)
+        pacer = Pacer(targets)
         err = False
-        while not err:
-            try:
-                chunk = chunks.next()
-                rc = 0
-            except StopIteration:
-                break
-            except errors.HandledError, exc:
-                log.error("sending RPC_ERR_KNOWN(%d) as final publish chunk" %
-                        (exc.code,))
-                rc = const.RPC_ERR_KNOWN
-                chunk = (exc.code, exc.args)
-                backend.handle_exception(*sys.exc_info())
-                err = True
-            except Exception:
-                log.error("sending RPC_ERR_UNKNOWN as final publish chunk")
-                rc = const.RPC_ERR_UNKOWN
-                chunk = ''.join(traceback.format_exception(*sys.exc_info()))
-                backend.handle_exception(*sys.exc_info())
-                err = True
+        try:
+            while not err:
+                window.wait()
+                try:
+                    rc, chunk = frames.next()
+                except StopIteration:
+                    break
+                except errors.HandledError, exc:
+                    log.error(
+                            "sending RPC_ERR_KNOWN(%d) as final publish chunk",
+                            exc.code)
+                    rc = const.RPC_ERR_KNOWN
+                    chunk = (exc.code, exc.args)
+                    backend.handle_exception(*sys.exc_info())
+                    err = True
+                except Exception:
+                    log.error("sending RPC_ERR_UNKNOWN as final publish chunk")
+                    rc = const.RPC_ERR_UNKNOWN
+                    chunk = ''.join(
+                            traceback.format_exception(*sys.exc_info()))
+                    backend.handle_exception(*sys.exc_info())
+                    err = True
 
-            try:
-                msg = connection.dump((msgtype + 3, (counter, rc, chunk)))
-            except TypeError:
-                log.error("sending RPC_ERR_UNSER_RESP as final publish chunk")
-                msg = connection.dump((msgtype + 3,
-                        (counter, const.RPC_ERR_UNSER_RESP, repr(chunk))))
-                err = True
+                msg = (msgtype + 3, (counter, rc, chunk))
+                try:
+                    serialized = (self.raw_frame(targets, msg, (2,)) or
+                            connection.dump(msg))
+                except TypeError:
+                    log.error(
+                            "sending RPC_ERR_UNSER_RESP as final publish chunk")
+                    msg = (msgtype + 3,
+                            (counter, const.RPC_ERR_UNSER_RESP, repr(chunk)))
+                    serialized = connection.dump(msg)
+                    err = True
+
+                if not err:
+                    log.debug("sending publish_chunk %r", (counter, rc))
+
+                self.multipush(targets, msg, serialized)
+                window.spend()
+                pacer.pace()
 
             if not err:
-                log.debug("sending publish_chunk %r" % ((counter, rc),))
-
-            self.multipush_str(targets, msg)
-            backend.pause()
-
-        if not err:
-            log.debug("sending publish_end_chunks %d" % counter)
-            self.multipush(targets, (msgtype + 6, counter))
+                log.debug("sending publish_end_chunks %d", counter)
+                self.multipush(targets, (msgtype + 6, counter))
+        finally:
+            self.untrack_credits(window, targets,
+                    const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter)
 
         self.unregister_outgoing_channel(targets,
                 const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter)
 
+    def chunk_frames(self, chunks, targets):
+        # (rc, chunk) pairs to send for a stream. coalescing only applies if
+        # it is turned on and every receiver can unpack batches, and gains
+        # nothing when they are all in this process
+        if (self.chunk_batch_size > 1 and
+                not all(isinstance(t, LocalTarget) for t in targets) and
+                all(const.FEATURE_CHUNK_BATCH in t.features for t in targets)):
+            return coalesce.frames(chunks, self.chunk_batch_size,
+                    self.chunk_batch_bytes, self.chunk_linger)
+        return itertools.izip(itertools.repeat(0), chunks)
+
+    def raw_frame(self, targets, msg, path):
+        # a large byte string at path in the message body can skip the
+        # serializer, if every target takes raw frames. returns None if not,
+        # or if nothing goes over the wire, for the caller to go on as usual
+        if connection.raw_payload(msg, path) is None:
+            return None
+        if all(isinstance(t, LocalTarget) for t in targets):
+            return None
+        if not all(const.FEATURE_RAW_FRAMES in t.features for t in targets):
+            return None
+        return connection.RawFrame(msg, path)
+
+    def forward_chunk(self, targets, msgtype, head, rc, chunk):
+        # pass a chunk frame on from a proxied stream. receivers that can't
+        # take batches get the chunks in them one frame at a time, and hand
+        # back a credit for each. that is more than was spent on the batch,
+        # which loosens the window they hold the sender to but never stalls it
+        if rc != const.CHUNK_BATCH:
+            msg = (msgtype, head + (rc, chunk))
+            self.multipush(targets, msg,
+                    self.raw_frame(targets, msg, (len(head) + 1,)))
+            return
+
+        batched, split = [], []
+        for target in targets:
+            if const.FEATURE_CHUNK_BATCH in target.features:
+                batched.append(target)
+            else:
+                split.append(target)
+
+        if batched:
+            self.multipush(batched, (msgtype, head + (rc, chunk)))
+        if split:
+            if not coalesce.valid(chunk):
+                log.warn("forwarding malformed chunk batch as an error")
+                self.multipush(split, (msgtype,
+                    head + (const.RPC_ERR_MALFORMED, None)))
+                return
+            for item in coalesce.Batch(chunk):
+                self.multipush(split, (msgtype, head + (0, item)))
+
     def cleanup_forwarded_chunk(self, peer_ident, counter):
         entry = self.proxying_channels.get(peer_ident, {}).pop(counter, None)
-        if entry is not None and not self.proxying_channels[peer_ident]:
-            del self.proxying_channels[peer_ident]
+        if entry is not None:
+            self.untrack_credits(entry['window'], entry['targets'],
+                    entry['type'], entry['dest_counter'])
+            if not self.proxying_channels[peer_ident]:
+                del self.proxying_channels[peer_ident]
         return entry
 
-    def send_proxied_rpc(
-            self, service, routing_id, method, args, kwargs, singular):
+    def send_proxied_rpc(self, service, routing_id, method, args, kwargs,
+            singular, hedge=None, deadline=None,
+            on_overload=const.OVERLOAD_BLOCK):
+        self.reclaim()
+
+        if self.rpc_client.max_inflight is not None:
+            deadline = self.admit_proxied(
+                    on_overload, deadline, (service, routing_id, method))
+
         if args and hasattr(args[0], '__iter__') and \
                 not hasattr(args[0], '__len__'):
-            log.debug("sending proxied chunked rpc %r" %
-                    ((service, routing_id, method),))
+            log.debug("sending proxied chunked rpc %r",
+                    (service, routing_id, method))
             counter = self.rpc_client.next_counter()
             routes = [self.peers.values()[0]]
             rpc = self.rpc_client.chunked_request(counter, routes, singular)
@@ -438,13 +826,39 @@ class Dispatcher(object):
                 self.register_outgoing_channel(routes,
                         const.MSG_TYPE_REQUEST_IS_CHUNKED, counter, glet)
                 backend.schedule(glet)
-            return rpc
-
-        log.debug("sending proxied_rpc %r" % ((service, routing_id, method),))
-        return self.rpc_client.request(
-                [self.peers.values()[0]],
-                (service, routing_id, method, bool(singular), args, kwargs),
-                singular)[1]
+            return self.cancellable(counter, rpc)
+
+        log.debug("sending proxied_rpc %r", (service, routing_id, method))
+        msg = (service, routing_id, method, bool(singular), args, kwargs)
+
+        # the hub does the hedging and enforces the deadline, so pass them
+        # along as an extra options element if the hub accepts one
+        options = {}
+        if singular and hedge:
+            options['hedge'] = hedge
+        if deadline is not None:
+            options['deadline'] = deadline
+
+        hub = self.peers.values()[0]
+        if options and const.FEATURE_REQUEST_OPTIONS in hub.features:
+            msg += (options,)
+
+        counter, rpc = self.rpc_client.request([hub], msg, singular)
+        return self.cancellable(counter, rpc)
+
+    def admit_proxied(self, on_overload, deadline, msg):
+        # everything a client sends goes to its hub, so max_inflight limits
+        # how many requests it has outstanding there. returns what is left
+        # of the deadline after any waiting
+        expires = None if deadline is None else time.time() + deadline
+        while self.rpc_client.admit(self.peers.values(), True) is None:
+            self.wait_for_room(on_overload, expires, msg)
+            if not self.peers:
+                raise errors.Unroutable()
+
+        if expires is None:
+            return None
+        return max(0.0, expires - time.time())
 
     def target_selection(self, peers, service, routing_id, method):
         by_addr = {}
@@ -453,21 +867,82 @@ class Dispatcher(object):
                 by_addr[None] = peer
             else:
                 by_addr[peer.ident] = peer
-        choice = hooks._get(self.hooks, 'select_peer')(
-                by_addr.keys(), service, routing_id, method)
+
+        strategy = self.selection_by_service.get(
+                service, self.default_selection)
+        if strategy is not None:
+            choice = strategy(by_addr.keys(), self.rpc_client.peer_stats)
+        elif self.select_peer_takes_stats:
+            choice = self.select_peer_hook(by_addr.keys(), service,
+                    routing_id, method,
+                    peer_stats=self.rpc_client.peer_stats)
+        else:
+            choice = self.select_peer_hook(
+                    by_addr.keys(), service, routing_id, method)
         return by_addr[choice]
 
+    def set_peer_selection(self, strategy, service=None):
+        # strategy is a name from hooks.STRATEGIES, a function with the same
+        # signature, or None to go back to the select_peer hook
+        if isinstance(strategy, basestring):
+            if strategy not in hooks.STRATEGIES:
+                raise ValueError("unknown peer selection strategy %r" %
+                        (strategy,))
+            strategy = hooks.STRATEGIES[strategy]
+
+        if service is None:
+            self.default_selection = strategy
+        elif strategy is None:
+            self.selection_by_service.pop(service, None)
+        else:
+            self.selection_by_service[service] = strategy
+
+    @property
+    def hooks(self):
+        return self._hooks
+
+    @hooks.setter
+    def hooks(self, value):
+        # look the hooks up once here rather than on every message
+        resolved = hooks.resolve(value)
+        self._hooks = value
+        self.select_peer_hook = resolved['select_peer']
+        self.select_peer_takes_stats = hooks.takes_peer_stats(
+                getattr(value, 'select_peer', hooks.select_peer))
+        self.connection_lost_hook = resolved['connection_lost']
+        self.connection_received_hook = resolved['connection_received']
+        self.send_queue_high_hook = resolved['send_queue_high']
+        self.send_queue_low_hook = resolved['send_queue_low']
+
     def send_rpc(self, service, routing_id, method, args, kwargs,
-            singular):
-        handler, schedule = self.find_local_handler(
-                const.MSG_TYPE_RPC_REQUEST, service, routing_id, method)
-        routes = []
-        if handler is not None:
-            routes.append(LocalTarget(self, handler, schedule))
+            singular, hedge=None, deadline=None,
+            on_overload=const.OVERLOAD_BLOCK):
+        self.reclaim()
+
+        # deadline arrives as seconds from now, the RPCClient wants the time
+        if deadline is not None:
+            deadline += time.time()
 
-        peers = list(self.find_peer_routes(
-            const.MSG_TYPE_RPC_REQUEST, service, routing_id))
-        routes.extend(peers)
+        while 1:
+            peers, handler, schedule = self.find_routes(
+                    const.MSG_TYPE_RPC_REQUEST, service, routing_id, method)
+            routes = []
+            if handler is not None:
+                routes.append(LocalTarget(self, handler, schedule))
+            routes.extend(peers)
+
+            # routes may have changed by the time there is room, so look
+            # them up again after waiting
+            admitted = self.rpc_client.admit(routes, singular)
+            if admitted is not None:
+                break
+            self.wait_for_room(
+                    on_overload, deadline, (service, routing_id, method))
+
+        if len(admitted) < len(routes):
+            routes = admitted
+            peers = [r for r in routes if not isinstance(r, LocalTarget)]
+        candidates = routes
 
         if singular and len(routes) > 1:
             routes = [self.target_selection(
@@ -476,14 +951,14 @@ class Dispatcher(object):
                 handler = None
 
         if handler is not None:
-            log.debug("locally handling rpc_request %r %s" %
-                    ((service, routing_id, method),
-                    "scheduled" if schedule else "immediately"))
+            log.debug("locally handling rpc_request %r %s",
+                    (service, routing_id, method),
+                    "scheduled" if schedule else "immediately")
 
         if peers and not (singular and handler):
-            log.debug("sending rpc_request %r to %d peers" %
-                    ((service, routing_id, method),
-                    len(routes) - bool(handler)))
+            log.debug("sending rpc_request %r to %d peers",
+                    (service, routing_id, method),
+                    len(routes) - bool(handler))
 
         if args and hasattr(args[0], '__iter__') and \
                 not hasattr(args[0], '__len__'):
@@ -496,10 +971,105 @@ class Dispatcher(object):
                 self.register_outgoing_channel(peers,
                         const.MSG_TYPE_REQUEST_IS_CHUNKED, counter, glet)
                 backend.schedule(glet)
-            return rpc
+            return self.cancellable(counter, rpc)
+
+        msg = (service, routing_id, method, args, kwargs)
+        counter, rpc = self.rpc_client.request(
+                routes, msg, singular, deadline)
+        if singular and hedge:
+            self.schedule_hedge(hedge, counter, routes[0], candidates, msg)
+        return self.cancellable(counter, rpc)
+
+    def wait_for_room(self, on_overload, deadline, msg):
+        # the request's targets are at max_inflight, so either give up or
+        # wait for a response to free up a slot
+        if on_overload == const.OVERLOAD_FAIL:
+            log.debug("refusing rpc_request %r, targets overloaded", msg)
+            self.rpc_client.rejected += 1
+            raise errors.Overloaded()
+
+        if deadline is not None and time.time() >= deadline:
+            log.debug("deadline passed waiting to send rpc_request %r", msg)
+            raise errors.WaitTimeout()
+
+        log.debug("waiting for room to send rpc_request %r", msg)
+        self.rpc_client.wait_for_room(deadline)
+
+    def cancellable(self, counter, rpc):
+        # hook up RPC.cancel()
+        if rpc is not None:
+            rpc._cancel = lambda: self.cancel_rpc(counter)
+        return rpc
+
+    def cancel_rpc(self, counter):
+        # end any chunked responses still coming in. the channels stay open,
+        # throwing away chunks that were already on their way, until the
+        # end_chunks that the sender follows a cancel with. forwarded ones
+        # are left to pass the rest along to the client the same way
+        key = (const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter)
+        streaming = []
+        for ident, channels in self.received_channels.items():
+            if key in channels:
+                streaming.append(ident)
+                ev, deq, grants = channels[key]
+                deq.append(STOP)
+                ev.set()
+                ev.clear()
+                channels[key] = (ev, collections.deque(maxlen=0), None)
+        for ident, channels in self.proxying_channels.items():
+            entry = channels.get(counter)
+            if entry is not None and entry['type'] == key[0]:
+                streaming.append(ident)
+
+        # stop sending a chunked request
+        for peer_addr, channels in self.outgoing_channels.items():
+            glet = channels.pop(
+                    (const.MSG_TYPE_REQUEST_IS_CHUNKED, counter), None)
+            if glet is not None:
+                backend.end(glet)
+                if not channels:
+                    del self.outgoing_channels[peer_addr]
+
+        # then tell the peers still working on it to stop
+        targets = [peer for peer in
+                self.rpc_client.cancel(counter, self.peers, streaming)
+                if const.FEATURE_CANCEL in peer.features]
+        if targets:
+            log.debug("sending cancel %d to %d peers", counter, len(targets))
+            self.multipush(targets, (const.MSG_TYPE_CANCEL, counter))
+
+    def schedule_hedge(self, hedge, counter, first, candidates, msg):
+        # hedge is either a delay in seconds, or True to derive the delay
+        # from the latency seen so far from the first target
+        candidates = [c for c in candidates if c is not first]
+        if not candidates:
+            return
+
+        if hedge is True:
+            stats = self.rpc_client.peer_stats.get(first.ident)
+            if stats and stats['latency'] is not None:
+                hedge = stats['latency'] + (
+                        HEDGE_DEVIATIONS * stats['deviation'])
+            else:
+                hedge = HEDGE_DELAY
+
+        timers.add(hedge, backend.schedule,
+                args=(self.send_hedge, (counter, candidates, msg)))
 
-        return self.rpc_client.request(routes,
-                (service, routing_id, method, args, kwargs), singular)[1]
+    def send_hedge(self, counter, candidates, msg):
+        # nothing is awaited any more once the first response has arrived
+        awaiting = self.rpc_client.inflight.get(counter)
+        if not awaiting:
+            return
+
+        candidates = [c for c in candidates
+                if c.up and c.ident not in awaiting]
+        if not candidates:
+            return
+
+        target = self.target_selection(candidates, *msg[:3])
+        log.debug("hedging rpc_request %r to %r", msg[:3], target.ident)
+        self.rpc_client.hedge(counter, target, msg)
 
     def send_chunked_rpc(self, service, routing_id, method, args, kwargs,
             targets, counter, singular=False, proxied=False):
@@ -512,44 +1082,58 @@ class Dispatcher(object):
         else:
             is_chunked_msg = (msgtype,
                     (service, routing_id, method, counter, args, kwargs))
-        self.multipush_str(targets, connection.dump(is_chunked_msg))
+        window = self.track_credits(credit.Window(), targets,
+                const.MSG_TYPE_REQUEST_IS_CHUNKED, counter)
+        self.multipush(targets, is_chunked_msg)
 
-        chunks = iter(chunks)
+        frames = self.chunk_frames(chunks, targets)
+        pacer = Pacer(targets)
         err = False
-        while not err:
-            try:
-                chunk = chunks.next()
-                rc = 0
-            except StopIteration:
-                break
-            except errors.HandledError, exc:
-                log.error("sending RPC_ERR_KNOWN(%d) as final request chunk" %
-                        (exc.code,))
-                rc = const.RPC_ERR_KNOWN
-                chunk = (exc.code, exc.args)
-                backend.handle_exception(*sys.exc_info())
-                err = True
-            except Exception:
-                log.error("sending RPC_ERR_UNKNOWN as final request chunk")
-                rc = const.RPC_ERR_UNKNOWN
-                chunk = ''.join(traceback.format_exception(*sys.exc_info()))
-                backend.handle_exception(*sys.exc_info())
-                err = True
+        try:
+            while not err:
+                window.wait()
+                try:
+                    rc, chunk = frames.next()
+                except StopIteration:
+                    break
+                except errors.HandledError, exc:
+                    log.error(
+                            "sending RPC_ERR_KNOWN(%d) as final request chunk",
+                            exc.code)
+                    rc = const.RPC_ERR_KNOWN
+                    chunk = (exc.code, exc.args)
+                    backend.handle_exception(*sys.exc_info())
+                    err = True
+                except Exception:
+                    log.error("sending RPC_ERR_UNKNOWN as final request chunk")
+                    rc = const.RPC_ERR_UNKNOWN
+                    chunk = ''.join(
+                            traceback.format_exception(*sys.exc_info()))
+                    backend.handle_exception(*sys.exc_info())
+                    err = True
 
-            try:
-                msg = connection.dump((msgtype + 3, (counter, rc, chunk)))
-            except TypeError:
-                log.error("sending RPC_ERR_UNSER_RESP as final request chunk")
-                msg = connection.dump((msgtype + 3,
-                        (counter, const.RPC_ERR_UNSER_RESP, repr(chunk))))
-                err = True
+                msg = (msgtype + 3, (counter, rc, chunk))
+                try:
+                    serialized = (self.raw_frame(targets, msg, (2,)) or
+                            connection.dump(msg))
+                except TypeError:
+                    log.error(
+                            "sending RPC_ERR_UNSER_RESP as final request chunk")
+                    msg = (msgtype + 3,
+                            (counter, const.RPC_ERR_UNSER_RESP, repr(chunk)))
+                    serialized = connection.dump(msg)
+                    err = True
+
+                self.multipush(targets, msg, serialized)
+                window.spend()
+                if not err:
+                    pacer.pace()
 
-            self.multipush_str(targets, msg)
             if not err:
-                backend.pause()
-
-        if not err:
-            self.multipush(targets, (msgtype + 6, counter))
+                self.multipush(targets, (msgtype + 6, counter))
+        finally:
+            self.untrack_credits(window, targets,
+                    const.MSG_TYPE_REQUEST_IS_CHUNKED, counter)
 
         self.unregister_outgoing_channel(targets,
                 const.MSG_TYPE_REQUEST_IS_CHUNKED, counter)
@@ -563,56 +1147,73 @@ class Dispatcher(object):
         msg = (counter, ident)
         if not proxied:
             msg = msg[0]
+        window = self.track_credits(credit.Window(), [peer],
+                const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter)
         peer.push((msgtype, msg))
 
-        chunks = iter(chunks)
+        frames = self.chunk_frames(chunks, [peer])
+        pacer = Pacer([peer])
         err = False
         prefix = (ident,) if proxied else ()
-        while not err:
-            try:
-                chunk = chunks.next()
-                rc = 0
-            except StopIteration:
-                break
-            except errors.HandledError, exc:
-                log.error("sending RPC_ERR_KNOWN(%d) as final response chunk" %
-                        (exc.code,))
-                rc = const.RPC_ERR_KNOWN
-                chunk = (exc.code, exc.args)
-                backend.handle_exception(*sys.exc_info())
-                err = True
-            except Exception:
-                log.error("sending RPC_ERR_UNKNOWN as final response chunk")
-                rc = const.RPC_ERR_UNKNOWN
-                chunk = ''.join(traceback.format_exception(*sys.exc_info()))
-                backend.handle_exception(*sys.exc_info())
-                err = True
+        try:
+            while not err:
+                window.wait()
+                try:
+                    rc, chunk = frames.next()
+                except StopIteration:
+                    break
+                except errors.HandledError, exc:
+                    log.error(
+                            "sending RPC_ERR_KNOWN(%d) as final response chunk",
+                            exc.code)
+                    rc = const.RPC_ERR_KNOWN
+                    chunk = (exc.code, exc.args)
+                    backend.handle_exception(*sys.exc_info())
+                    err = True
+                except Exception:
+                    log.error(
+                            "sending RPC_ERR_UNKNOWN as final response chunk")
+                    rc = const.RPC_ERR_UNKNOWN
+                    chunk = ''.join(
+                            traceback.format_exception(*sys.exc_info()))
+                    backend.handle_exception(*sys.exc_info())
+                    err = True
+
+                msg = (msgtype + 3, prefix + (counter, rc, chunk))
+                try:
+                    msg = (self.raw_frame([peer], msg, (len(prefix) + 2,))
+                            or peer.dump(msg))
+                except TypeError:
+                    log.error(
+                            "sending RPC_ERR_UNSER_RESP as final response chunk")
+                    msg = peer.dump((msgtype + 3, prefix +
+                        (counter, const.RPC_ERR_UNSER_RESP, repr(chunk))))
+                    err = True
 
-            try:
-                msg = peer.dump((msgtype + 3, prefix + (counter, rc, chunk)))
-            except TypeError:
-                log.error("sending RPC_ERR_UNSER_RESP as final response chunk")
-                msg = peer.dump((msgtype + 3,
-                    prefix + (counter, const.RPC_ERR_UNSER_RESP, repr(chunk))))
-                err = True
+                if trace.events is not None:
+                    trace.record("send", msgtype + 3, counter, peer.ident)
+                peer.push_string(msg, msgtype + 3,
+                        connection.exchange(msgtype + 3, counter))
+                window.spend()
+                if not err:
+                    pacer.pace()
 
-            peer.push_string(msg)
             if not err:
-                backend.pause()
-
-        if not err:
-            msg = (counter, ident)
-            if not proxied:
-                msg = msg[0]
-            peer.push((msgtype + 6, msg))
+                msg = (counter, ident)
+                if not proxied:
+                    msg = msg[0]
+                peer.push((msgtype + 6, msg))
+        finally:
+            self.untrack_credits(window, [peer],
+                    const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter)
 
         self.unregister_outgoing_channel([peer],
                 const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter)
 
     def send_proxied_publish(self, service, routing_id, method, args, kwargs,
             singular=False):
-        log.debug("sending proxied_publish %r" %
-                ((service, routing_id, method),))
+        log.debug("sending proxied_publish %r",
+                (service, routing_id, method))
         peer = self.peers.values()[0]
         if args and hasattr(args[0], "__iter__") \
                 and not hasattr(args[0], "__len__"):
@@ -624,39 +1225,65 @@ class Dispatcher(object):
                     const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter, glet)
             backend.schedule(glet)
         else:
-            peer.push((const.MSG_TYPE_PROXY_PUBLISH,
-                    (service, routing_id, method, args, kwargs, singular)))
+            msg = (const.MSG_TYPE_PROXY_PUBLISH,
+                    (service, routing_id, method, args, kwargs, singular))
+            self.multipush([peer], msg, self.raw_frame([peer], msg, (3, 0)))
 
     def publish_handler(self, handler, msg, source, args, kwargs):
-        log.debug("executing publish handler for %r from %r" % (msg, source))
+        log.debug("executing publish handler for %r from %r", msg, source)
         try:
             handler(*args, **kwargs)
         except Exception:
-            log.error("exception handling publish %r from %r" % (msg, source))
+            log.error("exception handling publish %r from %r", msg, source)
             backend.handle_exception(*sys.exc_info())
 
+    def schedule_rpc_handler(self, peer, counter, handler, args, kwargs,
+            proxied=False, deadline=None):
+        # registered as an outgoing channel so a MSG_TYPE_CANCEL can end it
+        glet = backend.greenlet(self.scheduled_rpc_handler,
+                args=(peer, counter, handler, args, kwargs, proxied, deadline))
+        self.register_outgoing_channel(
+                [peer], const.MSG_TYPE_RPC_REQUEST, counter, glet)
+        backend.schedule(glet)
+
+    def scheduled_rpc_handler(self, peer, counter, handler, args, kwargs,
+            proxied, deadline):
+        try:
+            self.rpc_handler(peer, counter, handler, args, kwargs, proxied,
+                    True, deadline)
+        finally:
+            self.unregister_outgoing_channel(
+                    [peer], const.MSG_TYPE_RPC_REQUEST, counter)
+
     def rpc_handler(self, peer, counter, handler, args, kwargs,
-            proxied=False, scheduled=False):
+            proxied=False, scheduled=False, deadline=None):
         req_type = "proxy_request" if proxied else "rpc_request"
-        log.debug("executing %s handler for %d from %r" %
-                (req_type, counter, peer.ident))
-
         response = (proxied and const.MSG_TYPE_PROXY_RESPONSE
                 or const.MSG_TYPE_RPC_RESPONSE)
 
+        # the caller has stopped waiting by now, so don't spend the time
+        if deadline is not None and time.time() >= deadline:
+            log.info("skipping %s handler for %d from %r, deadline passed",
+                    req_type, counter, peer.ident)
+            peer.push((response, (counter, const.RPC_ERR_DEADLINE, None)))
+            return
+
+        log.debug("executing %s handler for %d from %r",
+                req_type, counter, peer.ident)
+
         try:
             rc = 0
             result = handler(*args, **kwargs)
         except errors.HandledError, exc:
-            log.error("responding with RPC_ERR_KNOWN (%d) to %s %d" %
-                    (exc.code, req_type, counter))
+            log.error("responding with RPC_ERR_KNOWN (%d) to %s %d",
+                    exc.code, req_type, counter)
             rc = const.RPC_ERR_KNOWN
             result = (exc.code, exc.args)
             backend.handle_exception(*sys.exc_info())
         except TypeError:
             if len(traceback.extract_tb(sys.exc_info()[2])) == 1:
-                log.error("responding with RPC_ERR_BADARGS to %s %d" %
-                        (req_type, counter))
+                log.error("responding with RPC_ERR_BADARGS to %s %d",
+                        req_type, counter)
                 rc = const.RPC_ERR_BADARGS
                 spec = inspect.getargspec(handler)
                 result = (len(spec.args) - len(spec.defaults or ()),
@@ -664,14 +1291,14 @@ class Dispatcher(object):
                         bool(spec.varargs), bool(spec.keywords))
                 backend.handle_exception(*sys.exc_info())
             else:
-                log.error("responding with RPC_ERR_UNKNOWN to %s %d" %
-                        (req_type, counter))
+                log.error("responding with RPC_ERR_UNKNOWN to %s %d",
+                        req_type, counter)
                 rc = const.RPC_ERR_UNKNOWN
                 result = ''.join(traceback.format_exception(*sys.exc_info()))
                 backend.handle_exception(*sys.exc_info())
         except Exception:
-            log.error("responding with RPC_ERR_UNKNOWN to %s %d" %
-                    (req_type, counter))
+            log.error("responding with RPC_ERR_UNKNOWN to %s %d",
+                    req_type, counter)
             rc = const.RPC_ERR_UNKNOWN
             result = ''.join(traceback.format_exception(*sys.exc_info()))
             backend.handle_exception(*sys.exc_info())
@@ -693,65 +1320,112 @@ class Dispatcher(object):
         try:
             msg = peer.dump((response, (counter, rc, result)))
         except TypeError:
-            log.error("responding with RPC_ERR_UNSER_RESP to %s %d" %
-                    (req_type, counter))
+            log.error("responding with RPC_ERR_UNSER_RESP to %s %d",
+                    req_type, counter)
             msg = peer.dump((response,
                 (counter, const.RPC_ERR_UNSER_RESP, repr(result))))
             backend.handle_exception(*sys.exc_info())
         else:
-            log.debug("responding with MSG_TYPE_RESPONSE to %s %d" %
-                    (req_type, counter))
+            log.debug("responding with MSG_TYPE_RESPONSE to %s %d",
+                    req_type, counter)
 
-        peer.push_string(msg)
+        if trace.events is not None:
+            trace.record("send", response, counter, peer.ident)
+        peer.push_string(msg, response,
+                connection.exchange(response, counter))
 
-    def _generate_received_chunks(self, event, deque):
+    def _generate_received_chunks(self, event, deque, grants=None):
         while 1:
             while deque:
                 item = deque.popleft()
                 if item is STOP:
                     return
-                yield item
+                if grants is not None:
+                    grants.consumed()
+                if isinstance(item, coalesce.Batch):
+                    for chunk in item:
+                        yield chunk
+                else:
+                    yield item
             event.wait()
 
-    def handle_start_request_chunks(self, peer, counter, handler, args,
-            kwargs, proxied=False, client_counter=None):
+    def receive_chunks(self, peer_ident, msgtype, counter, grant=None):
+        # received_channels holds (event, deque, grants) for each stream,
+        # where grants is a credit.Grants if the sender takes credits
         ev = backend.Event()
         deq = collections.deque()
-        bypeer = self.received_channels.setdefault(peer.ident or id(peer), {})
-        bypeer[(const.MSG_TYPE_REQUEST_IS_CHUNKED, counter)] = (ev, deq)
-        gen = self._generate_received_chunks(ev, deq)
+        grants = None if grant is None else credit.Grants(grant)
+        bypeer = self.received_channels.setdefault(peer_ident, {})
+        bypeer[(msgtype, counter)] = (ev, deq, grants)
+        gen = self._generate_received_chunks(ev, deq, grants)
+        if grants is not None:
+            grants.watch(gen, lambda: self.abandon_incoming_chunks(
+                peer_ident, msgtype, counter, deq))
+        return gen
+
+    def handle_start_request_chunks(self, peer, counter, handler, args,
+            kwargs, proxied=False, client_counter=None, grant=None):
+        gen = self.receive_chunks(peer.ident or id(peer),
+                const.MSG_TYPE_REQUEST_IS_CHUNKED, counter, grant)
         client_counter = client_counter or counter
-        backend.schedule(self.rpc_handler,
-                args=(peer, client_counter, handler, (gen,) + args, kwargs,
-                        proxied, True))
+        self.schedule_rpc_handler(peer, client_counter, handler,
+                (gen,) + args, kwargs, proxied)
 
-    def handle_start_response_chunks(self, peer_ident, counter):
-        ev = backend.Event()
-        deq = collections.deque()
-        bypeer = self.received_channels.setdefault(peer_ident, {})
-        bypeer[(const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter)] = (ev, deq)
-        return self._generate_received_chunks(ev, deq)
+    def handle_start_response_chunks(self, peer_ident, counter, grant=None):
+        return self.receive_chunks(peer_ident,
+                const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter, grant)
 
     def handle_start_publish_chunks(
-            self, peer_ident, counter, handler, args, kwargs):
-        ev = backend.Event()
-        deq = collections.deque()
-        bypeer = self.received_channels.setdefault(peer_ident, {})
-        bypeer[(const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter)] = (ev, deq)
-        gen = self._generate_received_chunks(ev, deq)
+            self, peer_ident, counter, handler, args, kwargs, grant=None):
+        gen = self.receive_chunks(peer_ident,
+                const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter, grant)
         backend.schedule(handler, args=(gen,) + args, kwargs=kwargs)
 
     def handle_chunk_arrival(self, peer_ident, msgtype, counter, rc, chunk):
-        ev, deq = self.received_channels[peer_ident][(msgtype, counter)]
-        deq.append(chunk)
-        ev.set()
-        ev.clear()
-        if rc:
+        ev, deq, grants = self.received_channels[peer_ident][
+                (msgtype, counter)]
+        if grants is not None and grants.abandoned:
+            # nothing is listening, but the sender still needs the credit
+            grants.consumed()
+        else:
+            deq.append(chunk)
+            ev.set()
+            ev.clear()
+        if _ends_stream(rc) or (
+                rc == const.CHUNK_BATCH and
+                not isinstance(chunk, coalesce.Batch)):
+            # an error, or a malformed batch which _check_error made one
             self.cleanup_incoming_chunks(peer_ident, msgtype, counter)
 
+    def refuse_chunks(self, peer_ident, msgtype, counter, grant):
+        # a stream with nowhere to go. if the sender takes credits, keep
+        # handing them back until it ends so it isn't left waiting
+        if grant is None:
+            return
+        grants = credit.Grants(grant)
+        grants.abandoned = True
+        bypeer = self.received_channels.setdefault(peer_ident, {})
+        bypeer[(msgtype, counter)] = (
+                backend.Event(), collections.deque(maxlen=0), grants)
+
+    def abandon_incoming_chunks(self, peer_ident, msgtype, counter, deq):
+        # the generator was dropped before the end of the stream. throw
+        # away what it left behind, and what is still to come, returning
+        # the credits for all of it so the sender isn't held up
+        channel = self.received_channels.get(peer_ident, {}).get(
+                (msgtype, counter))
+        if channel is None or channel[1] is not deq:
+            return
+        log.debug("chunks for %r from %r abandoned", (msgtype, counter),
+                peer_ident)
+        grants = channel[2]
+        grants.abandoned = True
+        grants.consumed(len(deq))
+        deq.clear()
+
     def cleanup_incoming_chunks(self, peer_ident, msgtype, counter):
-        ev, deq = self.received_channels.get(peer_ident, {}).pop(
-                (msgtype, counter), (None, None))
+        ev, deq, grants = self.received_channels.get(peer_ident, {}).pop(
+                (msgtype, counter), (None, None, None))
         if ev is not None:
             deq.append(STOP)
             ev.set()
@@ -760,33 +1434,42 @@ class Dispatcher(object):
                 del self.received_channels[peer_ident]
 
     def forward_proxy_response_is_chunked(self, source, source_counter):
-        entry = self.inflight_proxies[source_counter]
-        entry['awaiting'] -= 1
-        if not entry['awaiting']:
-            del self.inflight_proxies[source_counter]
+        entry = self.proxied_arrival(source_counter)
+
+        # the client's credits come back keyed by its own counter and the
+        # source, so they are found by looking through proxying_channels
+        # rather than registering the relay in send_windows
+        relay = credit.Relay(self.credit_sender(source,
+            const.MSG_TYPE_RESPONSE_IS_CHUNKED, source_counter))
+        if const.FEATURE_CREDIT in entry['peer'].features:
+            relay.add(entry['peer'])
 
         bypeer = self.proxying_channels.setdefault(source.ident, {})
         bypeer[source_counter] = {
             'dest_counter': entry['client_counter'],
             'targets': [entry['peer']],
             'type': const.MSG_TYPE_RESPONSE_IS_CHUNKED,
+            'window': relay,
         }
         self.rpc_client.response(source, source_counter, 0, None)
 
         log.debug("forwarding proxied response_is_chunked to " +
-                "%r, %d remaining" % (entry['peer'].ident, entry['awaiting']))
+                "%r, %d remaining", entry['peer'].ident, entry['awaiting'])
 
         entry['peer'].push((const.MSG_TYPE_PROXY_RESPONSE_IS_CHUNKED,
             (entry['client_counter'], source.ident)))
 
     def forward_proxy_response_chunk(self, source, source_counter, rc, chunk):
         entry = self.proxying_channels[source][source_counter]
-        entry['targets'][0].push((const.MSG_TYPE_PROXY_RESPONSE_CHUNK,
-                (source, entry['dest_counter'], rc, chunk)))
+        self.forward_chunk(entry['targets'],
+                const.MSG_TYPE_PROXY_RESPONSE_CHUNK,
+                (source, entry['dest_counter']), rc, chunk)
 
-        if rc:
+        if _ends_stream(rc):
             self.cleanup_forwarded_proxy_response_chunk(
                     source, source_counter, False)
+        else:
+            entry['window'].spend()
 
     def cleanup_forwarded_proxy_response_chunk(self, source, source_counter,
             send_end_chunks=False):
@@ -801,22 +1484,25 @@ class Dispatcher(object):
     # callback for peer objects to pass up a message
     def incoming(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 2:
-            log.warn("malformed message from %r" % (peer.ident,))
+            log.warn("malformed message from %r", peer.ident)
             return
 
         msg_type, msg = msg
         if msg_type not in self.handlers:
             # drop unrecognized messages
-            log.warn("received unrecognized message type %r from %r" %
-                    (msg_type, peer.ident))
+            log.warn("received unrecognized message type %r from %r",
+                    msg_type, peer.ident)
             return
 
+        if trace.events is not None:
+            trace.record("recv", msg_type, msg, peer.ident)
+
         self.handlers[msg_type](self, peer, msg)
 
     def incoming_publish(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 5:
             # drop malformed messages
-            log.warn("received malformed publish from %r" % (peer.ident,))
+            log.warn("received malformed publish from %r", peer.ident)
             return
 
         service, routing_id, method, args, kwargs = msg
@@ -825,13 +1511,13 @@ class Dispatcher(object):
                 const.MSG_TYPE_PUBLISH, service, routing_id, method)
         if handler is None:
             # drop mis-delivered messages
-            log.warn("received mis-delivered publish %r from %r" %
-                    (msg[:3], peer.ident))
+            log.warn("received mis-delivered publish %r from %r",
+                    msg[:3], peer.ident)
             return
 
-        log.debug("handling publish %r from %r %s" %
-                (msg[:3], peer.ident,
-                "scheduled" if schedule else "immediately"))
+        log.debug("handling publish %r from %r %s",
+                msg[:3], peer.ident,
+                "scheduled" if schedule else "immediately")
 
         if schedule:
             backend.schedule(self.publish_handler,
@@ -840,73 +1526,90 @@ class Dispatcher(object):
             self.publish_handler(handler, msg[:3], peer.ident, args, kwargs)
 
     def incoming_rpc_request(self, peer, msg):
-        if not isinstance(msg, tuple) or len(msg) != 6:
+        # peers may add a 7th element with a dict of request options
+        if not isinstance(msg, tuple) or len(msg) not in (6, 7) or (
+                len(msg) == 7 and not isinstance(msg[6], dict)):
             # drop malformed messages
-            log.warn("received malformed rpc_request from %r" % (peer.ident,))
+            log.warn("received malformed rpc_request from %r", peer.ident)
             return
 
-        counter, service, routing_id, method, args, kwargs = msg
+        counter, service, routing_id, method, args, kwargs = msg[:6]
+        deadline = _deadline(msg[6]) if len(msg) == 7 else None
 
         handler, schedule = self.find_local_handler(
                 const.MSG_TYPE_RPC_REQUEST, service, routing_id, method)
         if handler is None:
-            if any(routing_id & mask == value
-                    for mask, value, handlers in self.local_subs.get(
-                            (const.MSG_TYPE_RPC_REQUEST, service), [])):
-                log.warn("received rpc_request %r for unknown method from %r" %
-                        (msg[:4], peer.ident))
+            if self.locally_handles(
+                    const.MSG_TYPE_RPC_REQUEST, service, routing_id):
+                log.warn("received rpc_request %r for unknown method from %r",
+                        msg[:4], peer.ident)
                 rc = const.RPC_ERR_NOMETHOD
             else:
-                log.warn("received mis-delivered rpc_request %r from %r" %
-                        (msg[:4], peer.ident))
+                log.warn("received mis-delivered rpc_request %r from %r",
+                        msg[:4], peer.ident)
                 rc = const.RPC_ERR_NOHANDLER
 
             # mis-delivered message
             peer.push((const.MSG_TYPE_RPC_RESPONSE, (counter, rc, None)))
             return
 
-        log.debug("handling rpc_request %r from %r %s" % (
-                msg[:4], peer.ident,
-                "scheduled" if schedule else "immediately"))
+        log.debug("handling rpc_request %r from %r %s", msg[:4], peer.ident,
+                "scheduled" if schedule else "immediately")
 
         if schedule:
-            backend.schedule(self.rpc_handler,
-                    args=(peer, counter, handler, args, kwargs),
-                    kwargs={'scheduled': True})
+            self.schedule_rpc_handler(peer, counter, handler, args, kwargs,
+                    deadline=deadline)
         else:
-            self.rpc_handler(peer, counter, handler, args, kwargs)
+            self.rpc_handler(peer, counter, handler, args, kwargs,
+                    deadline=deadline)
 
     def incoming_rpc_response(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 3:
             # drop malformed responses
-            log.warn("received malformed rpc_response from %r" % (peer.ident,))
+            log.warn("received malformed rpc_response from %r", peer.ident)
             return
 
         counter, rc, result = msg
 
-        if counter in self.inflight_proxies:
-            log.debug("received a proxied response %r from %r" %
-                    (msg[:2], peer.ident))
-            self.proxied_response(counter, rc, result)
-        elif (counter not in self.rpc_client.inflight or
+        proxied = counter in self.inflight_proxies
+        if not proxied and (counter not in self.rpc_client.inflight or
                 peer.ident not in self.rpc_client.inflight[counter]):
-            # drop mistaken responses
-            log.warn("received mis-delivered rpc_response %r from %r" %
-                    (msg[:2], peer.ident))
+            if counter < self.rpc_client.counter:
+                # one of ours, since cancelled or reclaimed
+                log.debug("dropping late rpc_response %r from %r",
+                        msg[:2], peer.ident)
+            else:
+                # drop mistaken responses
+                log.warn("received mis-delivered rpc_response %r from %r",
+                        msg[:2], peer.ident)
             return
 
-        log.debug("received rpc_response %r from %r" % (msg[:2], peer.ident))
+        log.debug("received rpc_response %r from %r", msg[:2], peer.ident)
 
+        # while the inflight_proxies entry still holds the rpc, so that it
+        # isn't taken for abandoned when the entry goes
         self.rpc_client.response(peer, counter, rc, result)
 
-    def proxied_response(self, counter, rc, result):
+        if proxied:
+            log.debug("received a proxied response %r from %r",
+                    msg[:2], peer.ident)
+            self.proxied_response(counter, rc, result)
+
+    def proxied_arrival(self, counter):
         entry = self.inflight_proxies[counter]
         entry['awaiting'] -= 1
         if not entry['awaiting']:
             del self.inflight_proxies[counter]
+            peer = entry['peer']
+            self.proxied_requests.pop(
+                    (peer.ident or id(peer), entry['client_counter']), None)
+        return entry
 
-        log.debug("forwarding proxied response to %r, %d remaining" %
-                (entry['peer'].ident, entry['awaiting']))
+    def proxied_response(self, counter, rc, result):
+        entry = self.proxied_arrival(counter)
+
+        log.debug("forwarding proxied response to %r, %d remaining",
+                entry['peer'].ident, entry['awaiting'])
 
         entry['peer'].push((const.MSG_TYPE_PROXY_RESPONSE,
                 (entry['client_counter'], rc, result)))
@@ -914,38 +1617,57 @@ class Dispatcher(object):
     def incoming_proxy_publish(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 6:
             # drop malformed messages
-            log.warn("received malformed proxy_publish from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_publish from %r",
+                    peer.ident)
             return
 
-        log.debug("forwarding a proxy_publish %r from %r" %
-                (msg[:3], peer.ident))
+        log.debug("forwarding a proxy_publish %r from %r",
+                msg[:3], peer.ident)
 
         self.send_publish(peer, *(msg[:5] + (True, msg[5])))
 
     def incoming_proxy_request(self, peer, msg):
-        if not isinstance(msg, tuple) or len(msg) != 7:
+        # clients may add an 8th element with a dict of request options
+        if not isinstance(msg, tuple) or len(msg) not in (7, 8) or (
+                len(msg) == 8 and not isinstance(msg[7], dict)):
             # drop badly formed messages
-            log.warn("received malformed proxy_request from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_request from %r",
+                    peer.ident)
             return
-        cli_counter, service, routing_id, method, singular, args, kwargs = msg
+        (cli_counter, service, routing_id, method, singular, args,
+                kwargs) = msg[:7]
+        options = msg[7] if len(msg) == 8 else {}
+        deadline = _deadline(options)
 
-        # find local handlers
-        handler, schedule = self.find_local_handler(
-                const.MSG_TYPE_RPC_REQUEST, service, routing_id, method)
+        self.reclaim()
 
-        # find remote targets and count up total handlers
-        targets = list(self.find_peer_routes(
-                const.MSG_TYPE_RPC_REQUEST, service, routing_id))
-        target_count = len(targets) + bool(handler)
+        # find local handlers and remote targets, and count up total handlers
+        targets, handler, schedule = self.find_routes(
+                const.MSG_TYPE_RPC_REQUEST, service, routing_id, method)
+        targets = list(targets)
+
+        # the hub can't hold up its connection to the client waiting for
+        # room, so targets at max_inflight are answered with an overload
+        # error instead, unless a singular request has somewhere else to go
+        overloaded = 0
+        if self.rpc_client.max_inflight is not None:
+            room = [t for t in targets if self.rpc_client.has_room(t)]
+            overloaded = len(targets) - len(room)
+            targets = room
+            if singular and overloaded:
+                overloaded = int(not targets and handler is None)
+            self.rpc_client.rejected += overloaded
+
+        target_count = len(targets) + bool(handler) + overloaded
 
         # pick the single target for 'singular' proxy RPCs
+        candidates = targets
         if target_count > 1 and singular:
             target_count = 1
+            if handler is not None:
+                candidates = targets + [LocalTarget(self, handler, schedule)]
             target = self.target_selection(
-                    targets + [LocalTarget(self, handler, schedule, client)],
-                    service, routing_id, method)
+                    candidates, service, routing_id, method)
             if isinstance(target, LocalTarget):
                 targets = []
             else:
@@ -954,38 +1676,53 @@ class Dispatcher(object):
 
         # handle it locally if it's aimed at us
         if handler is not None:
-            log.debug("locally handling proxy_request %r %s" % (
-                    msg[:4], "scheduled" if schedule else "immediately"))
+            log.debug("locally handling proxy_request %r %s",
+                    msg[:4], "scheduled" if schedule else "immediately")
             if schedule:
-                backend.schedule(self.rpc_handler,
-                        args=(peer, cli_counter, handler, args, kwargs),
-                        kwargs={'proxied': True, 'scheduled': True})
+                self.schedule_rpc_handler(peer, cli_counter, handler, args,
+                        kwargs, True, deadline)
             else:
-                self.rpc_handler(
-                        peer, cli_counter, handler, args, kwargs, True)
+                self.rpc_handler(peer, cli_counter, handler, args, kwargs,
+                        True, deadline=deadline)
 
         if targets:
-            log.debug("forwarding proxy_request %r to %d peers" %
-                    (msg[:4], target_count - bool(handler)))
+            log.debug("forwarding proxy_request %r to %d peers",
+                    msg[:4], target_count - bool(handler))
 
+            # passing the deadline on forwards whatever budget is left of it
+            forward = (service, routing_id, method, args, kwargs)
             counter, rpc = self.rpc_client.request(
-                    targets, (service, routing_id, method, args, kwargs))
+                    targets, forward, deadline=deadline)
 
+            # the entry holds the rpc so it isn't reclaimed as abandoned
             self.inflight_proxies[counter] = {
                 'awaiting': len(targets),
                 'client_counter': cli_counter,
                 'peer': peer,
+                'rpc': rpc,
             }
+            self.proxied_requests[(peer.ident or id(peer), cli_counter)] = \
+                    counter
+
+            # a local handler answers the client directly, so only hedge to
+            # other peers. the first response forwarded uses up 'awaiting',
+            # so a late one is never passed on to the client
+            if singular and options.get('hedge'):
+                self.schedule_hedge(options['hedge'], counter, targets[0],
+                        [t for t in candidates
+                            if not isinstance(t, LocalTarget)],
+                        forward)
 
         send_nomethod = False
-        if handler is None and not targets and self.locally_handles(
-                const.MSG_TYPE_RPC_REQUEST, service, routing_id):
+        if (handler is None and not targets and not overloaded
+                and self.locally_handles(
+                    const.MSG_TYPE_RPC_REQUEST, service, routing_id)):
             # if there are no remote handlers and we only fail locally because
             # of the method, send a NOMETHOD error and include ourselves in the
             # target_count so the client can distinguish between "no method"
             # and "unroutable"
-            log.warn("received proxy_request %r for unknown method" %
-                    (msg[:4],))
+            log.warn("received proxy_request %r for unknown method",
+                    msg[:4])
             target_count += 1
             send_nomethod = True
 
@@ -998,87 +1735,193 @@ class Dispatcher(object):
             peer.push((const.MSG_TYPE_PROXY_RESPONSE,
                 (cli_counter, const.RPC_ERR_NOMETHOD, None)))
 
+        if overloaded:
+            log.debug("refusing proxy_request %r to %d overloaded peers",
+                    msg[:4], overloaded)
+            for i in xrange(overloaded):
+                peer.push((const.MSG_TYPE_PROXY_RESPONSE,
+                    (cli_counter, const.RPC_ERR_OVERLOADED, None)))
+
+    def incoming_cancel(self, peer, msg):
+        if not isinstance(msg, (int, long)):
+            # drop malformed messages
+            log.warn("received malformed cancel from %r", peer.ident)
+            return
+
+        log.debug("received cancel %r from %r", msg, peer.ident)
+
+        # end the handler, or the sender of its chunked response
+        peer_addr = peer.ident or id(peer)
+        channels = self.outgoing_channels.get(peer_addr, {})
+        handler = channels.pop((const.MSG_TYPE_RPC_REQUEST, msg), None)
+        sender = channels.pop(
+                (const.MSG_TYPE_RESPONSE_IS_CHUNKED, msg), None)
+        if not channels:
+            self.outgoing_channels.pop(peer_addr, None)
+
+        if handler is not None:
+            backend.end(handler)
+        if sender is not None:
+            if sender is not handler:
+                backend.end(sender)
+
+            # close the stream so the peer can stop listening for it.
+            # requests from clients are the proxied ones
+            if peer.ident is None:
+                peer.push((const.MSG_TYPE_PROXY_RESPONSE_END_CHUNKS,
+                        (msg, self.hub._ident)))
+            else:
+                peer.push((const.MSG_TYPE_RESPONSE_END_CHUNKS, msg))
+
+        # pass it along for a proxy_request forwarded to other peers, both
+        # those yet to respond and those streaming a chunked response
+        counter = self.proxied_requests.pop((peer_addr, msg), None)
+        if counter is not None:
+            del self.inflight_proxies[counter]
+            self.cancel_rpc(counter)
+
+        for source, bypeer in self.proxying_channels.items():
+            for counter, entry in bypeer.items():
+                if (entry['type'] == const.MSG_TYPE_RESPONSE_IS_CHUNKED and
+                        entry['dest_counter'] == msg and
+                        entry['targets'][0] is peer):
+                    self.cancel_rpc(counter)
+
+    def incoming_features(self, peer, msg):
+        if not isinstance(msg, list) or not all(
+                isinstance(feature, str) for feature in msg):
+            # drop malformed messages
+            log.warn("received malformed features from %r", peer.ident)
+            return
+
+        log.debug("received features %r from %r", msg, peer.ident)
+
+        peer.features = frozenset(msg)
+
+    def incoming_credit(self, peer, msg):
+        # a 4th element names the source of a proxied chunked response
+        if not isinstance(msg, tuple) or len(msg) not in (3, 4) or \
+                not isinstance(msg[2], (int, long)) or msg[2] <= 0:
+            # drop malformed messages
+            log.warn("received malformed credit from %r", peer.ident)
+            return
+
+        msgtype, counter, count = msg[:3]
+
+        if len(msg) == 4 and (self.hub is None or msg[3] != self.hub._ident):
+            window = self.forwarded_response_window(peer, msg[3], counter)
+        else:
+            window = self.send_windows.get(
+                    peer.ident or id(peer), {}).get((msgtype, counter))
+
+        if window is None:
+            # the stream has ended since
+            log.debug("dropping late credit %r from %r", msg, peer.ident)
+            return
+
+        log.debug("received credit %r from %r", msg, peer.ident)
+
+        window.grant(peer, count)
+
+    def forwarded_response_window(self, peer, source, counter):
+        for entry in self.proxying_channels.get(source, {}).itervalues():
+            if (entry['type'] == const.MSG_TYPE_RESPONSE_IS_CHUNKED and
+                    entry['dest_counter'] == counter and
+                    entry['targets'][0] is peer):
+                return entry['window']
+        return None
+
     def incoming_proxy_query_count(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 5:
             # drop malformed queries
-            log.warn("received malformed proxy_query_count from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_query_count from %r",
+                    peer.ident)
             return
         counter, msg_type, service, routing_id, method = msg
 
-        log.debug("received proxy_query_count %r from %r" %
-                (msg, peer.ident))
+        log.debug("received proxy_query_count %r from %r",
+                msg, peer.ident)
 
         local, scheduled = self.find_local_handler(
                 msg_type, service, routing_id, method)
         target_count = (local is not None) + len(list(
             self.find_peer_routes(msg_type, service, routing_id)))
 
-        log.debug("sending proxy_response %r for query_count %r to %r" %
-                ((counter, 0, target_count), msg, peer.ident))
+        log.debug("sending proxy_response %r for query_count %r to %r",
+                (counter, 0, target_count), msg, peer.ident)
 
         peer.push((const.MSG_TYPE_PROXY_RESPONSE, (counter, 0, target_count)))
 
     def incoming_proxy_response(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 3:
             # drop malformed responses
-            log.warn("received malformed proxy_response from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_response from %r",
+                    peer.ident)
             return
 
         counter, rc, result = msg
 
         if counter not in self.rpc_client.inflight:
             # drop mistaken responses
-            log.warn("received mis-delivered proxy_response %r from %r" %
-                    (msg[:2], peer.ident))
+            log.warn("received mis-delivered proxy_response %r from %r",
+                    msg[:2], peer.ident)
             return
 
-        log.debug("received proxy_response %r from %r" %
-                (msg[:2], peer.ident))
+        log.debug("received proxy_response %r from %r",
+                msg[:2], peer.ident)
 
         self.rpc_client.response(peer, counter, rc, result)
 
     def incoming_proxy_response_count(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 2:
             # drop malformed responses
-            log.warn("received malformed proxy_response_count from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_response_count from %r",
+                    peer.ident)
             return
         counter, target_count = msg
 
-        log.debug("received proxy_response_count %r from %r" %
-                (msg, peer.ident))
+        if counter not in self.rpc_client.inflight:
+            # the RPC was cancelled or reclaimed before the count arrived
+            log.warn("received mis-delivered proxy_response_count %r from %r",
+                    msg, peer.ident)
+            return
+
+        log.debug("received proxy_response_count %r from %r",
+                msg, peer.ident)
 
         self.rpc_client.expect(peer, counter, target_count)
 
     def incoming_proxy_publish_is_chunked(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 6:
-            log.warn("received malformed proxy_publish_is_chunked from %r" %
-                    (peer.addr,))
+            log.warn("received malformed proxy_publish_is_chunked from %r",
+                    peer.addr)
             return
 
         service, routing_id, method, source_counter, args, kwargs = msg
 
-        log.debug("received proxy_publish_is_chunked %r from %r" %
-                (msg[:4], peer.addr))
+        log.debug("received proxy_publish_is_chunked %r from %r",
+                msg[:4], peer.addr)
 
         dest_counter = self.rpc_client.next_counter()
-        peers = list(self.find_peer_routes(
-                const.MSG_TYPE_PUBLISH, service, routing_id))
-        targets = peers[:]
-
-        handler, schedule = self.find_local_handler(
+        peers, handler, schedule = self.find_routes(
                 const.MSG_TYPE_PUBLISH, service, routing_id, method)
+        targets = list(peers)
+
         if handler:
             targets.append(LocalTarget(self, handler, schedule, peer))
 
+        relay = self.track_credits(
+                credit.Relay(self.credit_sender(peer,
+                    const.MSG_TYPE_PUBLISH_IS_CHUNKED, source_counter)),
+                targets, const.MSG_TYPE_PUBLISH_IS_CHUNKED, dest_counter)
+
         peer_addr = id(peer)
         bypeer = self.proxying_channels.setdefault(peer_addr, {})
         bypeer[source_counter] = {
             'dest_counter': dest_counter,
             'targets': targets,
             'type': const.MSG_TYPE_PUBLISH_IS_CHUNKED,
+            'window': relay,
         }
 
         self.multipush(targets, (const.MSG_TYPE_PUBLISH_IS_CHUNKED,
@@ -1086,8 +1929,8 @@ class Dispatcher(object):
 
     def incoming_proxy_publish_chunk(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 3:
-            log.warn("received malformed proxy_publish_chunk from %r" %
-                    (peer.addr,))
+            log.warn("received malformed proxy_publish_chunk from %r",
+                    peer.addr)
             return
 
         source_counter, rc, chunk = msg
@@ -1097,61 +1940,67 @@ class Dispatcher(object):
                 source_counter, None)
         if entry is None:
             log.warn("received misdelivered proxy_publish_chunk " +
-                    "%r from %r" % (source_counter, peer.addr))
+                    "%r from %r", source_counter, peer.addr)
             return
 
-        log.debug("received proxy_publish_chunk %r from %r" %
-                (source_counter, peer.addr))
+        log.debug("received proxy_publish_chunk %r from %r",
+                source_counter, peer.addr)
 
-        if rc:
+        if _ends_stream(rc):
             self.cleanup_forwarded_chunk(peer_addr, source_counter)
 
-        self.multipush(entry['targets'], (const.MSG_TYPE_PUBLISH_CHUNK,
-            (entry['dest_counter'], rc, chunk)))
+        self.forward_chunk(entry['targets'], const.MSG_TYPE_PUBLISH_CHUNK,
+                (entry['dest_counter'],), rc, chunk)
+        if not _ends_stream(rc):
+            entry['window'].spend()
 
     def incoming_proxy_publish_end_chunks(self, peer, msg):
         if not isinstance(msg, (int, long)):
-            log.warn("received malformed proxy_publish_end_chunks from %r" %
-                    (peer.addr,))
+            log.warn("received malformed proxy_publish_end_chunks from %r",
+                    peer.addr)
             return
 
         entry = self.cleanup_forwarded_chunk(id(peer), msg)
         if entry is None:
             log.warn("received misdelivered proxy_publish_end_chunks " +
-                    "%r from %r" % (msg, peer.addr))
+                    "%r from %r", msg, peer.addr)
             return
 
-        log.debug("received proxy_publish_end_chunks %r from %r" %
-                (msg, peer.addr))
+        log.debug("received proxy_publish_end_chunks %r from %r",
+                msg, peer.addr)
 
         self.multipush(entry['targets'],
                 (const.MSG_TYPE_PUBLISH_END_CHUNKS, entry['dest_counter']))
 
     def incoming_publish_is_chunked(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 6:
-            log.warn("received malformed publish_is_chunked from %r" %
-                    (peer.ident,))
+            log.warn("received malformed publish_is_chunked from %r",
+                    peer.ident)
             return
 
         service, routing_id, method, counter, args, kwargs = msg
 
         handler, schedule = self.find_local_handler(
                 const.MSG_TYPE_PUBLISH, service, routing_id, method)
+        grant = self.credit_sender(
+                peer, const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter)
         if handler is None:
-            log.warn("received mis-delivered publish_is_chunked %r from %r" %
-                    (msg[:4], peer.ident))
+            log.warn("received mis-delivered publish_is_chunked %r from %r",
+                    msg[:4], peer.ident)
+            self.refuse_chunks(peer.ident,
+                    const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter, grant)
             return
 
-        log.debug("received publish_is_chunked %r from %r" %
-                (msg[:4], peer.ident))
+        log.debug("received publish_is_chunked %r from %r",
+                msg[:4], peer.ident)
 
         self.handle_start_publish_chunks(
-                peer.ident, counter, handler, args, kwargs)
+                peer.ident, counter, handler, args, kwargs, grant)
 
     def incoming_publish_chunk(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 3:
-            log.warn("received malformed publish_chunk from %r" %
-                    (peer.ident,))
+            log.warn("received malformed publish_chunk from %r",
+                    peer.ident)
             return
 
         counter, rc, chunk = msg
@@ -1159,12 +2008,12 @@ class Dispatcher(object):
         peer_ident = peer.ident or id(peer)
         if ((const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter) not in
                 self.received_channels.get(peer_ident, ())):
-            log.warn("received mis-delivered publish_chunk %r from %r" %
-                    ((counter, rc), peer_ident))
+            log.warn("received mis-delivered publish_chunk %r from %r",
+                    (counter, rc), peer_ident)
             return
 
-        log.debug("received publish_chunk %r from %r" %
-                ((counter, rc), peer.ident))
+        log.debug("received publish_chunk %r from %r",
+                (counter, rc), peer.ident)
 
         self.handle_chunk_arrival(peer.ident,
                 const.MSG_TYPE_PUBLISH_IS_CHUNKED, counter, rc,
@@ -1172,51 +2021,55 @@ class Dispatcher(object):
 
     def incoming_publish_end_chunks(self, peer, msg):
         if not isinstance(msg, (int, long)):
-            log.warn("received malformed publish_end_chunks from %r" %
-                    (peer.ident,))
+            log.warn("received malformed publish_end_chunks from %r",
+                    peer.ident)
             return
 
-        log.debug("received publish_end_chunks %r from %r" % (msg, peer.ident))
+        log.debug("received publish_end_chunks %r from %r", msg, peer.ident)
 
         self.cleanup_incoming_chunks(peer.ident,
                 const.MSG_TYPE_PUBLISH_IS_CHUNKED, msg)
 
     def incoming_request_is_chunked(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 6:
-            log.warn("received malformed request_is_chunked from %r" %
-                    (peer.ident,))
+            log.warn("received malformed request_is_chunked from %r",
+                    peer.ident)
             return
 
         service, routing_id, method, counter, args, kwargs = msg
 
         handler, schedule = self.find_local_handler(
                 const.MSG_TYPE_RPC_REQUEST, service, routing_id, method)
+        grant = self.credit_sender(
+                peer, const.MSG_TYPE_REQUEST_IS_CHUNKED, counter)
         if handler is None:
-            if any(routing_id & mask == value
-                    for mask, value, handlers in self.local_subs.get(
-                        (const.MSG_TYPE_RPC_REQUEST, service), [])):
+            if self.locally_handles(
+                    const.MSG_TYPE_RPC_REQUEST, service, routing_id):
                 log.warn("received request_is_chunked " +
-                        "%r for unknown method from %r" %
-                        (msg[:4], peer.ident))
+                        "%r for unknown method from %r",
+                        msg[:4], peer.ident)
                 rc = const.RPC_ERR_NOMETHOD
             else:
                 log.warn("received mis-delivered request_is_chunked " +
-                        "%r from %r" % (msg[:4], peer.ident))
+                        "%r from %r", msg[:4], peer.ident)
                 rc = const.RPC_ERR_NOHANDLER
 
             # some form of mis-delivered message
             peer.push((const.MSG_TYPE_RPC_RESPONSE, (counter, rc, None)))
+            self.refuse_chunks(peer.ident,
+                    const.MSG_TYPE_REQUEST_IS_CHUNKED, counter, grant)
             return
 
-        log.debug("handling request_is_chunked %r from %r scheduled" % (
-                msg[:4], peer.ident))
+        log.debug("handling request_is_chunked %r from %r scheduled",
+                msg[:4], peer.ident)
 
-        self.handle_start_request_chunks(peer, counter, handler, args, kwargs)
+        self.handle_start_request_chunks(
+                peer, counter, handler, args, kwargs, grant=grant)
 
     def incoming_request_chunk(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 3:
-            log.warn("received malformed request_chunk from %r" %
-                    (peer.ident,))
+            log.warn("received malformed request_chunk from %r",
+                    peer.ident)
             return
 
         counter, rc, chunk = msg
@@ -1224,12 +2077,12 @@ class Dispatcher(object):
         peer_ident = peer.ident or id(peer)
         if ((const.MSG_TYPE_REQUEST_IS_CHUNKED, counter) not in
                 self.received_channels.get(peer_ident, ())):
-            log.warn("received mis-delivered request_chunk %r from %r" %
-                    ((counter, rc), peer_ident))
+            log.warn("received mis-delivered request_chunk %r from %r",
+                    (counter, rc), peer_ident)
             return
 
-        log.debug("received request_chunk %r from %r" %
-                ((counter, rc), peer.ident))
+        log.debug("received request_chunk %r from %r",
+                (counter, rc), peer.ident)
 
         self.handle_chunk_arrival(peer.ident,
                 const.MSG_TYPE_REQUEST_IS_CHUNKED, counter, rc,
@@ -1237,36 +2090,34 @@ class Dispatcher(object):
 
     def incoming_request_end_chunks(self, peer, msg):
         if not isinstance(msg, (int, long)):
-            log.warn("received malformed request_end_chunks from %r" %
-                    (peer.ident,))
+            log.warn("received malformed request_end_chunks from %r",
+                    peer.ident)
             return
 
-        log.debug("received request_end_chunks %r from %r" % (msg, peer.ident))
+        log.debug("received request_end_chunks %r from %r", msg, peer.ident)
 
         self.cleanup_incoming_chunks(peer.ident,
                 const.MSG_TYPE_REQUEST_IS_CHUNKED, msg)
 
     def incoming_proxy_request_is_chunked(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 7:
-            log.warn("received malformed proxy_request_is_chunked from %r" %
-                    (peer.addr,))
+            log.warn("received malformed proxy_request_is_chunked from %r",
+                    peer.addr)
             return
 
         (service, routing_id, method, singular,
                 source_counter, args, kwargs) = msg
 
-        log.debug("received proxy_request_is_chunked %r from %r" %
-                (msg[:4], peer.addr))
+        log.debug("received proxy_request_is_chunked %r from %r",
+                msg[:4], peer.addr)
 
-        peers = list(self.find_peer_routes(
-            const.MSG_TYPE_RPC_REQUEST, service, routing_id))
-        targets = peers[:]
+        peers, handler, schedule = self.find_routes(
+                const.MSG_TYPE_RPC_REQUEST, service, routing_id, method)
+        targets = list(peers)
 
         dest_counter = self.rpc_client.next_counter()
         self.rpc_client.sent(dest_counter, peers)
 
-        handler, schedule = self.find_local_handler(
-                const.MSG_TYPE_RPC_REQUEST, service, routing_id, method)
         if handler:
             targets.append(LocalTarget(self, handler, schedule, peer,
                 source_counter))
@@ -1275,12 +2126,18 @@ class Dispatcher(object):
             targets = [self.target_selection(
                     targets, service, routing_id, method)]
 
+        relay = self.track_credits(
+                credit.Relay(self.credit_sender(peer,
+                    const.MSG_TYPE_REQUEST_IS_CHUNKED, source_counter)),
+                targets, const.MSG_TYPE_REQUEST_IS_CHUNKED, dest_counter)
+
         peer_addr = id(peer)
         bypeer = self.proxying_channels.setdefault(peer_addr, {})
         bypeer[source_counter] = {
             'dest_counter': dest_counter,
             'targets': targets,
             'type': const.MSG_TYPE_REQUEST_IS_CHUNKED,
+            'window': relay,
         }
 
         if peers:
@@ -1297,8 +2154,8 @@ class Dispatcher(object):
             # of the method, send a NOMETHOD error and include ourselves in the
             # target_count so the client can distinguish between "no method"
             # and "unroutable"
-            log.warn("received proxy_request %r for unknown method" %
-                    (msg[:3],))
+            log.warn("received proxy_request %r for unknown method",
+                    msg[:3])
             send_nomethod = True
 
         peer.push((const.MSG_TYPE_PROXY_RESPONSE_COUNT,
@@ -1313,8 +2170,8 @@ class Dispatcher(object):
 
     def incoming_proxy_request_chunk(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 3:
-            log.warn("received malformed proxy_request_chunk from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_request_chunk from %r",
+                    peer.ident)
 
         source_counter, rc, chunk = msg
 
@@ -1323,81 +2180,88 @@ class Dispatcher(object):
                 source_counter, None)
         if entry is None:
             log.warn("received misdelivered proxy_request_chunk " +
-                    "%r from %r" % (source_counter, peer.addr))
+                    "%r from %r", source_counter, peer.addr)
             return
 
-        log.debug("received proxy_request_chunk %r from %r" %
-                (source_counter, peer.addr))
+        log.debug("received proxy_request_chunk %r from %r",
+                source_counter, peer.addr)
 
-        if rc:
+        if _ends_stream(rc):
             self.cleanup_forwarded_chunk(peer_addr, source_counter)
 
-        self.multipush(entry['targets'], (const.MSG_TYPE_REQUEST_CHUNK,
-            (entry['dest_counter'], rc, chunk)))
+        self.forward_chunk(entry['targets'], const.MSG_TYPE_REQUEST_CHUNK,
+                (entry['dest_counter'],), rc, chunk)
+        if not _ends_stream(rc):
+            entry['window'].spend()
 
     def incoming_proxy_request_end_chunks(self, peer, msg):
         if not isinstance(msg, (int, long)):
-            log.warn("received malformed proxy_request_end_chunks from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_request_end_chunks from %r",
+                    peer.ident)
             return
 
         entry = self.cleanup_forwarded_chunk(id(peer), msg)
         if entry is None:
             log.warn("received misdelivered proxy_request_end_chunks " +
-                    "%r from %r" % (msg, peer.addr))
+                    "%r from %r", msg, peer.addr)
             return
 
-        log.debug("received proxy_request_end_chunks %r from %r" %
-                (msg, peer.addr))
+        log.debug("received proxy_request_end_chunks %r from %r",
+                msg, peer.addr)
 
         self.multipush(entry['targets'],
                 (const.MSG_TYPE_REQUEST_END_CHUNKS, entry['dest_counter']))
 
     def incoming_response_is_chunked(self, peer, msg):
         if not isinstance(msg, (int, long)):
-            log.warn("received malformed response_is_chunked from %r" %
-                    (peer.ident,))
+            log.warn("received malformed response_is_chunked from %r",
+                    peer.ident)
             return
 
         if msg in self.inflight_proxies:
-            log.debug("received a proxied response_is_chunked %r from %r" %
-                    (msg, peer.ident))
+            log.debug("received a proxied response_is_chunked %r from %r",
+                    msg, peer.ident)
             self.forward_proxy_response_is_chunked(peer, msg)
             return
-        elif (msg not in self.rpc_client.inflight or
+
+        grant = self.credit_sender(
+                peer, const.MSG_TYPE_RESPONSE_IS_CHUNKED, msg)
+        if (msg not in self.rpc_client.inflight or
                 peer.ident not in self.rpc_client.inflight[msg]):
             # drop mistaken responses
-            log.warn("received mis-delivered response_is_chunked %r from %r" %
-                    (msg, peer.ident))
+            log.warn("received mis-delivered response_is_chunked %r from %r",
+                    msg, peer.ident)
+            self.refuse_chunks(peer.ident,
+                    const.MSG_TYPE_RESPONSE_IS_CHUNKED, msg, grant)
             return
 
-        log.debug("received response_is_chunked %r from %r" %
-                (msg, peer.ident))
+        log.debug("received response_is_chunked %r from %r",
+                msg, peer.ident)
 
         self.rpc_client.response(peer, msg, 0,
-                self.handle_start_response_chunks(peer.ident, msg))
+                self.handle_start_response_chunks(peer.ident, msg, grant))
 
     def incoming_response_chunk(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 3:
-            log.warn("received malformed response_chunk from %r" %
-                    (peer.ident,))
+            log.warn("received malformed response_chunk from %r",
+                    peer.ident)
             return
 
         counter, rc, chunk = msg
 
         if counter in self.proxying_channels.get(peer.ident, ()):
-            log.debug("forwarding a response_chunk %r from %r" %
-                    ((counter, rc), peer.ident))
+            log.debug("forwarding a response_chunk %r from %r",
+                    (counter, rc), peer.ident)
             self.forward_proxy_response_chunk(peer.ident, counter, rc, chunk)
             return
         elif ((const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter) not in
                 self.received_channels.get(peer.ident, ())):
-            log.warn("received mis-delivered response_chunk %r from %r" %
-                    ((counter, rc), peer.ident))
+            log.warn("received mis-delivered response_chunk %r from %r",
+                    (counter, rc), peer.ident)
             return
 
-        log.debug("received response_chunk %r from %r" %
-                ((counter, rc), peer.ident))
+        log.debug("received response_chunk %r from %r",
+                (counter, rc), peer.ident)
 
         self.handle_chunk_arrival(peer.ident,
                 const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter, rc,
@@ -1405,45 +2269,50 @@ class Dispatcher(object):
 
     def incoming_response_end_chunks(self, peer, msg):
         if not isinstance(msg, (int, long)):
-            log.warn("received malformed response_end_chunks from %r" %
-                    (peer.ident,))
+            log.warn("received malformed response_end_chunks from %r",
+                    peer.ident)
             return
 
         if msg in self.proxying_channels.get(peer.ident, ()):
-            log.debug("forwarding a response_end_chunks %r from %r" %
-                    (msg, peer.ident))
+            log.debug("forwarding a response_end_chunks %r from %r",
+                    msg, peer.ident)
             self.cleanup_forwarded_proxy_response_chunk(peer.ident, msg, True)
             return
 
-        log.debug("received response_end_chunks %r from %r" %
-                (msg, peer.ident))
+        log.debug("received response_end_chunks %r from %r",
+                msg, peer.ident)
 
         self.cleanup_incoming_chunks(peer.ident,
                 const.MSG_TYPE_RESPONSE_IS_CHUNKED, msg)
 
     def incoming_proxy_response_is_chunked(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 2:
-            log.warn("received malformed proxy_response_is_chunked from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_response_is_chunked from %r",
+                    peer.ident)
             return
 
         counter, source = msg
 
+        # credits go to the hub, which passes them on to the source
+        grant = self.credit_sender(peer,
+                const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter, source)
         if counter not in self.rpc_client.inflight:
             log.warn("received mis-delivered proxy_response_is_chunked " +
-                    "%r from %r" % (counter, peer.ident))
+                    "%r from %r", counter, peer.ident)
+            self.refuse_chunks(source,
+                    const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter, grant)
             return
 
-        log.debug("received proxy_response_is_chunked %r from %r" %
-                (counter, peer.ident))
+        log.debug("received proxy_response_is_chunked %r from %r",
+                counter, peer.ident)
 
         self.rpc_client.response(peer, counter, 0,
-                self.handle_start_response_chunks(source, counter))
+                self.handle_start_response_chunks(source, counter, grant))
 
     def incoming_proxy_response_chunk(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 4:
-            log.warn("received malformed proxy_response_chunk from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_response_chunk from %r",
+                    peer.ident)
             return
 
         source, counter, rc, chunk = msg
@@ -1451,11 +2320,11 @@ class Dispatcher(object):
         if ((const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter) not in
                 self.received_channels.get(source, ())):
             log.warn("received mis-delivered proxy_response_chunk " +
-                    "%r from %r" % ((counter, rc), peer.ident))
+                    "%r from %r", (counter, rc), peer.ident)
             return
 
-        log.debug("received proxy_response_chunk %r from %r" %
-                ((counter, rc), peer.ident))
+        log.debug("received proxy_response_chunk %r from %r",
+                (counter, rc), peer.ident)
 
         self.handle_chunk_arrival(source,
                 const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter, rc,
@@ -1463,21 +2332,26 @@ class Dispatcher(object):
 
     def incoming_proxy_response_end_chunks(self, peer, msg):
         if not isinstance(msg, tuple) or len(msg) != 2:
-            log.warn("received malformed proxy_response_end_chunks from %r" %
-                    (peer.ident,))
+            log.warn("received malformed proxy_response_end_chunks from %r",
+                    peer.ident)
             return
 
         counter, source = msg
 
-        log.debug("received proxy_response_end_chunks %r from %r" %
-                ((counter, source), peer.ident))
+        log.debug("received proxy_response_end_chunks %r from %r",
+                (counter, source), peer.ident)
 
         self.cleanup_incoming_chunks(source,
                 const.MSG_TYPE_RESPONSE_IS_CHUNKED, counter)
 
     handlers = {
+        const.MSG_TYPE_FEATURES: incoming_features,
+        const.MSG_TYPE_CANCEL: incoming_cancel,
+        const.MSG_TYPE_CREDIT: incoming_credit,
         const.MSG_TYPE_ANNOUNCE: incoming_announce,
         const.MSG_TYPE_UNSUBSCRIBE: incoming_unsubscribe,
+        const.MSG_TYPE_ANNOUNCE_MANY: incoming_announce_many,
+        const.MSG_TYPE_UNSUBSCRIBE_MANY: incoming_unsubscribe_many,
         const.MSG_TYPE_PUBLISH: incoming_publish,
         const.MSG_TYPE_RPC_REQUEST: incoming_rpc_request,
         const.MSG_TYPE_RPC_RESPONSE: incoming_rpc_response,
@@ -1514,7 +2388,39 @@ class Dispatcher(object):
     }
 
 
+class Pacer(object):
+    '''Decides when a chunk sender should let other greenlets run
+
+    Pausing after every chunk costs a trip through the scheduler each time,
+    even with nothing else to run. A sender pauses once it has had the CPU
+    for a time slice instead, or waits for a target's send queue to drain
+    to half of ``depth`` when it has backed up past it.
+    '''
+    def __init__(self, targets, time_slice=CHUNK_TIME_SLICE,
+            depth=CHUNK_QUEUE_DEPTH):
+        # local targets have no send queue, their handlers run when paused
+        self.queues = [t.send_queue for t in targets
+                if not isinstance(t, LocalTarget)]
+        self.time_slice = time_slice
+        self.depth = depth
+        self.started = time.time()
+
+    def pace(self):
+        for queue in self.queues:
+            if queue.bytes >= self.depth:
+                queue.wait_drained(self.depth // 2)
+                self.started = time.time()
+                return
+
+        if time.time() - self.started >= self.time_slice:
+            backend.pause()
+            self.started = time.time()
+
+
 class LocalTarget(object):
+    # nothing goes over the wire, so every feature is understood
+    features = const.FEATURES
+
     def __init__(self, dispatcher, handler, schedule, client=None,
             client_counter=None):
         self.dispatcher = dispatcher
@@ -1525,16 +2431,24 @@ class LocalTarget(object):
         self.client = client
         self.client_counter = client_counter
 
+        # set by Dispatcher.track_credits for a chunked stream sent here
+        self.window = None
+
+    def grant(self, count):
+        self.window.grant(self, count)
+
     def push(self, msg):
         msgtype, msg = msg
         if msgtype == const.MSG_TYPE_RPC_REQUEST:
-            counter, service, routing_id, method, args, kwargs = msg
+            counter, service, routing_id, method, args, kwargs = msg[:6]
+            deadline = _deadline(msg[6]) if len(msg) == 7 else None
             if self.schedule:
                 backend.schedule(self.dispatcher.rpc_handler,
-                        args=(self, counter, self.handler, args, kwargs))
+                        args=(self, counter, self.handler, args, kwargs),
+                        kwargs={'deadline': deadline})
             else:
-                self.dispatcher.rpc_handler(
-                        self, counter, self.handler, args, kwargs)
+                self.dispatcher.rpc_handler(self, counter, self.handler,
+                        args, kwargs, deadline=deadline)
 
         elif msgtype == const.MSG_TYPE_RPC_RESPONSE:
             # sent back here via dispatcher.rpc_handler
@@ -1549,22 +2463,24 @@ class LocalTarget(object):
                 try:
                     self.handler(*args, **kwargs)
                 except Exception:
-                    log.error("exception handling local publish %r" %
-                            ((service, routing_id, method),))
+                    log.error("exception handling local publish %r",
+                            (service, routing_id, method))
                     backend.handle_exception(*sys.exc_info())
 
         elif msgtype == const.MSG_TYPE_PUBLISH_IS_CHUNKED:
             service, routing_id, method, counter, args, kwargs = msg
             client = id(self.client) if self.client else None
             self.dispatcher.handle_start_publish_chunks(
-                    client, counter, self.handler, args, kwargs)
+                    client, counter, self.handler, args, kwargs,
+                    self.grant if self.window is not None else None)
 
         elif msgtype == const.MSG_TYPE_REQUEST_IS_CHUNKED:
             service, routing_id, method, counter, args, kwargs = msg
             client = self.client or self
             self.dispatcher.handle_start_request_chunks(
                     client, counter, self.handler, args, kwargs, True,
-                    self.client_counter)
+                    self.client_counter,
+                    self.grant if self.window is not None else None)
 
         elif msgtype in (
                 const.MSG_TYPE_PUBLISH_CHUNK, const.MSG_TYPE_REQUEST_CHUNK):
@@ -1582,27 +2498,53 @@ class LocalTarget(object):
     # in the case of a local handler it doesn't have to go over the wire, so
     # there's no issue with unserializable arguments (or return values). so
     # we'll skip the "dump" phase and just "push" the object itself
-    push_string = push
+    def push_string(self, msg, msg_type=None, exchange=None):
+        self.push(msg)
 
     def dump(self, msg):
         return msg
 
 
+def _deadline(options):
+    # requests carry their deadline as the seconds remaining when they were
+    # sent, so turn it back into a time on the local clock
+    budget = options.get('deadline')
+    if isinstance(budget, (int, long, float)):
+        return time.time() + budget
+    return None
+
+
+def _is_subscription_list(msg):
+    return isinstance(msg, list) and all(
+            isinstance(sub, tuple) and len(sub) == 4 for sub in msg)
+
+
+def _ends_stream(rc):
+    # chunk frames with an error code are the last of their stream
+    return rc and rc != const.CHUNK_BATCH
+
+
 def _check_error(log, source_peer, rc, data):
     if not rc:
         return data
 
+    if rc == const.CHUNK_BATCH:
+        if coalesce.valid(data):
+            return coalesce.Batch(data)
+        log.error("malformed chunk batch from %r", source_peer)
+        return errors.JunctionSystemError("malformed message")
+
     if rc == const.RPC_ERR_MALFORMED:
-        log.error("'malformed message' error from %r" % (source_peer,))
+        log.error("'malformed message' error from %r", source_peer)
         return errors.JunctionSystemError("malformed message")
 
     if rc == const.RPC_ERR_NOHANDLER:
-        log.error("'no handler' error from %r" % (source_peer,))
+        log.error("'no handler' error from %r", source_peer)
         return errors.NoRemoteHandler("message mistakenly sent to %r" %
                 (source_peer,))
 
     if rc == const.RPC_ERR_NOMETHOD:
-        log.error("'unsupported method' error from %r" % (source_peer,))
+        log.error("'unsupported method' error from %r", source_peer)
         return errors.UnsupportedRemoteMethod(
                 "peer at %r doesn't support the method" % (source_peer,))
 
@@ -1610,31 +2552,43 @@ def _check_error(log, source_peer, rc, data):
         err_code, err_args = data
         if err_code in errors.HANDLED_ERROR_TYPES:
             err_klass = errors.HANDLED_ERROR_TYPES.get(err_code)
-            log.error("%s error raised in handler at %r" %
-                    (err_klass.__name__, source_peer))
+            log.error("%s error raised in handler at %r",
+                    err_klass.__name__, source_peer)
             err = err_klass(source_peer, *err_args)
             return err
         else:
             rc = const.RPC_ERR_UNKNOWN
 
     if rc == const.RPC_ERR_UNKNOWN:
-        log.error("exception in handler at %r" % (source_peer,))
+        log.error("exception in handler at %r", source_peer)
         return errors.RemoteException(source_peer, data)
 
     if rc == const.RPC_ERR_LOST_CONN:
-        log.error("failure from lost connection to %r" % (source_peer,))
+        log.error("failure from lost connection to %r", source_peer)
         return errors.LostConnection(source_peer)
 
     if rc == const.RPC_ERR_UNSER_RESP:
-        log.error("handler at %r returned an unserializable object" %
-                (source_peer,))
+        log.error("handler at %r returned an unserializable object",
+                source_peer)
         return errors.UnserializableResponse(data)
 
     if rc == const.RPC_ERR_BADARGS:
-        log.error("wrong arguments provided for handler at %r" %
-                (source_peer,))
+        log.error("wrong arguments provided for handler at %r",
+                source_peer)
         return errors.BadArguments(data)
 
-    log.error("error message with unrecognized return code from %r" %
-            (source_peer,))
+    if rc == const.RPC_ERR_OVERLOADED:
+        # load being shed as configured, not a malfunction
+        log.info("request refused by %r, its targets are overloaded",
+                source_peer)
+        return errors.Overloaded(source_peer)
+
+    if rc == const.RPC_ERR_DEADLINE:
+        # not logged as an error, the caller has usually given up waiting
+        log.info("deadline passed before the handler at %r ran",
+                source_peer)
+        return errors.DeadlineExceeded(source_peer)
+
+    log.error("error message with unrecognized return code from %r",
+            source_peer)
     return errors.UnrecognizedRemoteProblem(source_peer, rc, data)
@@ -1,42 +1,112 @@
 from __future__ import absolute_import
 
+import time
 import weakref
 
-from . import backend, connection, const
+from . import backend, connection, const, timers
 from .. import errors, futures
 
 
+# weight given to each new sample in the per-peer moving averages of response
+# latency and error rate
+EWMA_WEIGHT = 0.2
+
+
 class RPCClient(object):
     REQUEST = const.MSG_TYPE_RPC_REQUEST
     CHUNKED_REQUEST = const.MSG_TYPE_REQUEST_IS_CHUNKED
 
-    def __init__(self):
+    def __init__(self, max_age=None, max_inflight=None):
         self.counter = 1
         self.inflight = {}
         self.by_peer = {}
-        self.rpcs = weakref.WeakValueDictionary()
+
+        # {counter: set of the by_peer keys it is filed under}, so forgetting
+        # an RPC only has to visit the peers it was sent to
+        self.peers_of = {}
+
+        # {counter: weakref.KeyedRef to the RPC future}. the counters of
+        # futures garbage collected while still tracked go in 'abandoned',
+        # and reclaim() drops the rest of their bookkeeping
+        self.rpcs = {}
+        self.abandoned = []
+
+        # with a max_age, RPCs that haven't completed that many seconds after
+        # they were sent are dropped too, and reclaim() checks for them every
+        # max_age / 2 seconds
+        self.max_age = max_age
+        self.next_sweep = 0
+
+        self.sent_at = {}
+        self.hedge_sent_at = {}
+
+        # absolute (local clock) deadlines of the requests that have one
+        self.deadlines = {}
+
+        # with a max_inflight, a request can't go to a peer that already has
+        # that many outstanding. senders wait on 'room', which is triggered
+        # whenever a response (or giving up on one) frees a slot
+        self.max_inflight = max_inflight
+        self.room = backend.Event()
+        self.waiting = 0
+        self.rejected = 0
+
+        # format for peer_stats:
+        # {ident: {
+        #     'outstanding': <requests awaiting a response>,
+        #     'responses': <responses received>,
+        #     'latency': <moving average response time, None before the first>,
+        #     'deviation': <moving average of latency's absolute deviation>,
+        #     'error_rate': <moving average of the share that failed>,
+        # }}
+        # with ident None for requests handled locally. it is what the load
+        # aware peer selection strategies choose by.
+        self.peer_stats = {}
 
     def next_counter(self):
         counter = self.counter
         self.counter += 1
         return counter
 
-    def request(self, targets, msg, singular=False):
+    def request(self, targets, msg, singular=False, deadline=None):
         if not targets:
             return 0, None
 
         counter = self.next_counter()
 
         self.sent(counter, targets)
+        if deadline is not None:
+            self.deadlines[counter] = deadline
 
         rpc = futures.RPC(len(targets), singular)
-        self.rpcs[counter] = rpc
+        self.track(counter, rpc)
 
-        for peer in targets:
-            peer.push((self.REQUEST, (counter,) + msg))
+        self.send_request(targets, counter, msg, deadline)
 
         return counter, rpc
 
+    def send_request(self, targets, counter, msg, deadline):
+        frame = (self.REQUEST, (counter,) + msg)
+        if deadline is None:
+            connection.fan_out(targets, frame)
+            return
+
+        # the deadline goes out as the time remaining, since peers' clocks
+        # can't be compared, and only to peers that accept request options
+        plain, capable = [], []
+        for target in targets:
+            if const.FEATURE_REQUEST_OPTIONS in target.features:
+                capable.append(target)
+            else:
+                plain.append(target)
+
+        if plain:
+            connection.fan_out(plain, frame)
+        if capable:
+            options = {'deadline': max(0.0, deadline - time.time())}
+            connection.fan_out(capable, (self.REQUEST,
+                    (counter,) + msg + (options,)))
+
     def chunked_request(self, counter, targets, singular=False):
         if not targets:
             return None
@@ -44,44 +114,227 @@ class RPCClient(object):
         self.sent(counter, targets)
 
         rpc = futures.RPC(len(targets), singular)
-        self.rpcs[counter] = rpc
+        self.track(counter, rpc)
 
         return rpc
 
+    def track(self, counter, rpc):
+        self.rpcs[counter] = weakref.KeyedRef(rpc, self.collected, counter)
+
+    def collected(self, ref):
+        # this runs wherever garbage collection happened to kick in, so
+        # leave the actual cleanup to reclaim()
+        self.abandoned.append(ref.key)
+
+    def get_rpc(self, counter):
+        ref = self.rpcs.get(counter)
+        return ref and ref()
+
+    def reclaim(self):
+        # forget the RPCs that were abandoned or have outlived max_age,
+        # returning the counters of the expired ones
+        while self.abandoned:
+            self.forget(self.abandoned.pop())
+
+        now = time.time()
+        if self.max_age is None or now < self.next_sweep:
+            return []
+        self.next_sweep = now + self.max_age / 2.0
+
+        expired = [counter for counter, sent_at in self.sent_at.iteritems()
+                if now - sent_at > self.max_age]
+        for counter in expired:
+            rpc = self.get_rpc(counter)
+            self.forget(counter)
+            if rpc is not None and not rpc.complete:
+                rpc.abort(errors.WaitTimeout, errors.WaitTimeout())
+        return expired
+
+    def has_room(self, target):
+        # local handlers aren't limited
+        if target.ident is None:
+            return True
+        stats = self.peer_stats.get(target.ident)
+        return stats is None or stats['outstanding'] < self.max_inflight
+
+    def admit(self, targets, singular):
+        # the targets a request can go to without going over max_inflight, or
+        # None if it has to wait. a singular request can take any one target
+        # with room, but others need room on all of them
+        if self.max_inflight is None:
+            return targets
+        room = [t for t in targets if self.has_room(t)]
+        if len(room) == len(targets) or (singular and room):
+            return room
+        return None
+
+    def wait_for_room(self, deadline=None):
+        # block until a slot frees up somewhere, or the deadline passes
+        timer = None
+        if deadline is not None:
+            timer = timers.add(deadline - time.time(), self.freed)
+        self.waiting += 1
+        try:
+            self.room.wait()
+        finally:
+            self.waiting -= 1
+            if timer is not None:
+                timer.cancel()
+
+    def freed(self):
+        if self.waiting:
+            self.room.set()
+            self.room.clear()
+
+    def overload_stats(self):
+        return {
+            'max_inflight': self.max_inflight,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+        }
+
     def connection_down(self, peer):
         for counter in list(self.by_peer.get(id(peer), [])):
             self.response(peer, counter, const.RPC_ERR_LOST_CONN, None)
 
     def response(self, peer, counter, rc, result):
         self.arrival(counter, peer)
-
-        if counter in self.rpcs:
-            self.rpcs[counter]._incoming(peer.ident, rc, result)
-            if not self.inflight[counter]:
-                del self.inflight[counter]
-            if not self.by_peer[id(peer)]:
-                del self.by_peer[id(peer)]
+        self.record_response(peer.ident, counter, rc)
+
+        rpc = self.get_rpc(counter)
+        if rpc is not None:
+            rpc._incoming(peer.ident, rc, result)
+
+        # clean up whether or not anything still holds the future
+        if not self.inflight[counter]:
+            del self.inflight[counter]
+            self.clear(counter)
+            self.freed()
+        if not self.by_peer[id(peer)]:
+            del self.by_peer[id(peer)]
+
+    def forget(self, counter):
+        # drop all bookkeeping for an RPC, returning the idents it awaited
+        awaiting = self.inflight.pop(counter, set())
+        self.clear(counter)
+
+        for ident in awaiting:
+            self.hedge_sent_at.pop((counter, ident), None)
+            self.stats_for(ident)['outstanding'] -= 1
+
+        if awaiting:
+            self.freed()
+
+        return awaiting
+
+    def clear(self, counter):
+        # the bookkeeping shared by regular and proxied RPCs
+        self.sent_at.pop(counter, None)
+        self.deadlines.pop(counter, None)
+        self.rpcs.pop(counter, None)
+
+        for key in self.peers_of.pop(counter, ()):
+            counters = self.by_peer.get(key)
+            if counters is None:
+                continue
+            self.unfile(counters, counter)
+            if not counters:
+                del self.by_peer[key]
+
+    def unfile(self, counters, counter):
+        counters.discard(counter)
+
+    def cancel(self, counter, peers, streaming=()):
+        # forget all about an RPC, and return the peers that are still
+        # working on it: those yet to respond or still streaming chunks
+        awaiting = self.forget(counter)
+        return [peers[ident] for ident in awaiting.union(streaming)
+                if ident in peers]
 
     def sent(self, counter, targets):
+        self.sent_at[counter] = time.time()
         self.inflight[counter] = set(x.ident for x in targets)
+        self.peers_of[counter] = set(id(x) for x in targets)
         for peer in targets:
             self.by_peer.setdefault(id(peer), set()).add(counter)
+            self.stats_for(peer.ident)['outstanding'] += 1
 
     def arrival(self, counter, peer):
         self.inflight[counter].remove(peer.ident)
         self.by_peer[id(peer)].remove(counter)
+        self.peers_of[counter].discard(id(peer))
+        self.stats_for(peer.ident)['outstanding'] -= 1
+        self.freed()
+
+    def hedge(self, counter, target, msg):
+        # send one more copy of an in-flight request to another target. the
+        # first response completes the RPC, and the others just get cleared
+        # out of the bookkeeping as they arrive
+        self.hedge_sent_at[(counter, target.ident)] = time.time()
+        self.inflight[counter].add(target.ident)
+        self.by_peer.setdefault(id(target), set()).add(counter)
+        self.peers_of[counter].add(id(target))
+        self.stats_for(target.ident)['outstanding'] += 1
+
+        self.send_request(
+                [target], counter, msg, self.deadlines.get(counter))
+
+    def record_response(self, ident, counter, rc):
+        sent_at = self.hedge_sent_at.pop((counter, ident), None) or \
+                self.sent_at.get(counter)
+        if sent_at is None:
+            return
+
+        stats = self.stats_for(ident)
+        stats['responses'] += 1
+
+        # handled exceptions are the handler's business, not a sign that
+        # something is wrong with the peer
+        failed = rc not in (0, const.RPC_ERR_KNOWN)
+        stats['error_rate'] += EWMA_WEIGHT * (failed - stats['error_rate'])
+
+        # a lost connection isn't a response, so says nothing of latency
+        if rc == const.RPC_ERR_LOST_CONN:
+            return
+
+        latency = time.time() - sent_at
+        if stats['latency'] is None:
+            stats['latency'] = latency
+        else:
+            diff = latency - stats['latency']
+            stats['latency'] += EWMA_WEIGHT * diff
+            stats['deviation'] += EWMA_WEIGHT * (
+                    abs(diff) - stats['deviation'])
+
+    def stats_for(self, ident):
+        stats = self.peer_stats.get(ident)
+        if stats is None:
+            stats = self.peer_stats[ident] = {
+                'outstanding': 0,
+                'responses': 0,
+                'latency': None,
+                'deviation': 0.0,
+                'error_rate': 0.0,
+            }
+        return stats
 
 
 class ProxiedClient(RPCClient):
     REQUEST = const.MSG_TYPE_PROXY_REQUEST
     CHUNKED_REQUEST = const.MSG_TYPE_PROXY_REQUEST_IS_CHUNKED
 
-    def __init__(self, client):
-        super(ProxiedClient, self).__init__()
+    def __init__(self, client, max_age=None, max_inflight=None):
+        super(ProxiedClient, self).__init__(max_age, max_inflight)
         self._client = weakref.ref(client)
 
+    def has_room(self, target):
+        # the limit is on the client as a whole, everything goes to the hub
+        return len(self.inflight) < self.max_inflight
+
     def sent(self, counter, targets):
+        self.sent_at[counter] = time.time()
         self.inflight[counter] = 0
+        self.peers_of[counter] = set(id(x) for x in targets)
         for peer in targets:
             self.by_peer.setdefault(id(peer), {})[counter] = 0
 
@@ -90,6 +343,23 @@ class ProxiedClient(RPCClient):
         self.by_peer[id(peer)][counter] -= 1
         if not self.by_peer[id(peer)][counter]:
             del self.by_peer[id(peer)][counter]
+            self.peers_of[counter].discard(id(peer))
+
+    def forget(self, counter):
+        awaiting = self.inflight.pop(counter, None)
+        self.clear(counter)
+        if awaiting is not None:
+            self.freed()
+        return awaiting
+
+    def unfile(self, counters, counter):
+        counters.pop(counter, None)
+
+    def cancel(self, counter, peers, streaming=()):
+        # everything goes by way of the hub, so that is who gets told
+        if self.forget(counter) is None and not streaming:
+            return []
+        return peers.values()
 
     def expect(self, peer, counter, target_count):
         try:
@@ -98,8 +368,13 @@ class ProxiedClient(RPCClient):
             raise
         self.by_peer[id(peer)][counter] += target_count
 
-        if counter in self.rpcs:
-            self.rpcs[counter]._expect(target_count)
+        rpc = self.get_rpc(counter)
+        if rpc is not None:
+            rpc._expect(target_count)
+
+        # with no targets there won't be any responses to clean up after
+        if not self.inflight[counter]:
+            self.forget(counter)
 
     def recipient_count(self, target, msg_type, service, routing_id, method):
         counter = self.next_counter()
@@ -110,7 +385,7 @@ class ProxiedClient(RPCClient):
         self.sent(counter, set([target]))
 
         rpc = futures.RPC(1, False)
-        self.rpcs[counter] = rpc
+        self.track(counter, rpc)
 
         self.expect(target, counter, 1)
 
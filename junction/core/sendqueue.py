@@ -0,0 +1,258 @@
+'''A queue of serialized frames waiting to go out on a connection
+
+It can be bounded by the total size of the frames it holds. What happens
+when a frame would take it past that bound depends on its policy:
+
+ - ``block``: the producer waits until the sender has drained enough
+ - ``drop``: the oldest droppable frames (plain publishes) are thrown away
+   to make room. everything else, like RPC responses and control frames, is
+   kept even if that leaves the queue over its bound
+ - ``disconnect``: the frame is dropped, and the overflow callback is left
+   to take the connection down
+
+Crossing the high watermark on the way up, and then the low watermark on
+the way back down, also trigger callbacks so applications can throttle
+themselves before it comes to that.
+
+Frames are kept in separate lanes (see ``const.LANES``) so that a backlog
+of bulk chunks doesn't hold up control frames and RPCs queued behind it.
+Each lane is FIFO, and the sender takes from them by deficit round robin:
+while they all have frames waiting, each gets to send its weight in
+``LANE_QUANTUM`` byte units per round.
+
+Frames that belong to one exchange, an RPC or a chunked stream, must still
+arrive in the order they were queued. So they are put with a key naming
+that exchange (see ``connection.exchange``), and while any frame with that
+key is waiting, the ones after it follow it into its lane, whatever lane
+they'd have gone in.
+'''
+from __future__ import absolute_import
+
+import collections
+
+from . import backend, const
+
+
+__all__ = ["SendQueue"]
+
+
+# the default watermarks, as fractions of the queue's bound
+HIGH_WATER = 0.75
+LOW_WATER = 0.25
+
+# the lanes' weights, in order of const.LANE_CONTROL, LANE_RPC and LANE_BULK,
+# and the bytes per unit of weight that each may send in a round
+LANE_WEIGHTS = (4, 2, 1)
+LANE_QUANTUM = 16384
+
+
+class SendQueue(object):
+    def __init__(self, max_bytes=None, policy=const.QUEUE_BLOCK,
+            on_high=None, on_low=None, on_overflow=None,
+            weights=LANE_WEIGHTS):
+        self.max_bytes = max_bytes
+        self.policy = policy
+        if max_bytes is not None:
+            self.high_water = int(max_bytes * HIGH_WATER)
+            self.low_water = int(max_bytes * LOW_WATER)
+        self.on_high = on_high
+        self.on_low = on_low
+        self.on_overflow = on_overflow
+
+        # a deque of (frame, droppable, exchange) triples for each lane
+        self.lanes = [collections.deque() for weight in weights]
+        self.quanta = [weight * LANE_QUANTUM for weight in weights]
+        self.deficits = [0] * len(weights)
+        self.turn = 0
+        self.count = 0
+        self.bytes = 0
+        self.droppable_bytes = 0
+        self.dropped = 0
+        self.above_high = False
+        self.closed = False
+
+        # {exchange: [lane, frames waiting]} for the exchanges with frames in
+        # the queue, to keep their later frames behind them
+        self.pinned = {}
+
+        # set while there are frames, for the sender to wait on
+        self._ready = backend.Event()
+
+        # triggered as frames are taken, for producers blocked on a full queue
+        # and those waiting for it to drain
+        self._room = backend.Event()
+        self._blocked = 0
+
+    def qsize(self):
+        return self.count
+
+    def empty(self):
+        return not self.count
+
+    def put(self, frame, droppable=False, lane=const.LANE_RPC,
+            exchange=None):
+        '''Add a frame to the end of one of the queue's lanes
+
+        If ``exchange`` is given and frames of the same one are still
+        waiting, this one goes in their lane instead, so it can't overtake
+        them.
+
+        :returns: False if the frame was dropped, otherwise True
+        '''
+        size = len(frame)
+        if self.max_bytes is not None and not self.closed and \
+                self.bytes + size > self.max_bytes and self.count:
+            if not self.make_room(size):
+                self.dropped += 1
+                return False
+
+        if exchange is not None:
+            pin = self.pinned.get(exchange)
+            if pin is None:
+                self.pinned[exchange] = [lane, 1]
+            else:
+                lane = pin[0]
+                pin[1] += 1
+
+        self.lanes[lane].append((frame, droppable, exchange))
+        self.count += 1
+        self.bytes += size
+        if droppable:
+            self.droppable_bytes += size
+        self._ready.set()
+
+        if (self.max_bytes is not None and not self.above_high
+                and self.bytes >= self.high_water):
+            self.above_high = True
+            if self.on_high is not None:
+                self.on_high(self.bytes)
+
+        return True
+
+    def make_room(self, size):
+        # apply the policy to an incoming frame that doesn't fit. returns
+        # whether the frame should still go in
+        if self.policy == const.QUEUE_BLOCK:
+            self._blocked += 1
+            try:
+                while (self.count and not self.closed
+                        and self.bytes + size > self.max_bytes):
+                    self._room.wait()
+            finally:
+                self._blocked -= 1
+            return True
+
+        if self.policy == const.QUEUE_DROP:
+            if not self.droppable_bytes:
+                return True
+
+            # throw away the oldest publishes, but leave everything else in
+            # its place. that can be most of a lane, so they are rebuilt
+            for i, lane in enumerate(self.lanes):
+                kept = collections.deque()
+                for item in lane:
+                    if item[1] and self.bytes + size > self.max_bytes:
+                        self.bytes -= len(item[0])
+                        self.droppable_bytes -= len(item[0])
+                        self.dropped += 1
+                        self.count -= 1
+                        self.unpin(item[2])
+                    else:
+                        kept.append(item)
+                self.lanes[i] = kept
+            return True
+
+        # QUEUE_DISCONNECT
+        if self.on_overflow is not None:
+            self.on_overflow(self.bytes + size)
+        return False
+
+    def get(self):
+        'Take the next frame, blocking while the queue is empty'
+        while not self.count:
+            self._ready.clear()
+            self._ready.wait()
+
+        frame, droppable, exchange = self.take()
+        self.unpin(exchange)
+        self.count -= 1
+        self.bytes -= len(frame)
+        if droppable:
+            self.droppable_bytes -= len(frame)
+
+        if self._blocked:
+            self._room.set()
+            self._room.clear()
+
+        if self.max_bytes is not None:
+            if self.above_high and self.bytes <= self.low_water:
+                self.above_high = False
+                if self.on_low is not None:
+                    self.on_low(self.bytes)
+
+        return frame
+
+    def unpin(self, exchange):
+        # a frame of this exchange has left the queue
+        if exchange is None:
+            return
+        pin = self.pinned[exchange]
+        pin[1] -= 1
+        if not pin[1]:
+            del self.pinned[exchange]
+
+    def take(self):
+        # deficit round robin. the lane whose turn it is sends frames for as
+        # long as its deficit covers them, and the next is topped up with
+        # its quantum as the turn passes on. a lane with nothing waiting
+        # gives up its deficit, so it can't save up for a burst later
+        lanes, deficits = self.lanes, self.deficits
+        while 1:
+            lane = lanes[self.turn]
+            if lane:
+                size = len(lane[0][0])
+                # with only this lane waiting, there's no one to be fair to
+                if size <= deficits[self.turn] or len(lane) == self.count:
+                    deficits[self.turn] = max(0, deficits[self.turn] - size)
+                    item = lane.popleft()
+                    if not lane:
+                        deficits[self.turn] = 0
+                    return item
+            else:
+                deficits[self.turn] = 0
+
+            self.turn = (self.turn + 1) % len(lanes)
+            if lanes[self.turn]:
+                deficits[self.turn] += self.quanta[self.turn]
+
+    def wait_drained(self, size):
+        'Block until the queue holds no more than ``size`` bytes'
+        self._blocked += 1
+        try:
+            while self.bytes > size and not self.closed:
+                self._room.wait()
+        finally:
+            self._blocked -= 1
+
+    def clear(self):
+        'Throw away everything queued'
+        self.dropped += self.count
+        for lane in self.lanes:
+            lane.clear()
+        self.pinned.clear()
+        self.deficits = [0] * len(self.lanes)
+        self.count = self.bytes = self.droppable_bytes = 0
+        if self.above_high:
+            self.above_high = False
+            if self.on_low is not None:
+                self.on_low(self.bytes)
+        if self._blocked:
+            self._room.set()
+            self._room.clear()
+
+    def close(self):
+        'Stop bounding the queue, releasing any blocked producers'
+        self.closed = True
+        if self._blocked:
+            self._room.set()
+            self._room.clear()
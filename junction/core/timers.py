@@ -0,0 +1,233 @@
+'''A shared hierarchical timer wheel for timeouts
+
+Every timeout in the process (waiting on futures, reconnect backoff, RPC
+hedges) is registered with one wheel, driven by a single coroutine, instead
+of each one setting its own backend timer. Inserting and cancelling a timer
+are O(1) set operations, and everything that expires within the same tick
+is fired together in one pass of the driver.
+
+The wheel has ``LEVELS`` levels of ``SLOTS`` slots each. A slot on level 0
+spans one tick of ``RESOLUTION`` seconds, and a slot on each level above
+spans a whole turn of the level below it. Timers far enough out to land on
+an upper level are cascaded down a level each time the one below wraps, so
+they only get touched a handful of times before they fire.
+
+Callbacks run in the driver coroutine, so they must not block. The wheel
+belongs to the greenlet backend that was active when it was made, and a new
+one is started on the next activation.
+'''
+from __future__ import absolute_import
+
+import logging
+import math
+import sys
+import time
+
+from . import backend
+
+
+__all__ = ["Timer", "TimerWheel", "add"]
+
+
+log = logging.getLogger("junction.timers")
+
+
+# seconds per tick. timers fire up to one tick late, but never early
+RESOLUTION = 0.01
+
+# slots per level (a power of two) and the number of levels. with these the
+# wheel spans about 46 hours, and anything longer waits in the last slot of
+# the top level and gets re-placed each time it comes around
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+LEVELS = 4
+
+
+class Timer(object):
+    'A single scheduled callback, returned by :meth:`TimerWheel.add`'
+    __slots__ = ["wheel", "expires", "func", "args", "slot"]
+
+    def __init__(self, wheel, expires, func, args):
+        self.wheel = wheel
+        self.expires = expires
+        self.func = func
+        self.args = args
+
+        # the set this timer currently sits in, None once fired or cancelled
+        self.slot = None
+
+    @property
+    def pending(self):
+        'Whether the timer is still waiting to fire'
+        return self.slot is not None
+
+    def cancel(self):
+        'Keep the timer from firing (a no-op if it already has)'
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+
+class TimerWheel(object):
+    def __init__(self, resolution=RESOLUTION):
+        self.resolution = resolution
+        self.origin = time.time()
+
+        # the last tick that has been processed
+        self.tick = 0
+
+        # {level: [set of Timers per slot]}
+        self.levels = [[set() for i in xrange(SLOTS)] for l in xrange(LEVELS)]
+        self.count = 0
+
+        self.activation = backend.activations
+        self._driver = None
+        self._wake = backend.Event()
+        self._wake_at = None
+
+    def add(self, secs, func, args=()):
+        '''Schedule ``func(*args)`` to run in ``secs`` seconds
+
+        :returns: a :class:`Timer`, which can be cancelled
+        '''
+        expires = int(math.ceil(
+            (time.time() + secs - self.origin) / self.resolution))
+        timer = Timer(self, expires, func, args)
+        self.place(timer)
+        self.count += 1
+
+        if not self.driven():
+            self._driver = backend.greenlet(self.driver_coro)
+            backend.schedule(self._driver)
+        elif self._wake_at is not None and expires < self._wake_at:
+            # the driver is sleeping past this one
+            self._wake.set()
+
+        return timer
+
+    def driven(self):
+        # whether a driver coroutine is still around to fire the timers. one
+        # killed before it ever ran never got to clear itself out
+        return self._driver is not None and not self._driver.dead
+
+    def place(self, timer):
+        # never in the past: the current tick's slot has been processed
+        expires = max(timer.expires, self.tick + 1)
+        delta = expires - self.tick
+
+        for level in xrange(LEVELS):
+            if delta < 1 << (SLOT_BITS * (level + 1)):
+                break
+        else:
+            # beyond the wheel's span, park it as far out as it goes. it is
+            # re-placed with its real expiry when it cascades down
+            expires = self.tick + (1 << (SLOT_BITS * LEVELS)) - 1
+
+        slot = self.levels[level][(expires >> (SLOT_BITS * level)) % SLOTS]
+        slot.add(timer)
+        timer.slot = slot
+
+    def cascade(self, tick):
+        # re-place the timers from the upper levels' slots that begin at this
+        # tick, highest level first so they can trickle all the way down
+        for level in xrange(LEVELS - 1, 0, -1):
+            if tick & ((1 << (SLOT_BITS * level)) - 1):
+                continue
+            slot = self.levels[level][(tick >> (SLOT_BITS * level)) % SLOTS]
+            if not slot:
+                continue
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self.place(timer)
+
+    def advance(self, now=None):
+        '''Process every tick up to ``now``, firing the expired timers
+
+        :returns: the number of timers fired
+        '''
+        if now is None:
+            now = time.time()
+        target = int((now - self.origin) / self.resolution)
+
+        # jump straight between the ticks that have anything to do
+        expired = []
+        while self.count > len(expired):
+            tick = self.next_tick()
+            if tick > target:
+                break
+            self.tick = tick
+            self.cascade(tick)
+
+            slot = self.levels[0][tick % SLOTS]
+            if slot:
+                expired.extend(slot)
+                slot.clear()
+
+        self.tick = max(self.tick, target)
+
+        self.count -= len(expired)
+        for timer in expired:
+            timer.slot = None
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                log.error("exception in timer callback %r", timer.func)
+                backend.handle_exception(*sys.exc_info())
+
+        return len(expired)
+
+    def next_tick(self):
+        # the next tick with anything to do: a non-empty level 0 slot coming
+        # due, or a non-empty upper level slot cascading down. a slot on each
+        # level can't come up before the one after the current one starts,
+        # so there is no need to look any higher than the best found so far
+        best = None
+        for level in xrange(LEVELS):
+            shift = SLOT_BITS * level
+            current = self.tick >> shift
+            if best is not None and best < (current + 1) << shift:
+                break
+            slots = self.levels[level]
+            for index in xrange(current + 1, current + SLOTS + 1):
+                if slots[index % SLOTS]:
+                    if best is None or index << shift < best:
+                        best = index << shift
+                    break
+        if best is None:
+            # nothing scheduled at all
+            return self.tick + 1
+        return best
+
+    def driver_coro(self):
+        # a driver that has been replaced leaves the wheel to its successor
+        current = backend.getcurrent()
+        try:
+            while self.count and self._driver is current:
+                self._wake_at = self.next_tick()
+                delay = (self.origin + self._wake_at * self.resolution
+                        - time.time())
+                if delay > 0:
+                    self._wake.wait(delay)
+                    self._wake.clear()
+                self._wake_at = None
+                self.advance()
+        finally:
+            if self._driver is current:
+                self._driver = None
+                self._wake_at = None
+
+
+_wheel = None
+
+
+def add(secs, func, args=()):
+    '''Schedule ``func(*args)`` on the process-wide timer wheel
+
+    :returns: a :class:`Timer`, which can be cancelled
+    '''
+    global _wheel
+    if _wheel is None or _wheel.activation != backend.activations:
+        _wheel = TimerWheel()
+    return _wheel.add(secs, func, args)
@@ -0,0 +1,62 @@
+'''Opt-in structured tracing of the messages a process sends and receives
+
+While tracing is enabled every message pushed to a connection or handled by
+the dispatcher is recorded in a fixed-size ring buffer as a tuple of
+``(timestamp, event, msg_type, msg_id, peer)``, where ``event`` is "send" or
+"recv", ``msg_id`` is the RPC or chunked-stream counter (None for messages
+that don't carry one) and ``peer`` is the remote peer's ident. Nothing is
+formatted into strings, so it is cheap enough to leave on under load, and
+while it is disabled the only cost is one attribute check per message.
+'''
+from __future__ import absolute_import
+
+import collections
+import time
+
+from . import const
+
+
+# default number of records kept before the oldest are dropped
+TRACE_SIZE = 10000
+
+# the ring buffer of records, or None while tracing is disabled. hot paths
+# check this before calling record()
+events = None
+
+
+def enable(size=TRACE_SIZE):
+    '''Start recording messages, keeping the most recent ``size`` of them
+
+    Re-enabling discards anything recorded so far.
+    '''
+    global events
+    events = collections.deque(maxlen=size)
+
+
+def disable():
+    'Stop recording and discard the records'
+    global events
+    events = None
+
+
+def snapshot():
+    '''Get the current records, oldest first
+
+    :returns: a list of ``(timestamp, event, msg_type, msg_id, peer)`` tuples
+    '''
+    return list(events or ())
+
+
+def record(event, msg_type, msg, peer):
+    if events is None:
+        return
+
+    msg_id = None
+    index = const.COUNTER_INDEX.get(msg_type)
+    if index is not None:
+        if isinstance(msg, tuple) and len(msg) > index:
+            msg = msg[index]
+        if isinstance(msg, (int, long)):
+            msg_id = msg
+
+    events.append((time.time(), event, msg_type, msg_id, peer))
@@ -0,0 +1,110 @@
+from __future__ import absolute_import
+
+
+# child slots in a trie node: the routing id bit must be 0, must be 1, or is
+# masked out and so could be either
+ZERO, ONE, WILD = 0, 1, 2
+
+
+class _Node(object):
+    __slots__ = ["children", "pattern", "count"]
+
+    def __init__(self):
+        self.children = [None, None, None]
+        self.pattern = None
+        self.count = 0
+
+
+class MaskTrie(object):
+    '''A set of (mask, value) pairs that can be checked for overlaps
+
+    Two pairs overlap if some routing id would match both of them, which is
+    the case when they agree on every bit that both of their masks include.
+
+    Pairs are stored along a path of bits from least to most significant up
+    to the highest bit in the mask, where each step follows the value's bit
+    or a wildcard branch if the mask leaves it out. Looking for an overlap
+    then follows the new pair's bits and the wildcard branches, so with the
+    usual sharding layouts (many values under the same mask) it takes time
+    proportional to the number of mask bits rather than to the number of
+    stored pairs.
+    '''
+    def __init__(self):
+        self._root = _Node()
+
+    def __len__(self):
+        return self._root.count
+
+    def add(self, mask, value):
+        node = self._root
+        node.count += 1
+        for i in xrange(mask.bit_length()):
+            branch = (value >> i) & 1 if (mask >> i) & 1 else WILD
+            child = node.children[branch]
+            if child is None:
+                child = node.children[branch] = _Node()
+            node = child
+            node.count += 1
+        node.pattern = (mask, value)
+
+    def remove(self, mask, value):
+        path = [(self._root, None)]
+        for i in xrange(mask.bit_length()):
+            branch = (value >> i) & 1 if (mask >> i) & 1 else WILD
+            child = path[-1][0].children[branch]
+            if child is None:
+                return False
+            path.append((child, branch))
+
+        if path[-1][0].pattern != (mask, value):
+            return False
+        path[-1][0].pattern = None
+
+        for node, branch in path:
+            node.count -= 1
+
+        # prune the topmost branch that no longer leads to any pairs
+        for i in xrange(1, len(path)):
+            node, branch = path[i]
+            if not node.count:
+                path[i - 1][0].children[branch] = None
+                break
+
+        return True
+
+    def find_overlap(self, mask, value):
+        '''Find a stored (mask, value) pair that overlaps the given one
+
+        :returns: the overlapping pair, or None if there isn't one
+        '''
+        length = mask.bit_length()
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+
+            # a stored pair ending here has only wildcards from here on
+            if node.pattern is not None:
+                return node.pattern
+
+            # likewise the new pair, so anything further down overlaps
+            if depth == length:
+                return self._any_pattern(node)
+
+            if (mask >> depth) & 1:
+                branches = ((value >> depth) & 1, WILD)
+            else:
+                branches = (ZERO, ONE, WILD)
+
+            for branch in branches:
+                child = node.children[branch]
+                if child is not None:
+                    stack.append((child, depth + 1))
+
+        return None
+
+    def _any_pattern(self, node):
+        if not node.count:
+            return None
+        while node.pattern is None:
+            node = [c for c in node.children if c is not None][0]
+        return node.pattern
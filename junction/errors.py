@@ -71,6 +71,18 @@ class IllegalMessage(Exception):
     "Restrictions on message types violated"
 
 
+class DeadlineExceeded(Exception):
+    "The request's deadline passed before its handler could run"
+
+
+class Cancelled(Exception):
+    "The RPC was cancelled before it completed"
+
+
+class Overloaded(Exception):
+    "The RPC's targets already have as many requests outstanding as allowed"
+
+
 HANDLED_ERROR_TYPES = {}
 
 
@@ -2,12 +2,11 @@ from __future__ import absolute_import
 
 import logging
 import sys
-import time
 import weakref
 
 import mummy
 
-from .core import backend, dispatch
+from .core import backend, dispatch, timers
 from . import errors
 
 
@@ -99,7 +98,7 @@ class Future(object):
 
         self._failure = (klass, exc, tb)
 
-        for wait in self._waits:
+        for wait in list(self._waits):
             wait.finish(self)
         self._waits = None
 
@@ -155,8 +154,10 @@ class Future(object):
             :class:`WaitTimeout <junction.errors.WaitTimeout>` if ``timeout``
             expires before completion
         '''
-        if self._done.wait(timeout):
-            raise errors.WaitTimeout()
+        if timeout is None:
+            self._done.wait()
+        elif not self._done.is_set():
+            _wait([self], 1, timeout)
 
     def after(self, func=None, other_parents=None):
         '''Create a new Future whose completion depends on this one
@@ -216,6 +217,7 @@ class RPC(Future):
         self._singular = singular
         self._results = []
         self._arrival = backend.Event()
+        self._cancel = None
 
     @property
     def target_count(self):
@@ -253,6 +255,21 @@ class RPC(Future):
         self._results = None
         super(RPC, self).abort(klass, exc, tb)
 
+    def cancel(self):
+        '''Stop waiting on the RPC, and have its targets stop working on it
+
+        Handlers that haven't finished are ended, as are chunked responses
+        still being sent, on peers that support cancellation. Unless it had
+        already completed, the RPC is aborted with :class:`Cancelled
+        <junction.errors.Cancelled>`.
+        '''
+        if self._cancel is not None:
+            self._cancel()
+            self._cancel = None
+
+        if not self._done.is_set():
+            self.abort(errors.Cancelled, errors.Cancelled())
+
     def _expect(self, count):
         if self._done.is_set():
             return
@@ -390,15 +407,7 @@ def wait_any(futures, timeout=None):
         if fut.complete:
             return fut
 
-    wait = _Wait(futures)
-
-    for fut in futures:
-        fut._waits.add(wait)
-
-    if wait.done.wait(timeout):
-        raise errors.WaitTimeout()
-
-    return wait.completed_future
+    return _wait(futures, 1, timeout)
 
 
 def wait_all(futures, timeout=None):
@@ -411,31 +420,72 @@ def wait_all(futures, timeout=None):
 
     :raises WaitTimeout: if a timeout is provided and hit
     '''
-    if timeout is not None:
-        deadline = time.time() + timeout
-        for fut in futures:
-            fut.wait(deadline - time.time())
-    else:
+    if timeout is None:
         for fut in futures:
             fut.wait()
+        return
+
+    # one wait (and one timer) covering every future still outstanding
+    pending = set(fut for fut in futures if not fut.complete)
+    if pending:
+        _wait(pending, len(pending), timeout)
+
+
+def _wait(futures, count, timeout):
+    # block until `count` of the futures complete, or the timeout expires
+    if timeout is not None and timeout <= 0:
+        raise errors.WaitTimeout()
+
+    wait = _Wait(futures, count)
+
+    for fut in wait.futures:
+        fut._waits.add(wait)
+
+    if timeout is not None:
+        wait.timer = timers.add(timeout, wait.expire)
+
+    wait.done.wait()
+
+    if wait.timed_out:
+        raise errors.WaitTimeout()
+
+    return wait.completed_future
 
 
 class _Wait(object):
-    def __init__(self, futures):
+    def __init__(self, futures, count=1):
         self.futures = set(futures)
+        self.remaining = count
         self.done = backend.Event()
         self.completed_future = None
         self.finished = False
+        self.timed_out = False
+        self.timer = None
 
     def finish(self, fut):
         if self.finished:
             return
+        self.completed_future = fut
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.end()
+
+    def expire(self):
+        if self.finished:
+            return
+        self.timed_out = True
+        self.end()
+
+    def end(self):
         self.finished = True
 
-        self.completed_future = fut
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
 
         for future in self.futures:
-            future._waits.remove(self)
+            if future._waits is not None:
+                future._waits.discard(self)
 
         self.done.set()
 
@@ -1,11 +1,19 @@
+import inspect
 import logging
 import random
 
 
 log = logging.getLogger("junction.hooks")
 
+# the "fastest" strategy avoids peers whose recent error rate is above this
+UNHEALTHY_ERROR_RATE = 0.5
 
-def select_peer(peer_addrs, service, routing_id, method):
+# chance that the "fastest" strategy sends to an unhealthy peer anyway, so
+# that a recovered peer gets the responses it needs to become healthy again
+PROBE_CHANCE = 0.05
+
+
+def select_peer(peer_addrs, service, routing_id, method, peer_stats=None):
     '''Choose a target from the available peers for a singular message
 
     :param peer_addrs:
@@ -18,6 +26,13 @@ def select_peer(peer_addrs, service, routing_id, method):
     :type routing_id: int
     :param method: the message method name
     :type method: string
+    :param peer_stats:
+        the hub's per-peer RPC statistics, mapping peer addrs to dicts of
+        ``outstanding``, ``responses``, ``latency``, ``deviation`` and
+        ``error_rate`` (see :meth:`Hub.peer_stats <junction.Hub.peer_stats>`).
+        a custom hook is only passed this if it has a ``peer_stats``
+        argument.
+    :type peer_stats: dict
 
     :returns: one of the provided peer_addrs
 
@@ -59,19 +74,170 @@ def connection_received(peer, subscriptions):
     pass
 
 
-def _get(hooks, name):
-    log.info("invoking hook %s" % name)
+def send_queue_high(peer, queued_bytes):
+    '''A connection's send queue has filled up past its high watermark
+
+    Only called for hubs and clients with a ``max_queued_bytes``, when the
+    queue reaches three quarters of it. It is a signal to slow down sending
+    to the peer until :func:`send_queue_low` is called for it.
+
+    :param peer:
+        the ``(host, port)`` with which the peer identified itself, or
+        ``None`` for a connection from a client
+    :type peer: ``(host, port)`` tuple or None
+    :param queued_bytes: the size of the frames waiting to be sent
+    :type queued_bytes: int
+    '''
+    pass
+
+
+def send_queue_low(peer, queued_bytes):
+    '''A connection's send queue has drained back down to its low watermark
+
+    Called once the queue is back down to a quarter of ``max_queued_bytes``
+    after :func:`send_queue_high` was called for it.
+
+    :param peer:
+        the ``(host, port)`` with which the peer identified itself, or
+        ``None`` for a connection from a client
+    :type peer: ``(host, port)`` tuple or None
+    :param queued_bytes: the size of the frames waiting to be sent
+    :type queued_bytes: int
+    '''
+    pass
+
+
+HOOKS = ["select_peer", "connection_lost", "connection_received",
+        "send_queue_high", "send_queue_low"]
+
+
+def resolve(hooks):
+    '''Look up every hook on a hooks object (None for all the defaults)
+
+    :returns:
+        a dict mapping each name in HOOKS to a callable, which is either the
+        default or the custom hook wrapped to fall back to the default if it
+        raises
+    '''
+    return dict((name, _get(hooks, name)) for name in HOOKS)
+
 
+def takes_peer_stats(hook):
+    '''Whether a select_peer hook should be passed the peer_stats argument'''
+    try:
+        args = inspect.getargspec(hook).args
+    except TypeError:
+        # not a python function or method, so we can't tell
+        return False
+    return 'peer_stats' in args
+
+
+def _get(hooks, name):
     default = globals()[name]
     hook = getattr(hooks, name, None)
     if hook is None:
         return default
 
+    log.info("using custom hook %s", name)
+
     def handler(*args, **kwargs):
         try:
             return hook(*args, **kwargs)
         except Exception, exc:
-            log.error("exception in hook %s: %r. falling back to default" %
-                    (name, exc))
+            log.error("exception in hook %s: %r. falling back to default",
+                    name, exc)
             return default(*args, **kwargs)
     return handler
+
+
+##
+## Built-in peer selection strategies
+##
+## These are alternatives to the select_peer hook that can be chosen per Hub
+## or per service with Hub.set_peer_selection. Each is called with the
+## eligible peer_addrs and peer_stats, as in select_peer. peers missing from
+## the stats have nothing outstanding and no latency or errors on record.
+## ``None`` stands for local handling, and is preferred on ties.
+##
+
+def _outstanding(peer_stats, addr):
+    stats = peer_stats.get(addr)
+    return stats['outstanding'] if stats else 0
+
+
+def _expected_wait(peer_stats, addr):
+    # a peer with no latency on record counts as instant, so it gets tried
+    stats = peer_stats.get(addr)
+    if not stats or stats['latency'] is None:
+        return 0.0
+    return stats['latency'] * (1 + stats['outstanding'])
+
+
+def _healthy(peer_stats, addr):
+    stats = peer_stats.get(addr)
+    return not stats or stats['error_rate'] < UNHEALTHY_ERROR_RATE
+
+
+def least_outstanding(peer_addrs, peer_stats):
+    '''Choose the peer with the fewest outstanding RPCs
+
+    Ties go to local handling if it is among them, otherwise to a random one
+    of the tied peers.
+    '''
+    return min(peer_addrs, key=lambda addr: (
+        _outstanding(peer_stats, addr), addr is not None, random.random()))
+
+
+def power_of_two(peer_addrs, peer_stats):
+    '''Choose the less loaded of two randomly sampled peers
+
+    This spreads load nearly as well as least_outstanding while avoiding
+    herding every caller onto the same momentarily idle peer.
+    '''
+    if len(peer_addrs) < 2:
+        return peer_addrs[0]
+    first, second = random.sample(peer_addrs, 2)
+    first_load = _outstanding(peer_stats, first)
+    second_load = _outstanding(peer_stats, second)
+    if second_load < first_load or (
+            second_load == first_load and second is None):
+        return second
+    return first
+
+
+def weighted_random(peer_addrs, peer_stats):
+    '''Choose randomly, weighting each peer by 1 / (1 + outstanding RPCs)'''
+    weights = [1.0 / (1 + _outstanding(peer_stats, addr))
+            for addr in peer_addrs]
+    point = random.random() * sum(weights)
+    for addr, weight in zip(peer_addrs, weights):
+        point -= weight
+        if point < 0:
+            return addr
+    return peer_addrs[-1]
+
+
+def fastest(peer_addrs, peer_stats):
+    '''Choose the healthy peer expected to respond soonest
+
+    The expected wait is the peer's average latency scaled by its number of
+    outstanding RPCs. Peers with a high recent error rate are only chosen
+    when no others are eligible, or occasionally to check on their recovery.
+    '''
+    healthy = [addr for addr in peer_addrs if _healthy(peer_stats, addr)]
+    if not healthy:
+        healthy = peer_addrs
+    elif len(healthy) < len(peer_addrs) and random.random() < PROBE_CHANCE:
+        return random.choice(
+                [addr for addr in peer_addrs if addr not in healthy])
+
+    return min(healthy, key=lambda addr: (
+        _expected_wait(peer_stats, addr), addr is not None, random.random()))
+
+
+STRATEGIES = {
+    'fastest': fastest,
+    'least_outstanding': least_outstanding,
+    'power_of_two': power_of_two,
+    'weighted_random': weighted_random,
+}
@@ -23,7 +23,16 @@ MAX_UDP_PACKET_SIZE = 65507
 
 class Hub(object):
     'A hub in the server graph'
-    def __init__(self, addr, peer_addrs, hostname=None, hooks=None):
+    def __init__(self, addr, peer_addrs, hostname=None, hooks=None,
+            route_cache_size=dispatch.ROUTE_CACHE_SIZE,
+            send_batch_size=connection.SEND_BATCH_SIZE, send_linger=0,
+            peer_selection=None, rpc_max_age=None, max_inflight=None,
+            max_queued_bytes=None, on_queue_full=const.QUEUE_BLOCK,
+            chunk_batch_size=1, chunk_batch_bytes=dispatch.CHUNK_BATCH_BYTES,
+            chunk_linger=dispatch.CHUNK_LINGER, fragment_size=None):
+        if on_queue_full not in const.QUEUE_POLICIES:
+            raise ValueError("unknown send queue policy %r" % (on_queue_full,))
+
         self.addr = addr
         self._ident = (hostname or addr[0], addr[1])
         self._peers = peer_addrs
@@ -31,9 +40,21 @@ class Hub(object):
         self._closing = False
         self._listener_coro = None
         self._udp_listener_coro = None
-
-        self._rpc_client = rpc.RPCClient()
-        self._dispatcher = dispatch.Dispatcher(self._rpc_client, self, hooks)
+        self._peer_options = {
+            'send_batch_size': send_batch_size,
+            'send_linger': send_linger,
+            'max_queued_bytes': max_queued_bytes,
+            'on_queue_full': on_queue_full,
+            'fragment_size': fragment_size,
+        }
+
+        self._rpc_client = rpc.RPCClient(rpc_max_age, max_inflight)
+        self._dispatcher = dispatch.Dispatcher(self._rpc_client, self, hooks,
+                route_cache_size=route_cache_size,
+                chunk_batch_size=chunk_batch_size,
+                chunk_batch_bytes=chunk_batch_bytes, chunk_linger=chunk_linger)
+        if peer_selection is not None:
+            self._dispatcher.set_peer_selection(peer_selection)
 
     def wait_connected(self, conns=None, timeout=None):
         '''Wait for connections to be made and their handshakes to finish
@@ -60,7 +81,7 @@ class Hub(object):
             remaining = max(0, deadline - time.time()) if timeout else None
             if not self._started_peers[peer_addr].wait_connected(remaining):
                 if timeout:
-                    log.warn("connect wait timed out after %.2f seconds" %
+                    log.warn("connect wait timed out after %.2f seconds",
                             timeout)
                 return False
         return True
@@ -118,15 +139,42 @@ class Hub(object):
             return lambda h: self.accept_publish(
                     service, mask, value, method, h, schedule)
 
-        log.info("accepting publishes%s %r" % (
-                " scheduled" if schedule else "",
-                (service, (mask, value), method),))
+        log.info("accepting publishes%s %r", " scheduled" if schedule else "",
+                (service, (mask, value), method))
 
         self._dispatcher.add_local_subscription(const.MSG_TYPE_PUBLISH,
                 service, mask, value, method, handler, schedule)
 
         return handler
 
+    def accept_publish_many(self, subscriptions, schedule=False):
+        '''Set handlers for a batch of publish subscriptions
+
+        This works like calling :meth:`accept_publish` for each subscription,
+        except that connected peers are told about all of them in a single
+        message rather than one message per subscription.
+
+        :param subscriptions:
+            ``(service, mask, value, method, handler)`` tuples, with the same
+            meanings as the arguments to :meth:`accept_publish`
+        :type subscriptions: iterable
+        :param schedule:
+            whether to schedule a separate greenlet running the handler for
+            each matching message. default ``False``.
+        :type schedule: bool
+
+        :raises:
+            the same exceptions as :meth:`accept_publish`. the subscriptions
+            in the batch before the offending one will have been made.
+        '''
+        subscriptions = list(subscriptions)
+        log.info("accepting publishes%s for %d subscriptions",
+                " scheduled" if schedule else "", len(subscriptions))
+
+        self._dispatcher.add_local_subscriptions(
+                (const.MSG_TYPE_PUBLISH,) + tuple(sub) + (schedule,)
+                for sub in subscriptions)
+
     def unsubscribe_publish(self, service, mask, value):
         '''Remove a publish subscription
 
@@ -141,8 +189,7 @@ class Hub(object):
             a boolean indicating whether the subscription was there (True) and
             removed, or not (False)
         '''
-        log.info("unsubscribing from publish %r" % (
-                (service, (mask, value)),))
+        log.info("unsubscribing from publish %r", (service, (mask, value)))
         return self._dispatcher.remove_local_subscription(
                 const.MSG_TYPE_PUBLISH, service, mask, value)
 
@@ -233,15 +280,42 @@ class Hub(object):
             return lambda h: self.accept_rpc(
                     service, mask, value, method, h, schedule)
 
-        log.info("accepting RPCs%s %r" % (
-                " scheduled" if schedule else "",
-                (service, (mask, value), method),))
+        log.info("accepting RPCs%s %r", " scheduled" if schedule else "",
+                (service, (mask, value), method))
 
         self._dispatcher.add_local_subscription(const.MSG_TYPE_RPC_REQUEST,
                 service, mask, value, method, handler, schedule)
 
         return handler
 
+    def accept_rpc_many(self, subscriptions, schedule=True):
+        '''Set handlers for a batch of RPC subscriptions
+
+        This works like calling :meth:`accept_rpc` for each subscription,
+        except that connected peers are told about all of them in a single
+        message rather than one message per subscription.
+
+        :param subscriptions:
+            ``(service, mask, value, method, handler)`` tuples, with the same
+            meanings as the arguments to :meth:`accept_rpc`
+        :type subscriptions: iterable
+        :param schedule:
+            whether to schedule a separate greenlet running the handler for
+            each matching message. default ``True``.
+        :type schedule: bool
+
+        :raises:
+            the same exceptions as :meth:`accept_rpc`. the subscriptions in
+            the batch before the offending one will have been made.
+        '''
+        subscriptions = list(subscriptions)
+        log.info("accepting RPCs%s for %d subscriptions",
+                " scheduled" if schedule else "", len(subscriptions))
+
+        self._dispatcher.add_local_subscriptions(
+                (const.MSG_TYPE_RPC_REQUEST,) + tuple(sub) + (schedule,)
+                for sub in subscriptions)
+
     def unsubscribe_rpc(self, service, mask, value):
         '''Remove a rpc subscription
 
@@ -258,12 +332,38 @@ class Hub(object):
             a boolean indicating whether the subscription was there (True) and
             removed, or not (False)
         '''
-        log.info("unsubscribing from RPC %r" % ((service, (mask, value)),))
+        log.info("unsubscribing from RPC %r", (service, (mask, value)))
         return self._dispatcher.remove_local_subscription(
                 const.MSG_TYPE_RPC_REQUEST, service, mask, value)
 
+    def unsubscribe_many(self, publishes=None, rpcs=None):
+        '''Remove a batch of publish and/or rpc subscriptions
+
+        Connected peers are told about all of the removals in a single
+        message.
+
+        :param publishes:
+            ``(service, mask, value)`` tuples of publish subscriptions to
+            remove
+        :type publishes: iterable or None
+        :param rpcs:
+            ``(service, mask, value)`` tuples of rpc subscriptions to remove
+        :type rpcs: iterable or None
+
+        :returns:
+            the number of the subscriptions that were there and removed
+        '''
+        subs = [(const.MSG_TYPE_PUBLISH,) + tuple(sub)
+                for sub in publishes or ()]
+        subs.extend((const.MSG_TYPE_RPC_REQUEST,) + tuple(sub)
+                for sub in rpcs or ())
+
+        log.info("unsubscribing from %d subscriptions", len(subs))
+        return len(self._dispatcher.remove_local_subscriptions(subs))
+
     def send_rpc(self, service, routing_id, method, args=None, kwargs=None,
-            broadcast=False):
+            broadcast=False, hedge=None, deadline=None,
+            on_overload=const.OVERLOAD_BLOCK):
         '''Send out an RPC request
 
         :param service: the service name (the routing top level)
@@ -284,17 +384,49 @@ class Hub(object):
         :param broadcast:
             if ``True``, send to every peer with a matching subscription
         :type broadcast: bool
+        :param hedge:
+            for singular RPCs, send a second copy of the request to another
+            eligible peer if no response has arrived after this many seconds.
+            with ``True`` the delay is derived from the latency seen so far
+            from the first peer. the first response to arrive is the one
+            used. ignored for broadcast and chunked RPCs.
+        :type hedge: float, bool or None
+        :param deadline:
+            seconds from now after which the request's handlers should be
+            skipped rather than run, as the response will no longer be
+            wanted. they then fail with :class:`DeadlineExceeded
+            <junction.errors.DeadlineExceeded>`. peers that don't support
+            deadlines run the handlers regardless. ignored for chunked RPCs.
+            a request blocked waiting on ``max_inflight`` gives up with
+            :class:`WaitTimeout <junction.errors.WaitTimeout>` once it passes.
+        :type deadline: float or None
+        :param on_overload:
+            what to do when ``max_inflight`` is set and the request's targets
+            already have that many RPCs outstanding: ``"block"`` (the
+            default) waits for a response to free up a slot, and ``"fail"``
+            raises :class:`Overloaded <junction.errors.Overloaded>` at once.
+            a singular RPC only needs one eligible peer with room.
+        :type on_overload: str
 
         :returns:
             a :class:`RPC <junction.futures.RPC>` object representing the
             RPC and its future response.
 
         :raises:
-            :class:`Unroutable <junction.errors.Unroutable>` if no peers are
-            registered to receive the message
+            - :class:`Unroutable <junction.errors.Unroutable>` if no peers are
+              registered to receive the message
+            - :class:`Overloaded <junction.errors.Overloaded>` if the
+              targets are at ``max_inflight`` and ``on_overload`` is
+              ``"fail"``
+            - ``ValueError`` if ``on_overload`` isn't ``"block"`` or
+              ``"fail"``
         '''
+        if on_overload not in const.OVERLOAD_POLICIES:
+            raise ValueError("unknown overload policy %r" % (on_overload,))
+
         rpc = self._dispatcher.send_rpc(service, routing_id, method,
-                args or (), kwargs or {}, not broadcast)
+                args or (), kwargs or {}, not broadcast, hedge, deadline,
+                on_overload)
 
         if not rpc:
             raise errors.Unroutable()
@@ -302,7 +434,8 @@ class Hub(object):
         return rpc
 
     def rpc(self, service, routing_id, method, args=None, kwargs=None,
-            timeout=None, broadcast=False):
+            timeout=None, broadcast=False, hedge=None,
+            on_overload=const.OVERLOAD_BLOCK):
         '''Send an RPC request and return the corresponding response
 
         This will block waiting until the response has been received.
@@ -324,11 +457,22 @@ class Hub(object):
         :type kwargs: dict
         :param timeout:
             maximum time to wait for a response in seconds. with None, there is
-            no timeout.
+            no timeout. it is also sent along as the request's ``deadline``
+            (see :meth:`send_rpc`).
         :type timeout: float or None
         :param broadcast:
             if ``True``, send to every peer with a matching subscription
         :type broadcast: bool
+        :param hedge:
+            for singular RPCs, send a second copy of the request to another
+            eligible peer if no response has arrived after this many seconds.
+            with ``True`` the delay is derived from the latency seen so far
+            from the first peer. the first response to arrive is the one
+            used. ignored for broadcast and chunked RPCs.
+        :type hedge: float, bool or None
+        :param on_overload:
+            ``"block"`` or ``"fail"``, see :meth:`send_rpc`
+        :type on_overload: str
 
         :returns:
             a list of the objects returned by the RPC's targets. these could be
@@ -338,11 +482,21 @@ class Hub(object):
             - :class:`Unroutable <junction.errors.Unroutable>` if no peers are
               registered to receive the message
             - :class:`WaitTimeout <junction.errors.WaitTimeout>` if a timeout
-              was provided and it expires
+              was provided and it expires, in which case the RPC is also
+              :meth:`cancelled <junction.futures.RPC.cancel>`
+            - :class:`Overloaded <junction.errors.Overloaded>` if the
+              targets are at ``max_inflight`` and ``on_overload`` is
+              ``"fail"``
         '''
         rpc = self.send_rpc(service, routing_id, method,
-                args or (), kwargs or {}, broadcast)
-        return rpc.get(timeout)
+                args or (), kwargs or {}, broadcast, hedge, timeout,
+                on_overload)
+        try:
+            return rpc.get(timeout)
+        except errors.WaitTimeout:
+            # nobody is waiting for the responses any more
+            rpc.cancel()
+            raise
 
     def rpc_receiver_count(self, service, routing_id):
         '''Get the number of peers that would handle a particular RPC
@@ -363,6 +517,83 @@ class Hub(object):
             return peers + 1
         return peers
 
+    def peer_stats(self):
+        '''Get the statistics kept on RPCs sent to each peer
+
+        Latency and error rate are exponentially weighted moving averages, so
+        they follow recent behavior.
+
+        :returns:
+            a dict mapping peer ``(host, port)``s (and ``None`` for RPCs
+            handled locally) to dicts with the keys:
+
+            - ``outstanding``: the number of RPCs awaiting a response
+            - ``responses``: the number of responses received
+            - ``latency``: the average response time in seconds, or None
+              before the first response
+            - ``deviation``: the average absolute deviation from ``latency``
+            - ``error_rate``: the share of recent responses that failed,
+              between 0 and 1 (handled exceptions don't count as failures)
+        '''
+        return dict((ident, dict(stats))
+                for ident, stats in self._rpc_client.peer_stats.items())
+
+    def stats(self):
+        '''Collect counters describing the hub's internal state
+
+        :returns:
+            a dict with the keys:
+
+            - ``route_cache``: a dict of the route cache's ``hits``,
+              ``misses``, current ``size`` and maximum ``capacity``.
+            - ``peers``: a dict mapping each connected peer's ``(host,
+              port)`` to a dict of its connection's ``queued_frames`` and
+              their total ``queued_bytes``, the ``dropped_frames`` that a
+              full send queue threw away, ``frames_sent``, ``sends``
+              (socket writes) and ``frames_per_send``.
+            - ``rpc_peers``: the result of :meth:`peer_stats`.
+            - ``bookkeeping``: a dict of the number of entries kept for RPCs
+              in progress: ``inflight`` RPCs, their targets yet to respond
+              (``by_peer``), their ``deadlines``, futures garbage collected
+              before they completed and still to be reclaimed
+              (``abandoned``), ``inflight_proxies`` forwarded for clients,
+              chunked messages being received (``received_channels``) or
+              forwarded (``proxying_channels``), and the credits followed
+              for each peer that chunked messages are sent or forwarded to
+              (``send_windows``).
+            - ``overload``: a dict of the ``max_inflight`` limit, the number
+              of senders ``waiting`` for room under it, and the number of
+              requests ``rejected`` for want of room, counting those relayed
+              for clients. the RPCs in flight to each peer are the
+              ``outstanding`` counts in ``rpc_peers``.
+        '''
+        return {
+            'route_cache': self._dispatcher.route_cache_stats(),
+            'bookkeeping': self._dispatcher.bookkeeping_stats(),
+            'overload': self._rpc_client.overload_stats(),
+            'peers': dict((ident, peer.stats())
+                for ident, peer in self._dispatcher.peers.items()),
+            'rpc_peers': self.peer_stats(),
+        }
+
+    def set_peer_selection(self, strategy, service=None):
+        '''Choose how singular publishes and RPCs pick among eligible peers
+
+        :param strategy:
+            the name of one of the load-aware strategies in
+            ``junction.hooks.STRATEGIES`` ("fastest", "least_outstanding",
+            "power_of_two" or "weighted_random"), a function with the same
+            signature, or None to use the ``select_peer`` hook
+        :param service:
+            only apply the strategy to messages for this service. with None
+            (the default), it applies to all services without their own.
+        :type service: anything hash-able
+
+        :raises:
+            ``ValueError`` if ``strategy`` is an unrecognized name
+        '''
+        self._dispatcher.set_peer_selection(strategy, service)
+
     def start(self):
         "Start up the hub's server, and have it start initiating connections"
         log.info("starting")
@@ -378,7 +609,8 @@ class Hub(object):
     def add_peer(self, peer_addr):
         "Build a connection to the Hub at a given ``(host, port)`` address"
         peer = connection.Peer(
-                self._ident, self._dispatcher, peer_addr, backend.Socket())
+                self._ident, self._dispatcher, peer_addr, backend.Socket(),
+                **self._peer_options)
         peer.start()
         self._started_peers[peer_addr] = peer
 
@@ -394,7 +626,7 @@ class Hub(object):
 
         server.bind(self.addr)
         server.listen(socket.SOMAXCONN)
-        log.info("starting listener socket on %r" % (self.addr,))
+        log.info("starting listener socket on %r", self.addr)
 
         while not self._closing:
             try:
@@ -405,7 +637,7 @@ class Hub(object):
                 break
 
             peer = connection.Peer(self._ident, self._dispatcher, addr, client,
-                    initiator=False)
+                    initiator=False, **self._peer_options)
             peer.start()
 
             # we may block on the next accept() call for a while, and these
@@ -418,7 +650,7 @@ class Hub(object):
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(self.addr)
 
-        log.info("starting UDP listener socket on %r" % (self.addr,))
+        log.info("starting UDP listener socket on %r", self.addr)
 
         while not self._closing:
             try:
@@ -430,20 +662,20 @@ class Hub(object):
 
             msg = mummy.loads(msg)
             if not isinstance(msg, tuple) or len(msg) != 3:
-                log.warn("malformed UDP message sent from %r" % (addr,))
+                log.warn("malformed UDP message sent from %r", addr)
 
             msg_type, sender_hostport, msg = msg
             if msg_type not in const.UDP_ALLOWED:
-                log.warn("disallowed UDP message type %r from %r" %
-                        (msg_type, sender_hostport))
+                log.warn("disallowed UDP message type %r from %r",
+                        msg_type, sender_hostport)
                 continue
 
             if sender_hostport not in self._dispatcher.peers:
-                log.warn("UDP message from unknown sender: %r" %
-                        (sender_hostport,))
+                log.warn("UDP message from unknown sender: %r",
+                        sender_hostport)
                 continue
 
-            log.debug("UDP message received from %r" % (sender_hostport,))
+            log.debug("UDP message received from %r", sender_hostport)
 
             peer = self._dispatcher.peers[sender_hostport]
             self._dispatcher.incoming(peer, (msg_type, msg))
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # vim: fileencoding=utf8:et:sta:ai:sw=4:ts=4:sts=4
 
+import gc
 import logging
+import os
 import sys
 import traceback
 import unittest
@@ -9,7 +11,8 @@ import unittest
 import gevent.coros
 import junction
 import junction.errors
-from junction.core import backend
+import junction.hooks
+from junction.core import backend, connection, const, sendqueue, timers, trace
 
 
 TIMEOUT = 0.015
@@ -164,6 +167,45 @@ class JunctionTests(object):
 
         self.assertEqual(results, [0, 1, 2, 3, 4])
 
+    def test_publish_raw_payload(self):
+        results = []
+        ev = backend.Event()
+
+        @self.peer.accept_publish("service", 0, 0, "method")
+        def handler(blob, tag):
+            results.append((blob, tag))
+            ev.set()
+
+        for i in xrange(4):
+            backend.pause()
+
+        blob = "x" * connection.RAW_FRAME_MIN * 4
+        self.sender.publish("service", 0, "method", (blob, 1), {})
+
+        ev.wait(TIMEOUT)
+
+        self.assertEqual(results, [(blob, 1)])
+
+    def test_chunked_publish_raw_payloads(self):
+        results = []
+        ev = backend.Event()
+
+        @self.peer.accept_publish("service", 0, 0, "method")
+        def handler(items):
+            for item in items:
+                results.append(item)
+            ev.set()
+
+        for i in xrange(4):
+            backend.pause()
+
+        blobs = [c * connection.RAW_FRAME_MIN * 2 for c in "abc"]
+        self.sender.publish("service", 0, "method", (iter(blobs + ["d"]),))
+
+        ev.wait(TIMEOUT)
+
+        self.assertEqual(results, blobs + ["d"])
+
     def test_rpc_success(self):
         handler_results = []
         sender_results = []
@@ -380,6 +422,93 @@ class HubTests(JunctionTests, GeventTestCase):
         self.assertEqual(2,
                 self.sender.publish_receiver_count('service', 0))
 
+    def test_bulk_subscribe_and_unsubscribe(self):
+        def handler(x):
+            return x * 2
+
+        self.peer.accept_rpc_many(
+                [('service', 7, value, 'method', handler)
+                    for value in xrange(8)])
+
+        backend.pause_for(TIMEOUT)
+
+        self.assertEqual(8, len(set(
+            self.sender.rpc('service', rid, 'method', (rid,), timeout=TIMEOUT)
+            for rid in xrange(8))))
+
+        self.assertEqual(4, self.peer.unsubscribe_many(
+            rpcs=[('service', 7, value) for value in xrange(4)]))
+
+        backend.pause_for(TIMEOUT)
+
+        self.assertEqual(0, self.sender.rpc_receiver_count('service', 3))
+        self.assertEqual(1, self.sender.rpc_receiver_count('service', 4))
+
+    def test_bulk_subscribe_to_peer_without_feature(self):
+        def handler(x):
+            return x * 2
+
+        # have the peer treat the sender as one that predates the batched
+        # announce and unsubscribe frames
+        backend.pause_for(TIMEOUT)
+        conn = self.peer._dispatcher.peers[self.sender._ident]
+        conn.features = conn.features - set([const.FEATURE_SUBSCRIBE_MANY])
+
+        self.peer.accept_rpc_many(
+                [('service', 7, value, 'method', handler)
+                    for value in xrange(8)])
+
+        backend.pause_for(TIMEOUT)
+
+        self.assertEqual(1, self.sender.rpc_receiver_count('service', 3))
+        self.assertEqual(1, self.sender.rpc_receiver_count('service', 7))
+
+        self.assertEqual(4, self.peer.unsubscribe_many(
+            rpcs=[('service', 7, value) for value in xrange(4)]))
+
+        backend.pause_for(TIMEOUT)
+
+        self.assertEqual(0, self.sender.rpc_receiver_count('service', 3))
+        self.assertEqual(1, self.sender.rpc_receiver_count('service', 4))
+
+    def test_trace_records_rpc_round_trip(self):
+        def handler(x):
+            return x
+
+        self.peer.accept_rpc('service', 0, 0, 'method', handler)
+
+        backend.pause_for(TIMEOUT)
+
+        trace.enable()
+        try:
+            self.assertEqual(1, self.sender.rpc(
+                'service', 0, 'method', (1,), timeout=TIMEOUT))
+            events = trace.snapshot()
+        finally:
+            trace.disable()
+
+        counter = events[0][3]
+        self.assertEqual([
+            ("send", const.MSG_TYPE_RPC_REQUEST, counter),
+            ("recv", const.MSG_TYPE_RPC_REQUEST, counter),
+            ("send", const.MSG_TYPE_RPC_RESPONSE, counter),
+            ("recv", const.MSG_TYPE_RPC_RESPONSE, counter),
+        ], [event[1:4] for event in events])
+
+    def test_peer_stats_track_rpc_latency(self):
+        self.peer.accept_rpc('service', 0, 0, 'method', lambda: None)
+
+        backend.pause_for(TIMEOUT)
+
+        for i in xrange(3):
+            self.sender.rpc('service', 0, 'method', timeout=TIMEOUT)
+
+        stats = self.sender.peer_stats()[self.peer._ident]
+        self.assertEqual(3, stats['responses'])
+        self.assertEqual(0, stats['outstanding'])
+        self.assertEqual(0.0, stats['error_rate'])
+        assert stats['latency'] is not None
+
 
 class ClientTests(JunctionTests, GeventTestCase):
     def build_sender(self):
@@ -419,6 +548,1192 @@ class NetworklessDependentTests(GeventTestCase):
         self.assertEqual(dep.value, 62)
 
 
+class SocketStub(object):
+    'Stands in for a connected socket, recording writes and serving reads'
+    def __init__(self, reads=()):
+        self.reads = list(reads)
+        self.writes = []
+        self.recvs = 0
+
+    def sendall(self, data):
+        self.writes.append(str(data))
+
+    def recv_into(self, buf):
+        self.recvs += 1
+        if not self.reads:
+            return 0
+        data = self.reads.pop(0)
+        if len(data) > len(buf):
+            self.reads.insert(0, data[len(buf):])
+            data = data[:len(buf)]
+        buf[:len(data)] = data
+        return len(data)
+
+
+class ConnectionTests(GeventTestCase):
+    def publishes(self, count):
+        return [(const.MSG_TYPE_PUBLISH, ("service", 0, "method", (i,), {}))
+                for i in xrange(count)]
+
+    def send_all(self, peer):
+        # run the sender until it has emptied the queue
+        sender = backend.greenlet(peer.sender_coro)
+        backend.schedule(sender)
+        backend.pause_for(TIMEOUT)
+        backend.end(sender)
+
+    def test_queued_frames_coalesced(self):
+        msgs = self.publishes(100)
+        sock = SocketStub()
+        peer = connection.Peer(None, None, None, sock)
+        for msg in msgs:
+            peer.push(msg)
+
+        self.send_all(peer)
+
+        self.assertEqual(100, peer.frames_sent)
+        self.assertEqual(1, peer.sends)
+        self.assertEqual(1, len(sock.writes))
+
+        reader = connection.Peer(None, None, None, SocketStub(sock.writes))
+        self.assertEqual(msgs, [reader.recv_one() for msg in msgs])
+
+    def test_coalesced_writes_bounded_by_batch_size(self):
+        msgs = self.publishes(100)
+        sock = SocketStub()
+        peer = connection.Peer(None, None, None, sock, send_batch_size=200)
+        for msg in msgs:
+            peer.push(msg)
+
+        self.send_all(peer)
+
+        self.assertEqual(100, peer.frames_sent)
+        self.assertEqual(len(sock.writes), peer.sends)
+        self.assertTrue(1 < peer.sends < 100)
+
+        reader = connection.Peer(None, None, None,
+                SocketStub([''.join(sock.writes)]))
+        self.assertEqual(msgs, [reader.recv_one() for msg in msgs])
+
+    def test_exchange_frames_kept_in_order(self):
+        # the frames of one RPC go in different lanes, but a chunked proxy
+        # response still can't overtake its count, nor a cancel its request
+        big = os.urandom(sendqueue.LANE_QUANTUM)
+        msgs = [(const.MSG_TYPE_RPC_RESPONSE, (i, 0, big)) for i in xrange(4)]
+        msgs += [
+            (const.MSG_TYPE_PROXY_RESPONSE_COUNT, (5, 1)),
+            (const.MSG_TYPE_PROXY_RESPONSE_IS_CHUNKED, (5, ("127.0.0.1", 1))),
+            (const.MSG_TYPE_REQUEST_IS_CHUNKED, ("service", 0, "method", 6)),
+            (const.MSG_TYPE_CANCEL, 6)]
+        sock = SocketStub()
+        peer = connection.Peer(None, None, None, sock)
+        for msg in msgs:
+            peer.push(msg)
+
+        self.send_all(peer)
+
+        reader = connection.Peer(None, None, None, SocketStub(sock.writes))
+        received = [reader.recv_one() for msg in msgs]
+        self.assertEqual(sorted(msgs), sorted(received))
+        order = [msg[0] for msg in received]
+        self.assertTrue(order.index(const.MSG_TYPE_PROXY_RESPONSE_COUNT) <
+                order.index(const.MSG_TYPE_PROXY_RESPONSE_IS_CHUNKED))
+        self.assertTrue(order.index(const.MSG_TYPE_REQUEST_IS_CHUNKED) <
+                order.index(const.MSG_TYPE_CANCEL))
+
+    def test_unrelated_exchange_not_pinned(self):
+        # our publish stream 5 and the peer's RPC 5 and publish stream 5 are
+        # numbered by different ends, so the response and credit don't have
+        # to wait behind the stream's chunks
+        big = os.urandom(sendqueue.LANE_QUANTUM)
+        msgs = [(const.MSG_TYPE_PUBLISH_IS_CHUNKED,
+            ("service", 0, "method", 5))]
+        msgs += [(const.MSG_TYPE_PUBLISH_CHUNK, (5, 0, big))
+                for i in xrange(4)]
+        msgs += [
+            (const.MSG_TYPE_RPC_RESPONSE, (5, 0, "result")),
+            (const.MSG_TYPE_CREDIT, (const.MSG_TYPE_PUBLISH_IS_CHUNKED, 5, 1))]
+        sock = SocketStub()
+        peer = connection.Peer(None, None, None, sock)
+        for msg in msgs:
+            peer.push(msg)
+
+        self.send_all(peer)
+
+        reader = connection.Peer(None, None, None, SocketStub(sock.writes))
+        order = [reader.recv_one()[0] for msg in msgs]
+        self.assertTrue(order.index(const.MSG_TYPE_RPC_RESPONSE) <
+                order.index(const.MSG_TYPE_PUBLISH_CHUNK))
+        self.assertTrue(order.index(const.MSG_TYPE_CREDIT) <
+                order.index(const.MSG_TYPE_PUBLISH_CHUNK))
+
+    def test_several_frames_in_one_recv(self):
+        msgs = self.publishes(3)
+        sock = SocketStub([''.join(connection.dump(msg) for msg in msgs)])
+        peer = connection.Peer(None, None, None, sock)
+
+        self.assertEqual(msgs, [peer.recv_one() for msg in msgs])
+        self.assertEqual(1, sock.recvs)
+
+    def test_frame_split_across_recvs(self):
+        msg, = self.publishes(1)
+        frame = connection.dump(msg)
+        sock = SocketStub([frame[:10], frame[10:]])
+        peer = connection.Peer(None, None, None, sock)
+
+        self.assertEqual(msg, peer.recv_one())
+        self.assertEqual(2, sock.recvs)
+
+    def test_length_prefix_split_across_recvs(self):
+        msgs = self.publishes(2)
+        data = ''.join(connection.dump(msg) for msg in msgs)
+        first = len(connection.dump(msgs[0]))
+        sock = SocketStub([data[:2], data[2:first + 3], data[first + 3:]])
+        peer = connection.Peer(None, None, None, sock)
+
+        self.assertEqual(msgs, [peer.recv_one() for msg in msgs])
+        self.assertEqual(3, sock.recvs)
+
+    def test_large_frame_grows_buffer(self):
+        msg = (const.MSG_TYPE_PUBLISH, ("service", 0, "method",
+            (os.urandom(connection.RECV_BUFFER_SIZE * 2),), {}))
+        sock = SocketStub([connection.dump(msg)])
+        peer = connection.Peer(None, None, None, sock)
+
+        self.assertEqual(msg, peer.recv_one())
+        self.assertEqual(connection.RECV_BUFFER_SIZE, len(peer._recv_buf))
+
+    def test_cut_off_frame(self):
+        msg, = self.publishes(1)
+        sock = SocketStub([connection.dump(msg)[:-1]])
+        peer = connection.Peer(None, None, None, sock)
+
+        self.assertRaises(junction.errors.MessageCutOff, peer.recv_one)
+
+class TraceTests(GeventTestCase):
+    def test_every_message_type_indexed(self):
+        for msg_type in const.REVERSE:
+            self.assertIn(msg_type, const.COUNTER_INDEX)
+
+    def test_message_ids(self):
+        cases = [
+            (const.MSG_TYPE_RPC_REQUEST,
+                (5, "service", 0, "method", (), {}), 5),
+            (const.MSG_TYPE_PUBLISH_END_CHUNKS, 6, 6),
+            (const.MSG_TYPE_REQUEST_IS_CHUNKED,
+                ("service", 0, "method", 7), 7),
+            (const.MSG_TYPE_PROXY_RESPONSE_CHUNK,
+                (("127.0.0.1", 1), 8, 0, "chunk"), 8),
+            (const.MSG_TYPE_ANNOUNCE_MANY, [(1, "service", 0, 0)], None),
+            (const.MSG_TYPE_FEATURES, ["request_options"], None),
+            (const.MSG_TYPE_CANCEL, 9, 9),
+            (const.MSG_TYPE_CREDIT,
+                (const.MSG_TYPE_PUBLISH_IS_CHUNKED, 10, 3), 10),
+            (const.MSG_TYPE_FRAGMENT, (11, True, "x"), 11),
+        ]
+        trace.enable()
+        try:
+            for msg_type, msg, msg_id in cases:
+                trace.record("send", msg_type, msg, ())
+            events = trace.snapshot()
+        finally:
+            trace.disable()
+
+        self.assertEqual([case[2] for case in cases],
+                [event[3] for event in events])
+
+    def test_proxied_response_chunk_id(self):
+        trace.enable()
+        try:
+            trace.record("send", const.MSG_TYPE_PROXY_RESPONSE_CHUNK,
+                    (("127.0.0.1", 1), 4, 0, "chunk"), ())
+            events = trace.snapshot()
+        finally:
+            trace.disable()
+
+        self.assertEqual([4], [event[3] for event in events])
+
+
+class RawFrameTests(GeventTestCase):
+    def test_round_trip(self):
+        blob = "x" * connection.RAW_FRAME_MIN
+        msg = (const.MSG_TYPE_PUBLISH,
+                ("service", 0, "method", (blob, 2), {}))
+        frame = connection.RawFrame(msg, (3, 0))
+
+        peer = connection.Peer(None, None, None, None)
+        peer._recv_buf = bytearray(frame.header + blob)
+        peer._recv_end = len(frame)
+        self.assertEqual(msg, peer.recv_one())
+
+    def test_small_payloads_serialized(self):
+        msg = (const.MSG_TYPE_PUBLISH_CHUNK, (1, 0, "x" * 10))
+        self.assertEqual(None, connection.raw_payload(msg, (2,)))
+        self.assertEqual(None, connection.raw_payload(msg, (3,)))
+
+    def test_only_strs_raw(self):
+        blob = "x" * connection.RAW_FRAME_MIN
+        for payload in (bytearray(blob), memoryview(blob)):
+            msg = (const.MSG_TYPE_PUBLISH_CHUNK, (1, 0, payload))
+            self.assertEqual(None, connection.raw_payload(msg, (2,)))
+
+    def test_split_and_reassemble(self):
+        # random bytes, so the serializer can't compress them below a piece
+        blob = os.urandom(connection.RAW_FRAME_MIN)
+        msg = (const.MSG_TYPE_PUBLISH,
+                ("service", 0, "method", (blob, 2), {}))
+
+        for frame in (connection.dump(msg),
+                connection.RawFrame(msg, (3, 0))):
+            pieces = connection._split(frame, 1000)
+            self.assertEqual(1000, len(pieces[0]))
+            self.assertEqual(msg, connection.load_frame(''.join(
+                piece if isinstance(piece, str) else piece.tobytes()
+                for piece in pieces)))
+
+
+class NetworklessSubscriptionTests(GeventTestCase):
+    def setUp(self):
+        super(NetworklessSubscriptionTests, self).setUp()
+        self.hub = junction.Hub(("127.0.0.1", 0), [])
+
+    def handler(self):
+        pass
+
+    def peer(self, port):
+        # a stand-in for a connected peer, as far as routing is concerned
+        peer = connection.Peer(None, self.hub._dispatcher,
+                ("127.0.0.1", port), None)
+        peer.ident = ("127.0.0.1", port)
+        return peer
+
+    def test_local_routes_follow_subscriptions(self):
+        dispatcher = self.hub._dispatcher
+        rpc = const.MSG_TYPE_RPC_REQUEST
+        for value in xrange(4):
+            self.hub.accept_rpc('service', 3, value, 'shard', self.handler)
+
+        self.assertEqual((self.handler, True),
+                dispatcher.find_local_handler(rpc, 'service', 6, 'shard'))
+        self.assertEqual((None, False),
+                dispatcher.find_local_handler(rpc, 'service', 6, 'other'))
+
+        assert self.hub.unsubscribe_rpc('service', 3, 2)
+        self.assertFalse(dispatcher.locally_handles(rpc, 'service', 6))
+        self.assertTrue(dispatcher.locally_handles(rpc, 'service', 7))
+
+        self.hub.accept_rpc('service', 4, 4, 'wide', self.handler)
+        self.assertTrue(dispatcher.locally_handles(rpc, 'service', 6))
+        self.assertEqual((self.handler, True),
+                dispatcher.find_local_handler(rpc, 'service', 6, 'wide'))
+
+    def test_peer_routed_once_across_masks(self):
+        dispatcher = self.hub._dispatcher
+        rpc = const.MSG_TYPE_RPC_REQUEST
+        peer, other = self.peer(1), self.peer(2)
+        dispatcher.add_peer_subscriptions(peer,
+                [(rpc, 'service', 1, 1), (rpc, 'service', 3, 3)])
+        dispatcher.add_peer_subscriptions(other, [(rpc, 'service', 3, 3)])
+
+        self.assertEqual([peer], dispatcher.find_peer_routes(
+            rpc, 'service', 5))
+        self.assertEqual(set([peer, other]), set(dispatcher.find_peer_routes(
+            rpc, 'service', 7)))
+        self.assertEqual(2, len(dispatcher.find_peer_routes(
+            rpc, 'service', 7)))
+        self.assertEqual([], dispatcher.find_peer_routes(rpc, 'service', 4))
+
+    def test_cached_routes_follow_subscriptions(self):
+        dispatcher = self.hub._dispatcher
+        rpc = const.MSG_TYPE_RPC_REQUEST
+        peer = self.peer(1)
+
+        def routes():
+            return dispatcher.find_routes(rpc, 'service', 5, 'method')
+
+        self.assertEqual(((), None, False), routes())
+
+        dispatcher.incoming_announce(peer, (rpc, 'service', 1, 1))
+        self.assertEqual(((peer,), None, False), routes())
+
+        self.hub.accept_rpc('service', 1, 1, 'method', self.handler)
+        self.assertEqual(((peer,), self.handler, True), routes())
+
+        dispatcher.incoming_unsubscribe(peer, (rpc, 'service', 1, 1))
+        self.assertEqual(((), self.handler, True), routes())
+
+        assert self.hub.unsubscribe_rpc('service', 1, 1)
+        self.assertEqual(((), None, False), routes())
+
+        dispatcher.incoming_announce(peer, (rpc, 'service', 1, 1))
+        self.assertEqual(((peer,), None, False), routes())
+
+        dispatcher.drop_peer_subscriptions(peer)
+        self.assertEqual(((), None, False), routes())
+
+    def test_route_cache_stats(self):
+        dispatcher = self.hub._dispatcher
+        rpc = const.MSG_TYPE_RPC_REQUEST
+        self.hub.accept_rpc('service', 0, 0, 'method', self.handler)
+        for i in xrange(3):
+            dispatcher.find_routes(rpc, 'service', 5, 'method')
+        dispatcher.find_routes(rpc, 'service', 6, 'method')
+
+        self.assertEqual({'hits': 2, 'misses': 2, 'size': 2,
+                'capacity': dispatcher.route_cache_size},
+                self.hub.stats()['route_cache'])
+
+    def test_route_cache_disabled(self):
+        hub = junction.Hub(("127.0.0.1", 0), [], route_cache_size=0)
+        hub.accept_rpc('service', 0, 0, 'method', self.handler)
+        for i in xrange(3):
+            self.assertEqual(((), self.handler, True),
+                    hub._dispatcher.find_routes(const.MSG_TYPE_RPC_REQUEST,
+                        'service', 5, 'method'))
+
+        stats = hub.stats()['route_cache']
+        self.assertEqual((0, 3, 0),
+                (stats['hits'], stats['misses'], stats['size']))
+
+    def test_dropped_peer_leaves_nothing_indexed(self):
+        dispatcher = self.hub._dispatcher
+        rpc = const.MSG_TYPE_RPC_REQUEST
+        peer, other = self.peer(1), self.peer(2)
+        for p in (peer, other):
+            dispatcher.peers[p.ident] = p
+        dispatcher.add_peer_subscriptions(peer, [(rpc, 'service', 1, 1),
+            (const.MSG_TYPE_PUBLISH, 'service', 0, 0)])
+        dispatcher.add_peer_subscriptions(other, [(rpc, 'service', 1, 1)])
+
+        self.assertEqual(2, len(dispatcher.drop_peer(peer)))
+        self.assertEqual({other: set([(rpc, 'service', 1, 1)])},
+                dispatcher.subs_by_peer)
+        self.assertEqual({(rpc, 'service'): {1: {1: set([other])}}},
+                dispatcher.peer_subs)
+
+        dispatcher.incoming_unsubscribe(other, (rpc, 'service', 1, 1))
+        self.assertEqual({}, dispatcher.subs_by_peer)
+        self.assertEqual({}, dispatcher.peer_subs)
+
+    def test_overlapping_subscription_rejected(self):
+        for value in xrange(64):
+            self.hub.accept_rpc('service', 63, value, 'method', self.handler)
+
+        self.assertRaises(junction.errors.OverlappingSubscription,
+                self.hub.accept_rpc, 'service', 3, 2, 'method', self.handler)
+        self.assertRaises(junction.errors.OverlappingSubscription,
+                self.hub.accept_rpc, 'service', 127, 66, 'method',
+                self.handler)
+
+    def test_overlap_allowed_across_methods(self):
+        self.hub.accept_rpc('service', 1, 0, 'method1', self.handler)
+        self.hub.accept_rpc('service', 0, 0, 'method2', self.handler)
+        self.hub.accept_rpc('service', 1, 1, 'method1', self.handler)
+
+        self.assertEqual(self.hub.rpc_receiver_count('service', 5), 1)
+
+    def test_resubscribe_after_unsubscribe(self):
+        self.hub.accept_rpc('service', 3, 1, 'method', self.handler)
+        assert self.hub.unsubscribe_rpc('service', 3, 1)
+        self.hub.accept_rpc('service', 1, 1, 'method', self.handler)
+
+    def test_hooks_resolved_on_swap(self):
+        class Hooks(object):
+            def select_peer(self, peer_addrs, service, routing_id, method):
+                return peer_addrs[-1]
+
+        dispatcher = self.hub._dispatcher
+        default = dispatcher.select_peer_hook
+        addrs = [None, ("127.0.0.1", 9000)]
+
+        dispatcher.hooks = Hooks()
+        self.assertEqual(("127.0.0.1", 9000), dispatcher.select_peer_hook(
+            addrs, 'service', 0, 'method'))
+
+        dispatcher.hooks = None
+        assert dispatcher.select_peer_hook is default
+        self.assertEqual(None, dispatcher.select_peer_hook(
+            addrs, 'service', 0, 'method'))
+
+
+class TimerWheelTests(GeventTestCase):
+    def manual_wheel(self):
+        # no driver coroutine, the test advances the wheel itself
+        wheel = timers.TimerWheel()
+        wheel.driven = lambda: True
+        return wheel
+
+    def test_timers_fire_in_batches(self):
+        fired = []
+        for i in xrange(5):
+            timers.add(TIMEOUT, fired.append, (i,))
+        timers.add(TIMEOUT * 10, fired.append, (5,))
+
+        backend.pause_for(TIMEOUT * 3)
+        self.assertEqual([0, 1, 2, 3, 4], sorted(fired))
+
+        backend.pause_for(TIMEOUT * 10)
+        self.assertEqual([0, 1, 2, 3, 4, 5], sorted(fired))
+
+    def test_cancelled_timer_never_fires(self):
+        fired = []
+        timer = timers.add(TIMEOUT, fired.append, (1,))
+        timer.cancel()
+        timer.cancel()
+        assert not timer.pending
+
+        backend.pause_for(TIMEOUT * 3)
+        self.assertEqual([], fired)
+
+    def test_far_timers_cascade_down(self):
+        wheel = self.manual_wheel()
+        fired = []
+        for secs in (0.5, 50, 500, 10 ** 6):
+            wheel.add(secs, fired.append, (secs,))
+
+        for i, secs in enumerate((0.5, 50, 500, 10 ** 6)):
+            wheel.advance(wheel.origin + secs - 0.1)
+            self.assertEqual(i, len(fired))
+            wheel.advance(wheel.origin + secs + 0.1)
+            self.assertEqual(secs, fired[-1])
+
+        self.assertEqual(0, wheel.count)
+
+    def test_timers_fire_after_reactivation(self):
+        fired = []
+        timers.add(TIMEOUT * 10, fired.append, (1,))
+        backend.pause()
+        wheel = timers._wheel
+
+        junction.activate_gevent()
+        timers.add(TIMEOUT, fired.append, (2,))
+        assert timers._wheel is not wheel
+
+        backend.pause_for(TIMEOUT * 3)
+        self.assertEqual([2], fired)
+
+    def test_dead_driver_replaced(self):
+        fired = []
+        timers.add(TIMEOUT * 10, fired.append, (1,))
+        backend.pause()
+
+        # as if the driver had been killed before it got to clear itself out
+        dead = backend.greenlet(lambda: None)
+        backend.schedule(dead)
+        backend.pause()
+        timers._wheel._driver = dead
+
+        timers.add(TIMEOUT, fired.append, (2,))
+        backend.pause_for(TIMEOUT * 3)
+        self.assertEqual([2], fired)
+
+    def test_wait_all_times_out_as_a_whole(self):
+        futs = [junction.Future() for i in xrange(3)]
+        backend.schedule_in(TIMEOUT, futs[0].finish, args=(0,))
+        self.assertRaises(junction.errors.WaitTimeout,
+                junction.wait_all, futs, TIMEOUT * 3)
+        assert futs[0].complete
+        assert not futs[1].complete
+
+        futs[1].finish(1)
+        futs[2].finish(2)
+        junction.wait_all(futs, TIMEOUT)
+        self.assertEqual(0, timers._wheel.count)
+
+
+class SendQueueTests(GeventTestCase):
+    def test_block_until_drained(self):
+        queue = sendqueue.SendQueue(100, const.QUEUE_BLOCK)
+        queue.put('a' * 60)
+        backend.schedule(queue.put, args=('b' * 60,))
+
+        backend.pause_for(TIMEOUT)
+        self.assertEqual(1, queue.qsize())
+
+        self.assertEqual('a' * 60, queue.get())
+        backend.pause_for(TIMEOUT)
+        self.assertEqual(1, queue.qsize())
+        self.assertEqual(60, queue.bytes)
+
+    def test_drop_oldest_publishes(self):
+        queue = sendqueue.SendQueue(100, const.QUEUE_DROP)
+        queue.put('a' * 40, True)
+        queue.put('r' * 40)
+        queue.put('b' * 40, True)
+        queue.put('c' * 40, True)
+
+        # nothing left to drop, so the response goes in over the bound
+        queue.put('s' * 90)
+
+        self.assertEqual(['r' * 40, 's' * 90],
+                [queue.get() for i in xrange(2)])
+        self.assertEqual(3, queue.dropped)
+
+    def test_disconnect_on_overflow(self):
+        overflows = []
+        queue = sendqueue.SendQueue(100, const.QUEUE_DISCONNECT,
+                on_overflow=overflows.append)
+        assert queue.put('a' * 60)
+        assert not queue.put('b' * 60)
+
+        self.assertEqual([120], overflows)
+        self.assertEqual(1, queue.qsize())
+
+    def test_watermarks(self):
+        marks = []
+        queue = sendqueue.SendQueue(100, const.QUEUE_DROP,
+                on_high=lambda b: marks.append(('high', b)),
+                on_low=lambda b: marks.append(('low', b)))
+        for i in xrange(4):
+            queue.put('a' * 25)
+        for i in xrange(3):
+            queue.get()
+
+        self.assertEqual([('high', 75), ('low', 25)], marks)
+
+    def test_wait_drained(self):
+        queue = sendqueue.SendQueue()
+        for i in xrange(4):
+            queue.put('a' * 25)
+
+        drained = []
+        backend.schedule(
+                lambda: drained.append(queue.wait_drained(50)))
+        backend.pause_for(TIMEOUT)
+        self.assertEqual([], drained)
+
+        queue.get()
+        backend.pause_for(TIMEOUT)
+        self.assertEqual([], drained)
+
+        queue.get()
+        backend.pause_for(TIMEOUT)
+        self.assertEqual([None], drained)
+
+    def test_lanes_take_turns(self):
+        queue = sendqueue.SendQueue()
+        bulk = 'x' * (sendqueue.LANE_QUANTUM - 2)
+        for i in xrange(4):
+            queue.put('b%d' % i + bulk, False, const.LANE_BULK)
+        queue.put('r', False, const.LANE_RPC)
+        queue.put('c', False, const.LANE_CONTROL)
+
+        self.assertEqual(['r', 'b0', 'c', 'b1', 'b2', 'b3'],
+                [queue.get()[:2] for i in xrange(6)])
+
+    def test_lanes_share_by_weight(self):
+        queue = sendqueue.SendQueue()
+        frame = 'x' * (sendqueue.LANE_QUANTUM - 1)
+        for i in xrange(8):
+            queue.put('r' + frame, False, const.LANE_RPC)
+            queue.put('b' + frame, False, const.LANE_BULK)
+
+        self.assertEqual(list('rrbrrb'), [queue.get()[0] for i in xrange(6)])
+
+    def test_exchange_follows_its_queued_frames(self):
+        # on its own the control lane would get its turn while the bulk
+        # frame is still waiting for enough deficit
+        queue = sendqueue.SendQueue()
+        queue.put('b7' + 'x' * sendqueue.LANE_QUANTUM, False,
+                const.LANE_BULK, 7)
+        queue.put('c7', False, const.LANE_CONTROL, 7)
+        queue.put('c', False, const.LANE_CONTROL)
+
+        self.assertEqual(['c', 'b7', 'c7'],
+                [queue.get()[:2] for i in xrange(3)])
+        self.assertEqual({}, queue.pinned)
+
+    def test_unknown_policy_rejected(self):
+        self.assertRaises(ValueError, junction.Hub, ("127.0.0.1", 0), [],
+                max_queued_bytes=100, on_queue_full="spill")
+
+
+class PeerSelectionTests(GeventTestCase):
+    def setUp(self):
+        super(PeerSelectionTests, self).setUp()
+        self.hub = junction.Hub(("127.0.0.1", 0), [])
+
+    def test_least_outstanding_prefers_local_on_ties(self):
+        stats = {("127.0.0.1", 1): {'outstanding': 3},
+                ("127.0.0.1", 2): {'outstanding': 1}}
+        addrs = [("127.0.0.1", 1), ("127.0.0.1", 2)]
+
+        self.assertEqual(("127.0.0.1", 2),
+                junction.hooks.least_outstanding(addrs, stats))
+
+        stats[None] = {'outstanding': 1}
+        self.assertEqual(None,
+                junction.hooks.least_outstanding(addrs + [None], stats))
+
+    def test_power_of_two_picks_less_loaded(self):
+        stats = {("127.0.0.1", 1): {'outstanding': 3}}
+        addrs = [("127.0.0.1", 1), ("127.0.0.1", 2)]
+
+        for i in xrange(10):
+            self.assertEqual(("127.0.0.1", 2),
+                    junction.hooks.power_of_two(addrs, stats))
+
+    def test_fastest_skips_slow_and_unhealthy_peers(self):
+        slow, failing, quick = [("127.0.0.1", port) for port in (1, 2, 3)]
+        stats = {
+            slow: {'outstanding': 0, 'latency': 0.5, 'error_rate': 0.0},
+            failing: {'outstanding': 0, 'latency': 0.001, 'error_rate': 0.9},
+            quick: {'outstanding': 0, 'latency': 0.01, 'error_rate': 0.0},
+        }
+
+        probe_chance = junction.hooks.PROBE_CHANCE
+        junction.hooks.PROBE_CHANCE = 0
+        try:
+            self.assertEqual(quick,
+                    junction.hooks.fastest([slow, failing, quick], stats))
+            self.assertEqual(slow,
+                    junction.hooks.fastest([slow, failing], stats))
+        finally:
+            junction.hooks.PROBE_CHANCE = probe_chance
+
+    def test_per_service_strategy(self):
+        class Peer(object):
+            def __init__(self, ident):
+                self.ident = ident
+
+        busy, idle = Peer(("127.0.0.1", 1)), Peer(("127.0.0.1", 2))
+        self.hub._rpc_client.peer_stats[busy.ident] = {'outstanding': 5}
+        self.hub.set_peer_selection('least_outstanding', 'service')
+
+        for i in xrange(10):
+            assert self.hub._dispatcher.target_selection(
+                    [busy, idle], 'service', 0, 'method') is idle
+
+        self.assertRaises(ValueError,
+                self.hub.set_peer_selection, 'no_such_strategy')
+
+
+class HedgedRPCTests(GeventTestCase):
+    def setUp(self):
+        global PORT
+        super(HedgedRPCTests, self).setUp()
+
+        def slow():
+            backend.pause_for(TIMEOUT * 10)
+            return 'slow'
+
+        self.slow = junction.Hub(("127.0.0.1", PORT), [])
+        PORT += 2
+        self.slow.accept_rpc('service', 0, 0, 'method', slow)
+        self.slow.start()
+
+        self.fast = junction.Hub(("127.0.0.1", PORT), [])
+        PORT += 2
+        self.fast.accept_rpc('service', 0, 0, 'method', lambda: 'fast')
+        self.fast.start()
+
+        self.sender = junction.Hub(("127.0.0.1", PORT),
+                [self.slow.addr, self.fast.addr])
+        PORT += 2
+        self.sender.start()
+        self.sender.wait_connected()
+
+        # always go to the slow hub first when it's an option
+        slow_ident = self.slow._ident
+        self.sender.set_peer_selection(lambda addrs, stats:
+                slow_ident if slow_ident in addrs else addrs[0])
+
+        backend.pause_for(TIMEOUT)
+
+    def tearDown(self):
+        for hub in (self.sender, self.slow, self.fast):
+            hub.shutdown()
+        super(HedgedRPCTests, self).tearDown()
+
+    def test_hedge_completes_from_second_peer(self):
+        rpc = self.sender.send_rpc('service', 0, 'method', hedge=TIMEOUT)
+        self.assertEqual('fast', rpc.get(TIMEOUT * 5))
+
+        # the slow response arrives later and only clears the bookkeeping
+        backend.pause_for(TIMEOUT * 10)
+        self.assertEqual('fast', rpc.value)
+        self.assertEqual({}, self.sender._rpc_client.inflight)
+        self.assertEqual(0,
+                self.sender.peer_stats()[self.slow._ident]['outstanding'])
+
+    def test_client_hedge_happens_at_hub(self):
+        client = junction.Client(self.sender.addr)
+        client.connect()
+        client.wait_connected()
+
+        self.assertEqual('fast', client.rpc('service', 0, 'method',
+            timeout=TIMEOUT * 5, hedge=TIMEOUT))
+
+
+class TwoHubTestCase(GeventTestCase):
+    '''Tests between a "remote" hub and a "sender" hub connected to it
+
+    Subclasses set up the remote's handlers in add_handlers, and can pass
+    other arguments to either hub in remote_options and sender_options.
+    '''
+    remote_options = {}
+    sender_options = {}
+
+    def setUp(self):
+        global PORT
+        super(TwoHubTestCase, self).setUp()
+
+        self.remote = junction.Hub(("127.0.0.1", PORT), [],
+                **self.remote_options)
+        PORT += 2
+        self.add_handlers(self.remote)
+        self.remote.start()
+
+        self.sender = junction.Hub(("127.0.0.1", PORT), [self.remote.addr],
+                **self.sender_options)
+        PORT += 2
+        self.sender.start()
+        self.sender.wait_connected()
+
+        # let the MSG_TYPE_FEATURES messages arrive
+        backend.pause_for(TIMEOUT)
+
+    def tearDown(self):
+        self.sender.shutdown()
+        self.remote.shutdown()
+        super(TwoHubTestCase, self).tearDown()
+
+    def add_handlers(self, hub):
+        pass
+
+
+class DeadlineTests(TwoHubTestCase):
+    def add_handlers(self, hub):
+        self.calls = []
+        hub.accept_rpc('service', 0, 0, 'method',
+                lambda: self.calls.append(1))
+
+    def test_features_exchanged(self):
+        peer = self.sender._dispatcher.peers[self.remote._ident]
+        self.assertIn(const.FEATURE_REQUEST_OPTIONS, peer.features)
+
+    def test_expired_deadline_skips_handler(self):
+        rpc = self.sender.send_rpc('service', 0, 'method', deadline=0)
+        self.assertRaises(junction.errors.DeadlineExceeded,
+                rpc.get, TIMEOUT * 5)
+        self.assertEqual([], self.calls)
+
+    def test_handler_runs_within_deadline(self):
+        self.sender.rpc('service', 0, 'method', timeout=TIMEOUT * 5)
+        self.assertEqual([1], self.calls)
+
+    def test_hub_forwards_client_deadline(self):
+        client = junction.Client(self.sender.addr)
+        client.connect()
+        client.wait_connected()
+        backend.pause_for(TIMEOUT)
+
+        rpc = client.send_rpc('service', 0, 'method', deadline=0)
+        self.assertRaises(junction.errors.DeadlineExceeded,
+                rpc.get, TIMEOUT * 5)
+        self.assertEqual([], self.calls)
+        client.shutdown()
+
+
+class CancelTests(TwoHubTestCase):
+    def add_handlers(self, hub):
+        self.finished = []
+        self.chunks_sent = []
+
+        def slow():
+            backend.pause_for(TIMEOUT * 5)
+            self.finished.append(1)
+
+        def stream():
+            while 1:
+                self.chunks_sent.append(1)
+                yield 1
+                backend.pause_for(TIMEOUT / 5)
+
+        hub.accept_rpc('service', 0, 0, 'slow', slow)
+        hub.accept_rpc('service', 0, 0, 'stream', stream)
+
+    def test_timeout_cancels_remote_handler(self):
+        self.assertRaises(junction.errors.WaitTimeout, self.sender.rpc,
+                'service', 0, 'slow', timeout=TIMEOUT)
+        backend.pause_for(TIMEOUT * 10)
+
+        self.assertEqual([], self.finished)
+        self.assertEqual({}, self.sender._rpc_client.inflight)
+        self.assertEqual({}, self.remote._dispatcher.outgoing_channels)
+
+    def test_cancel_aborts_rpc(self):
+        rpc = self.sender.send_rpc('service', 0, 'slow')
+        rpc.cancel()
+        self.assertRaises(junction.errors.Cancelled, rpc.get, TIMEOUT)
+
+        backend.pause_for(TIMEOUT * 10)
+        self.assertEqual([], self.finished)
+
+    def test_cancel_stops_chunked_response(self):
+        rpc = self.sender.send_rpc('service', 0, 'stream')
+        chunks = rpc.get(TIMEOUT * 5)
+        self.assertEqual(1, chunks.next())
+        rpc.cancel()
+        self.assertEqual([], list(chunks))
+
+        backend.pause_for(TIMEOUT)
+        sent = len(self.chunks_sent)
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(sent, len(self.chunks_sent))
+        self.assertEqual({}, self.remote._dispatcher.outgoing_channels)
+        self.assertEqual({}, self.sender._dispatcher.received_channels)
+
+    def test_client_cancel_passes_through_hub(self):
+        client = junction.Client(self.sender.addr)
+        client.connect()
+        client.wait_connected()
+
+        self.assertRaises(junction.errors.WaitTimeout, client.rpc,
+                'service', 0, 'slow', timeout=TIMEOUT)
+        backend.pause_for(TIMEOUT * 10)
+
+        self.assertEqual([], self.finished)
+        self.assertEqual({}, self.sender._dispatcher.inflight_proxies)
+        self.assertEqual({}, self.sender._dispatcher.proxied_requests)
+        client.shutdown()
+
+
+class BookkeepingTests(TwoHubTestCase):
+    sender_options = {'rpc_max_age': TIMEOUT * 2}
+
+    def add_handlers(self, hub):
+        def slow():
+            backend.pause_for(TIMEOUT * 5)
+
+        hub.accept_rpc('service', 0, 0, 'slow', slow)
+        hub.accept_rpc('service', 0, 0, 'echo', lambda x: x)
+
+    def bookkeeping(self):
+        return self.sender.stats()['bookkeeping']
+
+    def test_abandoned_rpc_reclaimed(self):
+        self.sender.send_rpc('service', 0, 'slow')
+        gc.collect()
+        self.assertEqual(1, self.bookkeeping()['abandoned'])
+
+        self.assertEqual(1, self.sender.rpc('service', 0, 'echo', (1,),
+            timeout=TIMEOUT))
+        bookkeeping = self.bookkeeping()
+        self.assertEqual(0, bookkeeping['abandoned'])
+        self.assertEqual(0, bookkeeping['inflight'])
+        self.assertEqual(0, bookkeeping['by_peer'])
+        self.assertEqual(0,
+                self.sender.peer_stats()[self.remote._ident]['outstanding'])
+
+        # the late response is dropped quietly
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(0, self.bookkeeping()['inflight'])
+
+    def test_rpc_expires_after_max_age(self):
+        rpc = self.sender.send_rpc('service', 0, 'slow')
+        backend.pause_for(TIMEOUT * 3)
+        self.sender._dispatcher.reclaim()
+
+        self.assertTrue(rpc.complete)
+        self.assertRaises(junction.errors.WaitTimeout, rpc.get)
+        self.assertEqual(0, self.bookkeeping()['inflight'])
+
+    def test_proxied_rpcs_leave_nothing_behind(self):
+        client = junction.Client(self.sender.addr)
+        client.connect()
+        client.wait_connected()
+
+        for i in xrange(3):
+            self.assertEqual(i, client.rpc('service', 0, 'echo', (i,),
+                timeout=TIMEOUT))
+
+        # the hub tracked the deadlines the client passed along, too
+        bookkeeping = self.bookkeeping()
+        self.assertEqual(0, bookkeeping['deadlines'])
+        self.assertEqual(dict.fromkeys(bookkeeping, 0), bookkeeping)
+        self.assertEqual(dict.fromkeys(client.stats()['bookkeeping'], 0),
+                client.stats()['bookkeeping'])
+        client.shutdown()
+
+    def test_abandoned_proxied_rpc_reclaimed(self):
+        client = junction.Client(self.sender.addr)
+        client.connect()
+        client.wait_connected()
+
+        client.send_rpc('service', 0, 'slow')
+        gc.collect()
+        self.assertEqual(1, client.stats()['bookkeeping']['abandoned'])
+
+        self.assertEqual(1, client.rpc('service', 0, 'echo', (1,),
+            timeout=TIMEOUT))
+        self.assertEqual(dict.fromkeys(client.stats()['bookkeeping'], 0),
+                client.stats()['bookkeeping'])
+        client.shutdown()
+
+
+class ReconnectTests(TwoHubTestCase):
+    def restart_remote(self):
+        # bring up a fresh remote at the same address once the sender has
+        # noticed the old one went away and started reconnecting
+        addr = self.remote.addr
+        self.remote.shutdown()
+        backend.pause_for(TIMEOUT)
+        self.remote = junction.Hub(addr, [])
+        self.remote.start()
+
+    def test_reconnect_after_backend_reactivation(self):
+        # the timers from before go with the old timer wheel
+        junction.activate_gevent()
+        self.restart_remote()
+
+        self.assertTrue(self.sender.wait_connected(timeout=1.0))
+
+    def test_reconnect_outlives_a_lost_timer(self):
+        class LostTimers(object):
+            def add(self, secs, func, args=()):
+                return self
+
+            def cancel(self):
+                pass
+
+        real_timers, backstop = connection.timers, \
+                connection.RECONNECT_BACKSTOP
+        connection.timers = LostTimers()
+        connection.RECONNECT_BACKSTOP = TIMEOUT * 2
+        try:
+            self.restart_remote()
+            self.assertTrue(self.sender.wait_connected(timeout=1.0))
+        finally:
+            connection.timers = real_timers
+            connection.RECONNECT_BACKSTOP = backstop
+
+
+class OverloadTests(TwoHubTestCase):
+    sender_options = {'max_inflight': 2}
+
+    def add_handlers(self, hub):
+        def slow():
+            backend.pause_for(TIMEOUT * 5)
+
+        hub.accept_rpc('service', 0, 0, 'slow', slow, schedule=True)
+
+    def test_fail_fast_when_full(self):
+        rpcs = [self.sender.send_rpc('service', 0, 'slow') for i in xrange(2)]
+
+        self.assertRaises(junction.errors.Overloaded, self.sender.send_rpc,
+                'service', 0, 'slow', on_overload="fail")
+        self.assertEqual(1, self.sender.stats()['overload']['rejected'])
+
+        junction.wait_all(rpcs, TIMEOUT * 10)
+        self.sender.send_rpc('service', 0, 'slow', on_overload="fail")
+
+    def test_block_until_room(self):
+        rpcs = [self.sender.send_rpc('service', 0, 'slow') for i in xrange(2)]
+
+        rpcs.append(self.sender.send_rpc('service', 0, 'slow'))
+        assert rpcs[0].complete or rpcs[1].complete
+        self.assertEqual(0, self.sender.stats()['overload']['waiting'])
+
+        junction.wait_all(rpcs, TIMEOUT * 10)
+
+    def test_blocked_send_gives_up_at_deadline(self):
+        # held onto, or they'd be reclaimed as abandoned
+        rpcs = [self.sender.send_rpc('service', 0, 'slow') for i in xrange(2)]
+
+        self.assertRaises(junction.errors.WaitTimeout, self.sender.send_rpc,
+                'service', 0, 'slow', deadline=TIMEOUT)
+        self.assertRaises(ValueError, self.sender.send_rpc,
+                'service', 0, 'slow', on_overload="drop")
+
+    def test_client_limit_and_relayed_overload(self):
+        client = junction.Client(self.sender.addr, max_inflight=1)
+        client.connect()
+        client.wait_connected()
+
+        first = client.send_rpc('service', 0, 'slow')
+        self.assertRaises(junction.errors.Overloaded, client.send_rpc,
+                'service', 0, 'slow', on_overload="fail")
+        self.assertEqual(1, client.stats()['overload']['rejected'])
+        first.wait(TIMEOUT * 10)
+
+        # the hub refuses what it would have to queue beyond its own limit
+        other = junction.Client(self.sender.addr)
+        other.connect()
+        other.wait_connected()
+        rpcs = [other.send_rpc('service', 0, 'slow') for i in xrange(3)]
+        junction.wait_all(rpcs, TIMEOUT * 10)
+        self.assertRaises(junction.errors.Overloaded, rpcs[2].get)
+
+        client.shutdown()
+        other.shutdown()
+
+
+class FlowControlTests(TwoHubTestCase):
+    def add_handlers(self, hub):
+        self.held = []
+        self.produced = []
+
+        def hold(chunks):
+            self.held.append(chunks)
+
+        def take_two(chunks):
+            chunks.next()
+            chunks.next()
+
+        hub.accept_publish('service', 0, 0, 'hold', hold)
+        hub.accept_publish('service', 0, 0, 'take_two', take_two)
+
+    def stream(self, count=None):
+        i = 0
+        while count is None or i < count:
+            self.produced.append(i)
+            yield i
+            i += 1
+
+    def test_sender_waits_for_credit(self):
+        self.sender.publish('service', 0, 'hold', (self.stream(),))
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(const.CHUNK_WINDOW, len(self.produced))
+
+        chunks = self.held[0]
+        for i in xrange(const.CHUNK_WINDOW // 2):
+            self.assertEqual(i, chunks.next())
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(const.CHUNK_WINDOW * 3 // 2, len(self.produced))
+
+    def test_abandoned_stream_releases_sender(self):
+        self.sender.publish('service', 0, 'take_two',
+                (self.stream(const.CHUNK_WINDOW * 3),))
+        backend.pause_for(TIMEOUT * 10)
+
+        self.assertEqual(const.CHUNK_WINDOW * 3, len(self.produced))
+        self.assertEqual({}, self.sender._dispatcher.send_windows)
+        self.assertEqual({}, self.remote._dispatcher.received_channels)
+
+    def test_hub_relays_credits_from_client(self):
+        client = junction.Client(self.sender.addr)
+        client.connect()
+        client.wait_connected()
+
+        client.publish('service', 0, 'hold', (self.stream(),))
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(const.CHUNK_WINDOW, len(self.produced))
+
+        chunks = self.held[0]
+        for i in xrange(const.CHUNK_WINDOW // 2):
+            chunks.next()
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(const.CHUNK_WINDOW * 3 // 2, len(self.produced))
+        client.shutdown()
+
+
+class CoalescingTests(TwoHubTestCase):
+    sender_options = {'chunk_batch_size': 10, 'chunk_linger': None}
+
+    def add_handlers(self, hub):
+        self.held = []
+        self.received = []
+
+        def hold(chunks):
+            self.held.append(chunks)
+
+        def collect(chunks):
+            for chunk in chunks:
+                self.received.append(chunk)
+
+        hub.accept_publish('service', 0, 0, 'hold', hold)
+        hub.accept_publish('service', 0, 0, 'collect', collect)
+
+    def test_chunks_arrive_one_at_a_time(self):
+        self.sender.publish('service', 0, 'collect', (iter(xrange(25)),))
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(range(25), self.received)
+
+    def test_window_counts_packed_frames(self):
+        produced = []
+
+        def stream():
+            i = 0
+            while 1:
+                produced.append(i)
+                yield i
+                i += 1
+
+        self.sender.publish('service', 0, 'hold', (stream(),))
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(const.CHUNK_WINDOW * 10, len(produced))
+
+    def test_error_follows_packed_chunks(self):
+        def stream():
+            for i in xrange(5):
+                yield i
+            raise ValueError("broken stream")
+
+        self.sender.publish('service', 0, 'collect', (stream(),))
+        backend.pause_for(TIMEOUT * 5)
+
+        self.assertEqual(6, len(self.received))
+        self.assertEqual(range(5), self.received[:5])
+        self.assertIsInstance(
+                self.received[5], junction.errors.RemoteException)
+
+    def test_packed_chunks_through_hub(self):
+        client = junction.Client(self.sender.addr, chunk_batch_size=10,
+                chunk_linger=None)
+        client.connect()
+        client.wait_connected()
+
+        client.publish('service', 0, 'collect', (iter(xrange(25)),))
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(range(25), self.received)
+        client.shutdown()
+
+
+class FragmentTests(TwoHubTestCase):
+    remote_options = {'fragment_size': 1000}
+    sender_options = {'fragment_size': 1000}
+
+    def add_handlers(self, hub):
+        self.received = []
+        # random bytes, so the serializer can't compress them below a piece
+        self.blob = os.urandom(10000)
+
+        def collect(item):
+            self.received.append(item)
+
+        def big(size):
+            return {'data': self.blob[:size]}
+
+        hub.accept_publish('service', 0, 0, 'collect', collect)
+        hub.accept_rpc('service', 0, 0, 'big', big)
+
+    def test_large_response_fragmented(self):
+        self.assertEqual({'data': self.blob},
+                self.sender.rpc('service', 0, 'big', (10000,),
+                    timeout=TIMEOUT * 5))
+
+        peer = self.remote._dispatcher.peers.values()[0]
+        self.assertEqual(1, peer._fragmented)
+
+    def test_large_raw_publish_fragmented(self):
+        blob = 'y' * 20000
+        self.sender.publish('service', 0, 'collect', (blob,))
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual([blob], self.received)
+
+        peer = self.sender._dispatcher.peers.values()[0]
+        self.assertEqual(1, peer._fragmented)
+
+    def test_small_frames_whole(self):
+        self.sender.publish('service', 0, 'collect', ('small',))
+        backend.pause_for(TIMEOUT * 5)
+        self.assertEqual(['small'], self.received)
+
+        peer = self.sender._dispatcher.peers.values()[0]
+        self.assertEqual(0, peer._fragmented)
+
+
 class DownedConnectionTests(GeventTestCase):
     def kill_client(self, cli_list):
         cli = cli_list.pop()
@@ -556,6 +1871,9 @@ class DownedConnectionTests(GeventTestCase):
         def gen():
             yield 1
             yield 2
+            # chunk senders only yield once in a while, so let the chunks
+            # go out before the connection does
+            backend.pause()
             self.kill_hub(hub2)
 
         hub2[0].publish('service', 0, 'method', (gen(),))
@@ -589,6 +1907,9 @@ class DownedConnectionTests(GeventTestCase):
         def gen():
             yield 1
             yield 2
+            # chunk senders only yield once in a while, so let the chunks
+            # go out before the connection does
+            backend.pause()
             self.kill_client(client)
 
         client[0].publish('service', 0, 'method', (gen(),))